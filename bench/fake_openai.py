@@ -0,0 +1,136 @@
+"""
+Servidor local que imita el endpoint de chat completions de OpenAI para los benchmarks.
+
+Devuelve una evaluacion en markdown de longitud fija tras la latencia configurada. Con
+`stream: true` la envia palabra por palabra como SSE, repartiendo la latencia entre los
+fragmentos. El servicio se apunta a este servidor con OPENAI_BASE_URL=http://host:puerto/v1.
+
+    python -m bench.fake_openai --port 8082 --latency 4
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EVALUACION = (
+    "## Diagnostico\n\n"
+    "- **Estado general**: vigor vegetal medio-alto, sin anomalias extensas.\n"
+    "- **Zonas de atencion**: el cuadrante noreste muestra valores bajos de NIR.\n\n"
+    "## Recomendaciones\n\n"
+    "1. Inspeccion en campo de las zonas de bajo vigor.\n"
+    "2. Repetir el monitoreo en 7 dias.\n"
+)
+
+
+class OpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Se configuran en start()
+    latency = 0.0
+    jitter = 0.0
+    content = EVALUACION
+    stats = {'completions': 0, 'request_bytes': 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.endswith('/chat/completions'):
+            data = b'{"error": {"message": "not found"}}'
+            self.send_response(404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        request = json.loads(body)
+        with self.stats_lock:
+            self.stats['completions'] += 1
+            self.stats['request_bytes'] += len(body)
+        if request.get('stream'):
+            self._stream(request)
+            return
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        completion = {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'gpt-4o-mini'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': len(body) // 4, 'completion_tokens': len(self.content) // 4,
+                      'total_tokens': (len(body) + len(self.content)) // 4},
+        }
+        data = json.dumps(completion).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, request: dict):
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        partes = re.findall(r'\S+\s*', self.content)
+        latency = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def enviar(data: str):
+            evento = f'data: {data}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(evento):x}\r\n'.encode('ascii') + evento + b'\r\n')
+            self.wfile.flush()
+
+        for i, parte in enumerate(partes + [None]):
+            time.sleep(latency / (len(partes) + 1))
+            delta = {} if parte is None else {'content': parte}
+            if i == 0:
+                delta['role'] = 'assistant'
+            enviar(json.dumps({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': request.get('model', 'gpt-4o-mini'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': 'stop' if parte is None else None}],
+            }))
+        enviar('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def start(host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0) -> ThreadingHTTPServer:
+    handler = type('Handler', (OpenAIHandler,), {
+        'latency': latency, 'jitter': jitter, 'stats': {'completions': 0, 'request_bytes': 0},
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-openai', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.0, help='segundos por respuesta')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    args = parser.parse_args()
+    server = start(args.host, args.port, args.latency, args.jitter)
+    print(f'OpenAI falso en http://{args.host}:{server.server_port}/v1')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
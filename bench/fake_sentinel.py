@@ -0,0 +1,151 @@
+"""
+Servidor local que imita la API de Sentinel Hub (OAuth, Process y Catalog) para los benchmarks.
+
+Responde a la peticion de procesamiento con un tar de PNGs, uno por cada `identifier`
+pedido, del tamaño solicitado (limitado por --max-size). Las bandas simples son de un
+canal y las combinadas (`combined_*`) RGB; fuera de una elipse central los pixeles van
+en 0, como los que quedan fuera del poligono de la parcela. El catalogo devuelve una
+adquisicion cada 5 dias dentro del rango pedido.
+
+    python -m bench.fake_sentinel --port 8081 --latency 1.5
+"""
+import argparse
+import functools
+import io
+import json
+import random
+import tarfile
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+
+@functools.lru_cache(maxsize=256)
+def _png(identifier: str, width: int, height: int) -> bytes:
+    # Contenido estable por banda: un gradiente suave con ruido y la mascara de la parcela
+    rng = np.random.default_rng(zlib.crc32(identifier.encode('utf-8')))
+    yy, xx = np.mgrid[0:height, 0:width]
+    base = 0.5 + 0.25 * np.sin(xx / max(width, 1) * 6) * np.cos(yy / max(height, 1) * 4)
+    fuera = ((xx - width / 2) / (width / 2)) ** 2 + ((yy - height / 2) / (height / 2)) ** 2 > 1
+    canales = 3 if identifier.startswith('combined_') else 1
+    bandas = []
+    for _ in range(canales):
+        banda = np.clip(base + rng.normal(0, 0.05, base.shape), 0, 1) * 254 + 1
+        banda[fuera] = 0
+        bandas.append(banda.astype(np.uint8))
+    array = np.dstack(bandas) if canales == 3 else bandas[0]
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def build_tar(identifiers, width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for identifier in identifiers:
+            data = _png(identifier, width, height)
+            info = tarfile.TarInfo(f'{identifier}.png')
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class SentinelHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Se configuran en start()
+    latency = 0.0
+    jitter = 0.0
+    max_size = 512
+    token_ttl = 3600
+    stats = {'oauth': 0, 'process': 0, 'catalog': 0, 'bytes': 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/token'):
+            with self.stats_lock:
+                self.stats['oauth'] += 1
+            token = {'access_token': f'bench-{time.time()}', 'token_type': 'Bearer', 'expires_in': self.token_ttl}
+            self._send(200, 'application/json', json.dumps(token).encode('utf-8'))
+            return
+        if self.path.endswith('/catalog/1.0.0/search'):
+            self._catalog(json.loads(body))
+            return
+        if not self.path.endswith('/process'):
+            self._send(404, 'application/json', b'{"error": "not found"}')
+            return
+
+        payload = json.loads(body)
+        output = payload.get('output', {})
+        width = min(int(output.get('width', 256)), self.max_size)
+        height = min(int(output.get('height', 256)), self.max_size)
+        identifiers = [response['identifier'] for response in output.get('responses', [])]
+        # Tiempo de procesamiento de Sentinel Hub
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        data = build_tar(identifiers, width, height)
+        with self.stats_lock:
+            self.stats['process'] += 1
+            self.stats['bytes'] += len(data)
+        self._send(200, 'application/x-tar', data)
+
+    def _catalog(self, payload: dict):
+        # Busqueda con distinct=date: las fechas de adquisicion como lista de strings
+        desde, hasta = (date.fromisoformat(valor[:10]) for valor in payload['datetime'].split('/'))
+        fechas = []
+        fecha = date(2020, 1, 1) + timedelta(days=(desde - date(2020, 1, 1)).days // 5 * 5)
+        while fecha <= hasta:
+            if fecha >= desde:
+                fechas.append(fecha.isoformat())
+            fecha += timedelta(days=5)
+        with self.stats_lock:
+            self.stats['catalog'] += 1
+        self._send(200, 'application/json', json.dumps({'features': fechas, 'context': {}}).encode('utf-8'))
+
+
+def start(host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+          max_size: int = 512) -> ThreadingHTTPServer:
+    handler = type('Handler', (SentinelHandler,), {
+        'latency': latency, 'jitter': jitter, 'max_size': max_size,
+        'stats': {'oauth': 0, 'process': 0, 'catalog': 0, 'bytes': 0},
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-sentinel', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='segundos de procesamiento por peticion')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--max-size', type=int, default=512, help='lado maximo de cada PNG en pixeles')
+    args = parser.parse_args()
+    server = start(args.host, args.port, args.latency, args.jitter, args.max_size)
+    print(f'Sentinel Hub falso en http://{args.host}:{server.server_port} '
+          f'(OAuth: /oauth/token, Process: /api/v1/process, Catalog: /api/v1/catalog/1.0.0/search)')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+"""
+Benchmark de punta a punta del API contra servicios externos locales.
+
+Levanta un Sentinel Hub y un OpenAI falsos (bench.fake_sentinel, bench.fake_openai),
+arranca el API con uvicorn en un subproceso apuntado a ellos y al emulador de
+Firestore, y mide cada escenario con N peticiones a la concurrencia indicada. El
+resultado (latencias p50/p95/p99, peticiones/s, pico de RSS del servidor y bytes en
+disco) se imprime y se guarda como JSON para comparar entre versiones.
+
+Requiere el emulador de Firestore en marcha, por ejemplo:
+
+    gcloud emulators firestore start --host-port=127.0.0.1:8085
+    FIRESTORE_EMULATOR_HOST=127.0.0.1:8085 python -m bench.run --output bench_output.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from typing import Awaitable, Callable, List, Optional
+
+import httpx
+
+from bench import fake_openai, fake_sentinel
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ESCENARIOS = ('crud_write', 'ejecutar', 'jobs', 'crud_read')
+
+
+def percentil(valores: List[float], p: float) -> Optional[float]:
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p / 100
+    inferior = int(k)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (k - inferior)
+
+
+def _proc_status(pid: int) -> dict:
+    # VmHWM: pico de memoria residente; VmRSS: la actual (solo Linux)
+    valores = {}
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for linea in status:
+                if linea.startswith(('VmHWM:', 'VmRSS:')):
+                    nombre, valor = linea.split(':', 1)
+                    valores[nombre] = int(valor.split()[0]) * 1024
+    except OSError:
+        pass
+    return valores
+
+
+def _reset_peak_rss(pid: int):
+    # Escribir 5 en clear_refs reinicia VmHWM (Linux >= 4.0); si no se puede, el pico es acumulado
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def disk_bytes(*paths: str) -> int:
+    # Cada inodo se cuenta una vez: las imagenes enlazadas (hard links) no suman dos veces
+    vistos = set()
+    total = 0
+    for path in paths:
+        for directorio, _, archivos in os.walk(path):
+            for archivo in archivos:
+                try:
+                    stat = os.stat(os.path.join(directorio, archivo))
+                except OSError:
+                    continue
+                if (stat.st_dev, stat.st_ino) not in vistos:
+                    vistos.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_size
+    return total
+
+
+def poligono(indice: int, lado_m: float) -> List[dict]:
+    # Parcelas cuadradas separadas entre si, en la zona de Santa Cruz
+    lat0 = -17.80 - (indice // 50) * 0.01
+    lon0 = -63.20 + (indice % 50) * 0.01
+    delta = lado_m / 111_320
+    return [
+        {'latitude': lat0, 'longitude': lon0},
+        {'latitude': lat0, 'longitude': lon0 + delta},
+        {'latitude': lat0 + delta, 'longitude': lon0 + delta},
+        {'latitude': lat0 + delta, 'longitude': lon0},
+    ]
+
+
+class Servidor:
+    """El API en un subproceso de uvicorn, para medir su memoria por separado."""
+
+    def __init__(self, env: dict, port: int):
+        self.env = env
+        self.port = port
+        self.process: Optional[subprocess.Popen] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self, timeout: float = 60):
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(self.port),
+             '--no-access-log'],
+            cwd=PROJECT_ROOT, env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'El servidor termino al arrancar: {self.process.stderr.read().decode()[-2000:]}')
+            try:
+                if httpx.get(f'{self.url}/', timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        raise RuntimeError('El servidor no respondio a tiempo')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+async def medir(nombre: str, servidor: Servidor, total: int, concurrencia: int,
+                peticion: Callable[[httpx.AsyncClient, int], Awaitable[int]], rutas_disco: List[str]) -> dict:
+    latencias: List[float] = []
+    estados: dict = {}
+    errores = 0
+    semaforo = asyncio.Semaphore(concurrencia)
+    disco_inicial = disk_bytes(*rutas_disco)
+    _reset_peak_rss(servidor.process.pid)
+
+    async def una(cliente: httpx.AsyncClient, i: int):
+        nonlocal errores
+        async with semaforo:
+            inicio = time.perf_counter()
+            try:
+                estado = await peticion(cliente, i)
+            except httpx.HTTPError:
+                errores += 1
+                return
+            latencias.append(time.perf_counter() - inicio)
+            estados[str(estado)] = estados.get(str(estado), 0) + 1
+            if estado >= 500:
+                errores += 1
+
+    limits = httpx.Limits(max_connections=concurrencia, max_keepalive_connections=concurrencia)
+    async with httpx.AsyncClient(base_url=servidor.url, timeout=600, limits=limits) as cliente:
+        inicio = time.perf_counter()
+        await asyncio.gather(*(una(cliente, i) for i in range(total)))
+        duracion = time.perf_counter() - inicio
+
+    memoria = _proc_status(servidor.process.pid)
+    return {
+        'scenario': nombre,
+        'requests': total,
+        'concurrency': concurrencia,
+        'errors': errores,
+        'status': estados,
+        'duration_s': round(duracion, 3),
+        'rps': round(len(latencias) / duracion, 3) if duracion else None,
+        'latency_s': {
+            'p50': percentil(latencias, 50),
+            'p95': percentil(latencias, 95),
+            'p99': percentil(latencias, 99),
+            'max': max(latencias) if latencias else None,
+        },
+        'peak_rss_bytes': memoria.get('VmHWM'),
+        'rss_bytes': memoria.get('VmRSS'),
+        'disk_bytes': disk_bytes(*rutas_disco) - disco_inicial,
+    }
+
+
+async def preparar(servidor: Servidor, usuario: str, parcelas: int, lado_m: float) -> List[str]:
+    async with httpx.AsyncClient(base_url=servidor.url, timeout=120) as cliente:
+        respuesta = await cliente.post('/auth/register', json={'username': usuario, 'password': 'benchmark'})
+        respuesta.raise_for_status()
+        items = [{'nombre': f'parcela {i}', 'ubicacion': poligono(i, lado_m), 'tipo_monitoreo': ['plagas']}
+                 for i in range(parcelas)]
+        respuesta = await cliente.post(f'/parcelas/bulk/{usuario}', json=items)
+        respuesta.raise_for_status()
+        # Las series por ruta deben usar la plantilla completa, con el prefijo del router
+        metricas = (await cliente.get('/metrics')).text
+        serie = 'farmai_http_request_seconds_count{method="POST",route="/parcelas/bulk/{usuario_id}",status="200"}'
+        if serie not in metricas:
+            raise RuntimeError(f'/metrics no tiene la serie {serie}')
+        return [parcela['id'] for parcela in respuesta.json()]
+
+
+def escenarios(usuario: str, parcela_ids: List[str], lado_m: float):
+    def parcela(i: int) -> str:
+        return parcela_ids[i % len(parcela_ids)]
+
+    async def crud_write(cliente: httpx.AsyncClient, i: int) -> int:
+        indice = i % len(parcela_ids)
+        body = {'nombre': f'parcela {indice}', 'usuario_id': usuario, 'ubicacion': poligono(indice, lado_m),
+                'tipo_monitoreo': ['plagas']}
+        return (await cliente.put(f'/parcelas/{usuario}/{parcela(i)}', json=body)).status_code
+
+    async def ejecutar(cliente: httpx.AsyncClient, i: int) -> int:
+        return (await cliente.get(f'/analisis/ejecutar/{usuario}/{parcela(i)}/plagas')).status_code
+
+    async def jobs(cliente: httpx.AsyncClient, i: int) -> int:
+        # Latencia hasta que el trabajo termina, no solo hasta que se encola
+        respuesta = await cliente.post(f'/analisis/jobs/{usuario}/{parcela(i)}/plagas')
+        if respuesta.status_code != 202:
+            return respuesta.status_code
+        job_id = respuesta.json()['id']
+        while True:
+            await asyncio.sleep(0.1)
+            job = (await cliente.get(f'/analisis/jobs/{job_id}')).json()
+            if job['etapa'] == 'done':
+                return 200
+            if job['etapa'] == 'failed':
+                return 500
+
+    async def crud_read(cliente: httpx.AsyncClient, i: int) -> int:
+        opcion = i % 3
+        if opcion == 0:
+            return (await cliente.get(f'/parcelas/{usuario}/{parcela(i)}')).status_code
+        if opcion == 1:
+            return (await cliente.get(f'/parcelas/{usuario}', params={'limit': 50})).status_code
+        respuesta = await cliente.get(f'/analisis/{usuario}/{parcela(i)}/', params={'limit': 20, 'campos': 'indices'})
+        # Una parcela sin analisis devuelve 404: tambien es una respuesta valida
+        return 200 if respuesta.status_code == 404 else respuesta.status_code
+
+    return {'crud_write': crud_write, 'ejecutar': ejecutar, 'jobs': jobs, 'crud_read': crud_read}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(ESCENARIOS), help=f'de: {", ".join(ESCENARIOS)}')
+    parser.add_argument('--requests', type=int, default=200, help='peticiones por escenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--parcelas', type=int, default=50)
+    parser.add_argument('--parcela-lado-m', type=float, default=500, help='lado de cada parcela en metros')
+    parser.add_argument('--sentinel-latency', type=float, default=1.0)
+    parser.add_argument('--sentinel-max-size', type=int, default=512)
+    parser.add_argument('--openai-latency', type=float, default=2.0)
+    parser.add_argument('--jitter', type=float, default=0.1, help='variacion de las latencias simuladas')
+    parser.add_argument('--workers', type=int, default=4, help='JOBS_WORKERS del servidor')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--no-cache', action='store_true', help='desactiva las caches de imagenes y evaluaciones')
+    parser.add_argument('--catalog', action='store_true',
+                        help='activa el pre-chequeo del catalogo (las repeticiones sin escenas nuevas no descargan)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='conservar las imagenes y bases generadas')
+    parser.add_argument('--output', help='archivo JSON de resultados')
+    args = parser.parse_args()
+
+    if not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        parser.error('FIRESTORE_EMULATOR_HOST no esta definido: inicie el emulador de Firestore')
+    nombres = [nombre.strip() for nombre in args.scenarios.split(',') if nombre.strip()]
+    desconocidos = [nombre for nombre in nombres if nombre not in ESCENARIOS]
+    if desconocidos:
+        parser.error(f'escenarios desconocidos: {", ".join(desconocidos)}')
+    random.seed(args.seed)
+
+    run_id = f'{time.strftime("%Y%m%d%H%M%S")}_{uuid.uuid4().hex[:6]}'
+    work_dir = os.path.join(PROJECT_ROOT, '.bench', run_id)
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+
+    sentinel = fake_sentinel.start(latency=args.sentinel_latency, jitter=args.jitter,
+                                   max_size=args.sentinel_max_size)
+    openai = fake_openai.start(latency=args.openai_latency, jitter=args.jitter)
+    env = dict(os.environ)
+    env.update({
+        'FIREBASE_COLLECTION_PREFIX': f'bench_{run_id}_',
+        'SENTINEL_OAUTH_URL': f'http://127.0.0.1:{sentinel.server_port}/oauth/token',
+        'SENTINEL_PROCESS_URL': f'http://127.0.0.1:{sentinel.server_port}/api/v1/process',
+        'SENTINEL_CATALOG_URL': f'http://127.0.0.1:{sentinel.server_port}/api/v1/catalog/1.0.0/search',
+        'SENTINEL_CLIENT_ID': 'bench',
+        'SENTINEL_CLIENT_SECRET': 'bench',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{openai.server_port}/v1',
+        'OPENAI_API_KEY': 'bench',
+        # Se concatena a la raiz del proyecto (ver services.storage.get_storage_path)
+        'STORAGE_CONTAINER_PATH': f'/.bench/{run_id}/img',
+        'JOBS_DB_PATH': os.path.join(data_dir, 'jobs.db'),
+        'JOBS_WORKERS': str(args.workers),
+        'IMAGERY_CACHE_PATH': os.path.join(data_dir, 'imagery_cache'),
+        'EVAL_CACHE_PATH': os.path.join(data_dir, 'evaluation_cache.db'),
+        'LOG_FILE': '',
+        'LOG_LEVEL': 'WARNING',
+        'SCHEDULER_ENABLED': 'false',
+        # Por defecto cada peticion recorre el pipeline completo
+        'CATALOG_ENABLED': 'true' if args.catalog else 'false',
+    })
+    if args.no_cache:
+        env.update({'IMAGERY_CACHE_ENABLED': 'false', 'EVAL_CACHE_ENABLED': 'false'})
+
+    servidor = Servidor(env, args.port)
+    resultados = []
+    try:
+        servidor.start()
+        usuario = f'bench_{run_id}'
+        parcela_ids = asyncio.run(preparar(servidor, usuario, args.parcelas, args.parcela_lado_m))
+        peticiones = escenarios(usuario, parcela_ids, args.parcela_lado_m)
+        for nombre in nombres:
+            resultado = asyncio.run(medir(nombre, servidor, args.requests, args.concurrency, peticiones[nombre],
+                                          [work_dir]))
+            resultados.append(resultado)
+            print(json.dumps(resultado), file=sys.stderr)
+    finally:
+        servidor.stop()
+        sentinel.shutdown()
+        openai.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    reporte = {
+        'run_id': run_id,
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'fakes': {'sentinel': sentinel.RequestHandlerClass.stats, 'openai': openai.RequestHandlerClass.stats},
+        'scenarios': resultados,
+    }
+    salida = json.dumps(reporte, indent=2)
+    print(salida)
+    if args.output:
+        with open(args.output, 'w') as archivo:
+            archivo.write(salida + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,40 @@
-from fastapi import FastAPI
+import time
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from routers import auth, parcela, analisis, analysis
+from fastapi.middleware.gzip import GZipMiddleware
+from routers import auth, parcela, analisis, analysis, imagenes
+from services import jobs, pipeline, http_client, scheduler, mirror, metrics, log_config, lifecycle
 import os
-import logging
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Logging JSON a stdout y a logs/app.log (rotado), escrito desde un hilo aparte
+log_config.setup_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Iniciar los workers que procesan la cola de analisis
+    jobs.start_workers(pipeline.ejecutar_job)
+    # Encolar los monitoreos programados de las parcelas (SCHEDULER_ENABLED)
+    scheduler.start_scheduler()
+    # Aplicar la politica de retencion de imagenes en disco (LIFECYCLE_ENABLED)
+    lifecycle.start_lifecycle()
+    yield
+    lifecycle.stop_lifecycle()
+    scheduler.stop_scheduler()
+    jobs.stop_workers()
+    await http_client.aclose()
+    if mirror.mirror:
+        mirror.mirror.close()
+    log_config.shutdown_logging()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="FarmAI Backend API",
     description="API para la gestión de FarmAI",
     version="1.0.0",
@@ -24,25 +51,64 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Permite todos los métodos
     allow_headers=["*"],  # Permite todos los headers
+    expose_headers=["X-Next-Page-Token", "X-Request-ID", "X-Sin-Datos-Nuevos"],  # Paginacion, logs y pre-chequeo
 )
 
-# Configurar logging
-if not os.path.exists('logs'):
-    os.makedirs('logs')
+# Comprimir las respuestas grandes (listados de analisis con evaluaciones)
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv('GZIP_MINIMUM_SIZE', '1024')))
+
+
+@app.middleware("http")
+async def medir_peticiones(request: Request, call_next):
+    metrics.HTTP_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        metrics.HTTP_IN_FLIGHT.dec()
+        # Plantilla de la ruta (no la URL) para no crear una serie por cada id; la ruta del
+        # scope es la del router, sin el prefijo con el que se incluyo
+        route = request.scope.get('route')
+        plantilla = PLANTILLAS_RUTAS.get(id(route), route.path) if route else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.labels(request.method, plantilla,
+                                            str(status_code)).observe(time.perf_counter() - start)
+
+
+@app.middleware("http")
+async def correlacionar_peticiones(request: Request, call_next):
+    # Id de correlacion: el que envia el cliente o uno nuevo; se incluye en cada log
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    token = log_config.request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        log_config.request_id_var.reset(token)
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
+
 
 # Configurar imagenes
 if not os.path.exists('img'):
     os.makedirs('img')
 
-level = os.getenv('LOG_LEVEL', 'INFO')
-
-logging.basicConfig(filename='logs/app.log', level=level, format='%(asctime)s - %(levelname)s - %(message)s')
-
-# Incluir los routers
-app.include_router(auth.router, prefix="/auth", tags=["auth"])
-app.include_router(parcela.router, prefix="/parcelas", tags=["parcelas"])
-app.include_router(analysis.router, prefix="/analysis", tags=["analysis"])
-app.include_router(analisis.router, prefix="/analisis", tags=["analisis"])
+# Incluir los routers, guardando la plantilla completa (prefijo + ruta) de cada ruta
+PLANTILLAS_RUTAS = {}
+for router, prefix, tag in [(auth.router, "/auth", "auth"),
+                            (parcela.router, "/parcelas", "parcelas"),
+                            (analysis.router, "/analysis", "analysis"),
+                            (analisis.router, "/analisis", "analisis"),
+                            (imagenes.router, "/imagenes", "imagenes")]:
+    app.include_router(router, prefix=prefix, tags=[tag])
+    PLANTILLAS_RUTAS.update({id(route): prefix + route.path for route in router.routes})
 
 
 @app.get("/", summary="Endpoint de Bienvenida", response_description="Mensaje de bienvenida")
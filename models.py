@@ -1,10 +1,131 @@
-from google.cloud.firestore import GeoPoint
+import asyncio
+import base64
+import json
+
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud.firestore import DELETE_FIELD, GeoPoint
+from google.cloud.firestore_v1.field_path import FieldPath
 from pydantic import BaseModel
-from services.firebase import db, prefix
-from typing import Optional, List
+from services.firebase import db, async_db, prefix
+from services.metrics import firestore_timed
+from services.mirror import mirror
+from typing import Callable, ClassVar, Optional, List, Dict, Tuple
 from datetime import datetime
 
 
+class UnitOfWork:
+    """
+    Agrupa varias escrituras en un solo batch de Firestore, que se confirma de una vez
+    (una sola ida y vuelta) al salir del bloque `with` o al llamar a `commit()`.
+
+    Las escrituras con `update()` fallan si el documento no existe, asi que sirven de
+    precondicion de existencia: si alguna falla no se aplica ninguna y se lanza
+    ValueError con el mensaje indicado en `not_found`.
+    """
+
+    def __init__(self):
+        self.batch = db.batch()
+        self._not_found: Optional[str] = None
+        self._after_commit: List[Callable[[], None]] = []
+
+    def set(self, ref, data: dict, merge: bool = False):
+        self.batch.set(ref, data, merge=merge)
+
+    def update(self, ref, fields: dict, not_found: Optional[str] = None):
+        self.batch.update(ref, fields)
+        if not_found and self._not_found is None:
+            self._not_found = not_found
+
+    def delete(self, ref):
+        self.batch.delete(ref)
+
+    def after_commit(self, callback: Callable[[], None]):
+        # Acciones locales (p. ej. actualizar el espejo) que solo deben correr si se confirma
+        self._after_commit.append(callback)
+
+    @firestore_timed('batch.commit')
+    def commit(self):
+        try:
+            self.batch.commit()
+        except NotFound as e:
+            raise ValueError(self._not_found or str(e))
+        for callback in self._after_commit:
+            callback()
+        self._after_commit = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        return False
+
+
+class AsyncUnitOfWork(UnitOfWork):
+    """UnitOfWork sobre el cliente asincrono; se usa con `async with`."""
+
+    def __init__(self):
+        super().__init__()
+        self.batch = async_db.batch()
+
+    @firestore_timed('batch.commit_async')
+    async def commit(self):
+        try:
+            await self.batch.commit()
+        except NotFound as e:
+            raise ValueError(self._not_found or str(e))
+        for callback in self._after_commit:
+            callback()
+        self._after_commit = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        return False
+
+
+# Limite de escrituras de Firestore por batch
+MAX_ESCRITURAS_BATCH = 500
+
+
+def _encode_cursor(*valores) -> str:
+    # page_token opaco con los valores de orden del ultimo documento devuelto
+    return base64.urlsafe_b64encode(json.dumps(valores).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(page_token: str, cantidad: int) -> list:
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError("page_token invalido")
+    if not isinstance(valores, list) or len(valores) != cantidad:
+        raise ValueError("page_token invalido")
+    return valores
+
+
+def _mirror_user(usuario_id, wait: bool = True):
+    # Copia en memoria del usuario y sus parcelas; None si el espejo no esta disponible.
+    # Con wait=False (rutas async) no se espera a que el listener cargue
+    entry = mirror.user(usuario_id, wait=wait) if mirror else None
+    if entry is not None and entry.doc is None:
+        raise ValueError("Usuario no existe")
+    return entry
+
+
+def _borrar_datos_locales(usuario_id: str, parcela_id: str, analisis_id: Optional[str] = None):
+    # Imagenes en disco y filas de las series del analisis o de toda la parcela.
+    # Importes diferidos: services.lifecycle y services.series importan este modulo
+    from services import lifecycle
+    from services.series import series_store
+    lifecycle.borrar_imagenes(usuario_id, parcela_id, analisis_id)
+    if series_store:
+        series_store.quitar(usuario_id, parcela_id, analisis_id)
+
+
 class User(BaseModel):
     username: str
     password: str
@@ -22,12 +143,20 @@ class User(BaseModel):
             "password": self.password
         }
 
+    @firestore_timed('user.create_user')
     def create_user(self):
         user_ref = db.collection(f'{prefix}users').document(self.username)
         user_ref.set(self.to_dict())
+        if mirror:
+            mirror.user_saved(self.username, self.to_dict())
 
     @staticmethod
+    @firestore_timed('user.get_user_by_username')
     def get_user_by_username(username):
+        entry = mirror.user(username) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                return dict(entry.doc) if entry.doc is not None else None
         user_ref = db.collection(f'{prefix}users').document(username)
         user = user_ref.get()
         if user.exists:
@@ -35,9 +164,38 @@ class User(BaseModel):
         return None
 
     @staticmethod
+    @firestore_timed('user.delete')
     def delete(user_id):
         user_ref = db.collection(f'{prefix}users').document(user_id)
         user_ref.delete()
+        if mirror:
+            mirror.user_saved(user_id, None)
+
+    @firestore_timed('user.create_user_async')
+    async def create_user_async(self):
+        user_ref = async_db.collection(f'{prefix}users').document(self.username)
+        await user_ref.set(self.to_dict())
+        if mirror:
+            mirror.user_saved(self.username, self.to_dict())
+
+    @staticmethod
+    @firestore_timed('user.get_user_by_username_async')
+    async def get_user_by_username_async(username):
+        entry = mirror.user(username, wait=False) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                return dict(entry.doc) if entry.doc is not None else None
+        user = await async_db.collection(f'{prefix}users').document(username).get()
+        if user.exists:
+            return user.to_dict()
+        return None
+
+    @staticmethod
+    @firestore_timed('user.delete_async')
+    async def delete_async(user_id):
+        await async_db.collection(f'{prefix}users').document(user_id).delete()
+        if mirror:
+            mirror.user_saved(user_id, None)
 
 
 class Punto(BaseModel):
@@ -66,6 +224,19 @@ class ImagenSatelital(BaseModel):
     tipo: str
     ruta: str
 
+
+class IndiceEspectral(BaseModel):
+    ruta: str
+    media: float
+    desviacion: float
+    minimo: float
+    maximo: float
+    percentiles: Dict[str, float]
+    histograma: List[int]
+    rango_histograma: List[float]
+    fraccion_enmascarada: float
+
+
 class Parcela(BaseModel):
     id: Optional[str]
     nombre: str
@@ -100,18 +271,30 @@ class Parcela(BaseModel):
             "proximo_monitoreo": self.proximo_monitoreo.isoformat() if self.proximo_monitoreo else None
         }
 
+    @firestore_timed('parcela.save')
     def save(self):
         # Verificar si el usuario existe
         user_ref = db.document(f'{prefix}users/{self.usuario_id}')
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-            raise ValueError("Usuario no existe")
+        if _mirror_user(self.usuario_id) is None:
+            user_doc = user_ref.get()
+            if not user_doc.exists:
+                raise ValueError("Usuario no existe")
 
+        # merge conserva los campos que mantienen los analisis (ultimo_analisis, actualizado)
         parcela_ref = user_ref.collection('parcelas').document(self.id)
-        parcela_ref.set(self.to_dict())
+        parcela_ref.set(self.to_dict(), merge=True)
+        if mirror:
+            mirror.parcela_saved(self.usuario_id, self.id, self.to_dict(), merge=True)
 
     @staticmethod
+    @firestore_timed('parcela.get_by_id')
     def get_by_id(usuario_id, parcela_id):
+        entry = _mirror_user(usuario_id)
+        if entry is not None:
+            with entry.lock:
+                source = entry.docs.get(parcela_id)
+            return Parcela.from_dict(source) if source is not None else None
+
         user_ref = db.document(f'{prefix}users/{usuario_id}')
         user_doc = user_ref.get()
         if not user_doc.exists:
@@ -124,7 +307,17 @@ class Parcela(BaseModel):
         return None
 
     @staticmethod
+    @firestore_timed('parcela.get_by_name')
     def get_by_name(usuario_id, nombre):
+        entry = _mirror_user(usuario_id)
+        if entry is not None:
+            with entry.lock:
+                sources = [entry.docs[parcela_id] for parcela_id in sorted(entry.docs)]
+            for source in sources:
+                if source.get('nombre') == nombre:
+                    return Parcela.from_dict(source)
+            return None
+
         user_ref = db.document(f'{prefix}users/{usuario_id}')
         user_doc = user_ref.get()
         if not user_doc.exists:
@@ -136,7 +329,14 @@ class Parcela(BaseModel):
         return None
 
     @staticmethod
+    @firestore_timed('parcela.get_all')
     def get_all(usuario_id):
+        entry = _mirror_user(usuario_id)
+        if entry is not None:
+            with entry.lock:
+                sources = [entry.docs[parcela_id] for parcela_id in sorted(entry.docs)]
+            return [Parcela.from_dict(source) for source in sources]
+
         user_ref = db.document(f'{prefix}users/{usuario_id}')
         user_doc = user_ref.get()
         if not user_doc.exists:
@@ -149,14 +349,218 @@ class Parcela(BaseModel):
         return parcelas
 
     @staticmethod
+    @firestore_timed('parcela.delete')
     def delete(usuario_id, parcela_id):
-        user_ref = db.document(f'{prefix}users/{usuario_id}')
-        user_doc = user_ref.get()
+        if _mirror_user(usuario_id) is None:
+            user_ref = db.document(f'{prefix}users/{usuario_id}')
+            user_doc = user_ref.get()
+            if not user_doc.exists:
+                raise ValueError("Usuario no existe")
+
+        parcela_ref = db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}')
+        parcela_ref.delete()
+        if mirror:
+            mirror.parcela_saved(usuario_id, parcela_id, None)
+        _borrar_datos_locales(usuario_id, parcela_id)
+
+    @firestore_timed('parcela.save_async')
+    async def save_async(self):
+        user_ref = async_db.document(f'{prefix}users/{self.usuario_id}')
+        if _mirror_user(self.usuario_id, wait=False) is None:
+            user_doc = await user_ref.get()
+            if not user_doc.exists:
+                raise ValueError("Usuario no existe")
+
+        await user_ref.collection('parcelas').document(self.id).set(self.to_dict(), merge=True)
+        if mirror:
+            mirror.parcela_saved(self.usuario_id, self.id, self.to_dict(), merge=True)
+
+    @staticmethod
+    @firestore_timed('parcela.get_by_id_async')
+    async def get_by_id_async(usuario_id, parcela_id):
+        entry = _mirror_user(usuario_id, wait=False)
+        if entry is not None:
+            with entry.lock:
+                source = entry.docs.get(parcela_id)
+            return Parcela.from_dict(source) if source is not None else None
+
+        user_doc = await async_db.document(f'{prefix}users/{usuario_id}').get()
+        if not user_doc.exists:
+            raise ValueError("Usuario no existe")
+
+        parcela_doc = await async_db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}').get()
+        if parcela_doc.exists:
+            return Parcela.from_dict(parcela_doc.to_dict())
+        return None
+
+    @staticmethod
+    @firestore_timed('parcela.get_by_name_async')
+    async def get_by_name_async(usuario_id, nombre):
+        entry = _mirror_user(usuario_id, wait=False)
+        if entry is not None:
+            with entry.lock:
+                sources = [entry.docs[parcela_id] for parcela_id in sorted(entry.docs)]
+            for source in sources:
+                if source.get('nombre') == nombre:
+                    return Parcela.from_dict(source)
+            return None
+
+        user_ref = async_db.document(f'{prefix}users/{usuario_id}')
+        user_doc = await user_ref.get()
+        if not user_doc.exists:
+            raise ValueError("Usuario no existe")
+
+        async for parcela in user_ref.collection('parcelas').where('nombre', '==', nombre).stream():
+            return Parcela.from_dict(parcela.to_dict())
+        return None
+
+    @staticmethod
+    @firestore_timed('parcela.get_all_async')
+    async def get_all_async(usuario_id):
+        return [Parcela.from_dict(source) for source in await Parcela._sources_async(usuario_id)]
+
+    @staticmethod
+    async def _sources_async(usuario_id) -> List[dict]:
+        # Documentos crudos de las parcelas, incluidos los campos que mantienen los analisis
+        entry = _mirror_user(usuario_id, wait=False)
+        if entry is not None:
+            with entry.lock:
+                return [entry.docs[parcela_id] for parcela_id in sorted(entry.docs)]
+
+        user_ref = async_db.document(f'{prefix}users/{usuario_id}')
+        user_doc = await user_ref.get()
         if not user_doc.exists:
             raise ValueError("Usuario no existe")
 
+        return [parcela.to_dict() async for parcela in user_ref.collection('parcelas').stream()]
+
+    @staticmethod
+    @firestore_timed('parcela.get_many_async')
+    async def get_many_async(usuario_id, parcela_ids: List[str]) -> List['Parcela']:
+        # Varias parcelas por id en una sola lectura multiple; las inexistentes se omiten
+        parcela_ids = list(dict.fromkeys(parcela_ids))
+        entry = _mirror_user(usuario_id, wait=False)
+        if entry is not None:
+            with entry.lock:
+                sources = [entry.docs[parcela_id] for parcela_id in parcela_ids if parcela_id in entry.docs]
+            return [Parcela.from_dict(source) for source in sources]
+
+        # El documento del usuario va en la misma lectura para verificar que existe
+        user_path = f'{prefix}users/{usuario_id}'
+        refs = [async_db.document(user_path)] + [async_db.document(f'{user_path}/parcelas/{parcela_id}')
+                                                 for parcela_id in parcela_ids]
+        encontrados = {}
+        user_existe = False
+        async for snapshot in async_db.get_all(refs):
+            if snapshot.reference.path == user_path:
+                user_existe = snapshot.exists
+            elif snapshot.exists:
+                encontrados[snapshot.id] = snapshot.to_dict()
+        if not user_existe:
+            raise ValueError("Usuario no existe")
+        return [Parcela.from_dict(encontrados[parcela_id]) for parcela_id in parcela_ids if parcela_id in encontrados]
+
+    @staticmethod
+    @firestore_timed('parcela.save_many_async')
+    async def save_many_async(usuario_id, parcelas: List['Parcela']):
+        """
+        Crea o actualiza varias parcelas de un usuario en batches de hasta
+        MAX_ESCRITURAS_BATCH escrituras, confirmados en paralelo. Cada batch es atomico,
+        el conjunto no.
+        """
+        user_ref = async_db.document(f'{prefix}users/{usuario_id}')
+        if _mirror_user(usuario_id, wait=False) is None:
+            user_doc = await user_ref.get()
+            if not user_doc.exists:
+                raise ValueError("Usuario no existe")
+
+        batches = []
+        for inicio in range(0, len(parcelas), MAX_ESCRITURAS_BATCH):
+            uow = AsyncUnitOfWork()
+            for parcela in parcelas[inicio:inicio + MAX_ESCRITURAS_BATCH]:
+                data = parcela.to_dict()
+                uow.set(user_ref.collection('parcelas').document(parcela.id), data, merge=True)
+                if mirror:
+                    uow.after_commit(lambda parcela_id=parcela.id, data=data:
+                                     mirror.parcela_saved(usuario_id, parcela_id, data, merge=True))
+            batches.append(uow.commit())
+        await asyncio.gather(*batches)
+
+    @staticmethod
+    @firestore_timed('parcela.list_async')
+    async def list_async(usuario_id, limit: int, page_token: Optional[str] = None) -> Tuple[List['Parcela'], Optional[str]]:
+        # Pagina de parcelas ordenadas por id; devuelve tambien el page_token de la siguiente
+        despues = _decode_cursor(page_token, 1)[0] if page_token else None
+        entry = _mirror_user(usuario_id, wait=False)
+        if entry is not None:
+            with entry.lock:
+                ids = sorted(parcela_id for parcela_id in entry.docs if despues is None or parcela_id > despues)
+                sources = [entry.docs[parcela_id] for parcela_id in ids[:limit + 1]]
+        else:
+            user_ref = async_db.document(f'{prefix}users/{usuario_id}')
+            user_doc = await user_ref.get()
+            if not user_doc.exists:
+                raise ValueError("Usuario no existe")
+            query = user_ref.collection('parcelas').order_by('id')
+            if despues is not None:
+                query = query.start_after({'id': despues})
+            sources = [parcela.to_dict() async for parcela in query.limit(limit + 1).stream()]
+
+        # Se pide un documento de mas para saber si hay otra pagina
+        parcelas = [Parcela.from_dict(source) for source in sources[:limit]]
+        next_token = _encode_cursor(parcelas[-1].id) if len(sources) > limit else None
+        return parcelas, next_token
+
+    @staticmethod
+    @firestore_timed('parcela.delete_async')
+    async def delete_async(usuario_id, parcela_id):
+        if _mirror_user(usuario_id, wait=False) is None:
+            user_doc = await async_db.document(f'{prefix}users/{usuario_id}').get()
+            if not user_doc.exists:
+                raise ValueError("Usuario no existe")
+
+        await async_db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}').delete()
+        if mirror:
+            mirror.parcela_saved(usuario_id, parcela_id, None)
+        await asyncio.to_thread(_borrar_datos_locales, usuario_id, parcela_id)
+
+    @staticmethod
+    @firestore_timed('parcela.get_due')
+    def get_due(hasta: datetime, limit: int) -> List[Tuple['Parcela', datetime]]:
+        # Consulta sobre el grupo de colecciones 'parcelas' (requiere el indice de campo
+        # proximo_monitoreo con alcance de grupo de colecciones), sin recorrer los usuarios.
+        # Devuelve cada parcela junto a la hora de su ultima escritura.
+        query = (db.collection_group('parcelas')
+                 .where('proximo_monitoreo', '<=', hasta.isoformat())
+                 .order_by('proximo_monitoreo')
+                 .limit(limit))
+        parcelas = []
+        ultima = None
+        # El grupo de colecciones incluye las parcelas de otros prefijos, que se descartan
+        # aqui: se sigue paginando hasta juntar `limit` del prefijo o agotar la consulta
+        while len(parcelas) < limit:
+            pagina = list((query.start_after(ultima) if ultima is not None else query).stream())
+            for parcela in pagina:
+                if parcela.reference.path.startswith(f'{prefix}users/') and len(parcelas) < limit:
+                    parcelas.append((Parcela.from_dict(parcela.to_dict()), parcela.update_time))
+            if len(pagina) < limit:
+                break
+            ultima = pagina[-1]
+        return parcelas
+
+    @staticmethod
+    @firestore_timed('parcela.update_proximo_monitoreo')
+    def update_proximo_monitoreo(usuario_id, parcela_id, proximo_monitoreo: datetime,
+                                 last_update_time: Optional[datetime] = None) -> bool:
+        # Si se indica last_update_time, solo se actualiza si nadie modifico la parcela
+        # desde esa lectura; devuelve False en ese caso
         parcela_ref = db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}')
-        parcela_ref.delete()
+        option = db.write_option(last_update_time=last_update_time) if last_update_time else None
+        try:
+            parcela_ref.update({'proximo_monitoreo': proximo_monitoreo.isoformat()}, option=option)
+        except FailedPrecondition:
+            return False
+        return True
 
 
 class Analisis(BaseModel):
@@ -165,40 +569,111 @@ class Analisis(BaseModel):
     tipo: str
     evaluacion: Optional[str] = None
     id: Optional[str] = None
+    indices: Optional[Dict[str, IndiceEspectral]] = None
+    # Dia de la escena de Sentinel-2 mas reciente usada por el mosaico
+    fecha_adquisicion: Optional[datetime] = None
 
     @staticmethod
     def from_dict(source):
         imagenes = [ImagenSatelital(**imagen) for imagen in source.get('imagenes', [])]
+        indices = source.get('indices')
+        if indices:
+            indices = {nombre: IndiceEspectral(**indice) for nombre, indice in indices.items()}
         return Analisis(
             fecha=datetime.fromisoformat(source.get('fecha')),
             imagenes=imagenes,
             tipo=source.get('tipo'),
             evaluacion=source.get('evaluacion'),
-            id=source.get('id')
+            id=source.get('id'),
+            indices=indices,
+            fecha_adquisicion=datetime.fromisoformat(source.get('fecha_adquisicion')) if source.get('fecha_adquisicion') else None
         )
 
+    def proyectar(self, campos: Optional[List[str]]) -> 'Analisis':
+        # Con `campos` solo esos quedan como asignados: model_dump(exclude_unset=True) omite
+        # el resto en lugar de devolver sus valores por defecto
+        if campos is None:
+            return self
+        return Analisis.model_construct(_fields_set={campo for campo in campos if campo in Analisis.model_fields},
+                                        **dict(self))
+
     def to_dict(self):
         return {
             "fecha": self.fecha.isoformat(),
             "imagenes": [imagen.dict() for imagen in self.imagenes],
             "tipo": self.tipo,
             "evaluacion": self.evaluacion,
-            "id": self.id
+            "id": self.id,
+            "indices": {nombre: indice.dict() for nombre, indice in self.indices.items()} if self.indices else None,
+            "fecha_adquisicion": self.fecha_adquisicion.isoformat() if self.fecha_adquisicion else None
         }
 
-    def save(self, usuario_id: str, parcela_id: str):
-        if not self.fecha:
+    def save(self, usuario_id: str, parcela_id: str, uow: Optional[UnitOfWork] = None):
+        # Sin uow se confirma en el acto; con uow se confirma junto al resto del batch
+        if uow is None:
+            with UnitOfWork() as uow:
+                return self.save(usuario_id, parcela_id, uow)
+
+        self._agregar_escrituras(db, usuario_id, parcela_id, uow)
+
+    async def save_async(self, usuario_id: str, parcela_id: str, uow: Optional[AsyncUnitOfWork] = None):
+        if uow is None:
+            async with AsyncUnitOfWork() as uow:
+                return await self.save_async(usuario_id, parcela_id, uow)
+        self._agregar_escrituras(async_db, usuario_id, parcela_id, uow)
+
+    def _agregar_escrituras(self, client, usuario_id: str, parcela_id: str, uow: UnitOfWork):
+        nuevo = not self.fecha
+        if nuevo:
             self.fecha = datetime.now()
         if not self.id:
             self.id = f"{self.fecha.strftime('%Y%m%d%H%M%S')}_{self.tipo}"
-        parcela_ref = db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}')
-        if not parcela_ref.get().exists:
-            raise ValueError("Parcela no existe")
-        analisis_ref = parcela_ref.collection('analisis').document(self.id)
-        analisis_ref.set(self.to_dict())
+        # La actualizacion de la parcela hace de precondicion: si no existe falla el batch
+        # entero, sin leerla antes
+        parcela_ref = client.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}')
+        cambios = {'actualizado': datetime.now().isoformat()}
+        if nuevo:
+            # FieldPath escapa los tipos que no son identificadores simples
+            cambios[FieldPath('ultimo_analisis', self.tipo).to_api_repr()] = self.id
+        uow.update(parcela_ref, cambios, not_found="Parcela no existe")
+        data = self.to_dict()
+        uow.set(parcela_ref.collection('analisis').document(self.id), data)
+        if mirror:
+            uow.after_commit(lambda: mirror.analisis_saved(usuario_id, parcela_id, self.id, data))
 
     @staticmethod
+    def update_fields(usuario_id: str, parcela_id: str, analisis_id: str, fields: dict,
+                      uow: Optional[UnitOfWork] = None):
+        # Escritura parcial (mascara de campos) en lugar de reescribir el documento completo
+        if uow is None:
+            with UnitOfWork() as uow:
+                return Analisis.update_fields(usuario_id, parcela_id, analisis_id, fields, uow)
+
+        analisis_ref = db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis/{analisis_id}')
+        uow.update(analisis_ref, fields, not_found="Analisis no existe")
+        if mirror:
+            uow.after_commit(lambda: mirror.analisis_saved(usuario_id, parcela_id, analisis_id, fields, merge=True))
+
+    @staticmethod
+    async def update_fields_async(usuario_id: str, parcela_id: str, analisis_id: str, fields: dict,
+                                  uow: Optional[AsyncUnitOfWork] = None):
+        if uow is None:
+            async with AsyncUnitOfWork() as uow:
+                return await Analisis.update_fields_async(usuario_id, parcela_id, analisis_id, fields, uow)
+
+        analisis_ref = async_db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis/{analisis_id}')
+        uow.update(analisis_ref, fields, not_found="Analisis no existe")
+        if mirror:
+            uow.after_commit(lambda: mirror.analisis_saved(usuario_id, parcela_id, analisis_id, fields, merge=True))
+
+    @staticmethod
+    @firestore_timed('analisis.get_by_id')
     def get_by_id(usuario_id: str, parcela_id: str, analisis_id: str):
+        entry = mirror.analisis(usuario_id, parcela_id) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                source = entry.docs.get(analisis_id)
+            return Analisis.from_dict(source) if source is not None else None
         analisis_ref = db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis/{analisis_id}')
         analisis_doc = analisis_ref.get()
         if analisis_doc.exists:
@@ -206,7 +681,13 @@ class Analisis(BaseModel):
         return None
 
     @staticmethod
+    @firestore_timed('analisis.get_all')
     def get_all(usuario_id: str, parcela_id: str):
+        entry = mirror.analisis(usuario_id, parcela_id) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                sources = [entry.docs[analisis_id] for analisis_id in sorted(entry.docs)]
+            return [Analisis.from_dict(source) for source in sources]
         analisis_ref = db.collection(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis').stream()
         analisis_list = []
         for analisis in analisis_ref:
@@ -214,13 +695,216 @@ class Analisis(BaseModel):
         return analisis_list
 
     @staticmethod
+    @firestore_timed('analisis.delete')
     def delete(usuario_id: str, parcela_id: str, analisis_id: str):
         analisis_ref = db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis/{analisis_id}')
         analisis_ref.delete()
+        if mirror:
+            mirror.analisis_saved(usuario_id, parcela_id, analisis_id, None)
+        # Si `ultimo_analisis` apuntaba al borrado pasa al anterior del mismo tipo, o se
+        # quita si no queda ninguno. Solo se escribe si la parcela no cambio desde la
+        # lectura; si cambio, get_ultimos_async cubre el puntero que quede huerfano
+        parcela_ref = db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}')
+        parcela_doc = parcela_ref.get()
+        if parcela_doc.exists:
+            cambios = {}
+            for tipo in Analisis._tipos_apuntados(parcela_doc.to_dict(), analisis_id):
+                anterior = Analisis.get_last_analisis_by_tipo(usuario_id, parcela_id, tipo)
+                cambios[FieldPath('ultimo_analisis', tipo).to_api_repr()] = anterior.id if anterior else DELETE_FIELD
+            if cambios:
+                try:
+                    parcela_ref.update(cambios, option=db.write_option(last_update_time=parcela_doc.update_time))
+                except FailedPrecondition:
+                    pass
+        _borrar_datos_locales(usuario_id, parcela_id, analisis_id)
+
+    @staticmethod
+    def _tipos_apuntados(parcela: dict, analisis_id: str) -> List[str]:
+        # Tipos cuyo `ultimo_analisis` apunta al analisis indicado
+        ultimos = parcela.get('ultimo_analisis') or {}
+        return [tipo for tipo, ultimo_id in ultimos.items() if ultimo_id == analisis_id]
 
     @staticmethod
+    @firestore_timed('analisis.get_last_analisis_by_tipo')
     def get_last_analisis_by_tipo(usuario_id: str, parcela_id: str, tipo: str):
+        entry = mirror.analisis(usuario_id, parcela_id) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                sources = [source for source in entry.docs.values() if source.get('tipo') == tipo]
+            if not sources:
+                return None
+            return Analisis.from_dict(max(sources, key=lambda source: source.get('fecha')))
         analisis_ref = db.collection(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis').where('tipo', '==', tipo).order_by('fecha', direction='DESCENDING').limit(1).stream()
         for analisis in analisis_ref:
             return Analisis.from_dict(analisis.to_dict())
         return None
+
+    @staticmethod
+    @firestore_timed('analisis.get_by_id_async')
+    async def get_by_id_async(usuario_id: str, parcela_id: str, analisis_id: str):
+        entry = mirror.analisis(usuario_id, parcela_id, wait=False) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                source = entry.docs.get(analisis_id)
+            return Analisis.from_dict(source) if source is not None else None
+        analisis_ref = async_db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis/{analisis_id}')
+        analisis_doc = await analisis_ref.get()
+        if analisis_doc.exists:
+            return Analisis.from_dict(analisis_doc.to_dict())
+        return None
+
+    @staticmethod
+    @firestore_timed('analisis.get_all_async')
+    async def get_all_async(usuario_id: str, parcela_id: str):
+        entry = mirror.analisis(usuario_id, parcela_id, wait=False) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                sources = [entry.docs[analisis_id] for analisis_id in sorted(entry.docs)]
+            return [Analisis.from_dict(source) for source in sources]
+        analisis_ref = async_db.collection(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis').stream()
+        return [Analisis.from_dict(analisis.to_dict()) async for analisis in analisis_ref]
+
+    @staticmethod
+    @firestore_timed('analisis.delete_async')
+    async def delete_async(usuario_id: str, parcela_id: str, analisis_id: str):
+        analisis_ref = async_db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis/{analisis_id}')
+        await analisis_ref.delete()
+        if mirror:
+            mirror.analisis_saved(usuario_id, parcela_id, analisis_id, None)
+        # Igual que delete(): repuntar o quitar `ultimo_analisis` si nombraba al borrado
+        parcela_ref = async_db.document(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}')
+        parcela_doc = await parcela_ref.get()
+        if parcela_doc.exists:
+            tipos = Analisis._tipos_apuntados(parcela_doc.to_dict(), analisis_id)
+            anteriores = await asyncio.gather(*(Analisis.get_last_analisis_by_tipo_async(usuario_id, parcela_id, tipo)
+                                                for tipo in tipos))
+            cambios = {FieldPath('ultimo_analisis', tipo).to_api_repr(): anterior.id if anterior else DELETE_FIELD
+                       for tipo, anterior in zip(tipos, anteriores)}
+            if cambios:
+                try:
+                    await parcela_ref.update(cambios,
+                                             option=async_db.write_option(last_update_time=parcela_doc.update_time))
+                except FailedPrecondition:
+                    pass
+        await asyncio.to_thread(_borrar_datos_locales, usuario_id, parcela_id, analisis_id)
+
+    @staticmethod
+    @firestore_timed('analisis.get_last_analisis_by_tipo_async')
+    async def get_last_analisis_by_tipo_async(usuario_id: str, parcela_id: str, tipo: str):
+        entry = mirror.analisis(usuario_id, parcela_id, wait=False) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                sources = [source for source in entry.docs.values() if source.get('tipo') == tipo]
+            if not sources:
+                return None
+            return Analisis.from_dict(max(sources, key=lambda source: source.get('fecha')))
+        analisis_ref = async_db.collection(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis').where('tipo', '==', tipo).order_by('fecha', direction='DESCENDING').limit(1).stream()
+        async for analisis in analisis_ref:
+            return Analisis.from_dict(analisis.to_dict())
+        return None
+
+    # Campos que siempre se leen en los listados: los usa el orden y el cursor
+    CAMPOS_LISTADO: ClassVar[Tuple[str, ...]] = ('id', 'fecha', 'tipo')
+
+    @staticmethod
+    @firestore_timed('analisis.list_async')
+    async def list_async(usuario_id: str, parcela_id: str, limit: Optional[int] = None,
+                         page_token: Optional[str] = None, tipo: Optional[str] = None,
+                         desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                         campos: Optional[List[str]] = None) -> Tuple[List['Analisis'], Optional[str]]:
+        """
+        Analisis de una parcela del mas reciente al mas antiguo, filtrados por tipo y
+        rango de fechas. Con `limit` se pagina por cursor (fecha, id) y se devuelve el
+        page_token de la siguiente pagina; con `campos` solo se leen esos campos (p. ej.
+        para omitir `evaluacion` en los listados).
+        """
+        cursor = _decode_cursor(page_token, 2) if page_token else None
+        if campos is not None:
+            campos = list(dict.fromkeys(list(Analisis.CAMPOS_LISTADO) + campos))
+
+        entry = mirror.analisis(usuario_id, parcela_id, wait=False) if mirror else None
+        if entry is not None:
+            with entry.lock:
+                sources = list(entry.docs.values())
+            sources = [source for source in sources
+                       if (tipo is None or source.get('tipo') == tipo)
+                       and (desde is None or source.get('fecha') >= desde.isoformat())
+                       and (hasta is None or source.get('fecha') <= hasta.isoformat())]
+            sources.sort(key=lambda source: (source.get('fecha'), source.get('id')), reverse=True)
+            if cursor is not None:
+                sources = [source for source in sources if (source.get('fecha'), source.get('id')) < tuple(cursor)]
+            if limit is not None:
+                sources = sources[:limit + 1]
+            if campos is not None:
+                sources = [{campo: source.get(campo) for campo in campos if campo in source} for source in sources]
+        else:
+            # Filtros y orden resueltos por Firestore; tipo + fecha requiere indice compuesto
+            query = async_db.collection(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis')
+            if tipo is not None:
+                query = query.where('tipo', '==', tipo)
+            if desde is not None:
+                query = query.where('fecha', '>=', desde.isoformat())
+            if hasta is not None:
+                query = query.where('fecha', '<=', hasta.isoformat())
+            # El desempate por id de documento (igual al campo id) lo cubre el indice simple
+            # de fecha; ordenar por el campo id pediria un indice compuesto
+            query = (query.order_by('fecha', direction='DESCENDING')
+                     .order_by(FieldPath.document_id(), direction='DESCENDING'))
+            if cursor is not None:
+                query = query.start_after({'fecha': cursor[0], FieldPath.document_id(): cursor[1]})
+            if campos is not None:
+                query = query.select(campos)
+            if limit is not None:
+                query = query.limit(limit + 1)
+            sources = [analisis.to_dict() async for analisis in query.stream()]
+
+        analisis_list = [Analisis.from_dict(source).proyectar(campos) for source in sources[:limit]]
+        next_token = None
+        if limit is not None and len(sources) > limit:
+            ultimo = sources[limit - 1]
+            next_token = _encode_cursor(ultimo.get('fecha'), ultimo.get('id'))
+        return analisis_list, next_token
+
+    @staticmethod
+    @firestore_timed('analisis.get_ultimos_async')
+    async def get_ultimos_async(usuario_id: str, campos: Optional[List[str]] = None) -> Dict[str, Dict[str, 'Analisis']]:
+        """
+        Ultimo analisis de cada tipo monitoreado de cada parcela del usuario.
+
+        Los ids salen del mapa `ultimo_analisis` de cada parcela y se leen todos en una
+        sola lectura multiple; los tipos que no figuran en el mapa (analisis anteriores a
+        el) o cuyo analisis ya no existe se consultan uno por uno, en paralelo.
+        """
+        if campos is not None:
+            campos = list(dict.fromkeys(list(Analisis.CAMPOS_LISTADO) + campos))
+        parcelas = await Parcela._sources_async(usuario_id)
+
+        apuntados = {}
+        pendientes = []
+        for parcela in parcelas:
+            ultimos = parcela.get('ultimo_analisis') or {}
+            tipos = list(dict.fromkeys((parcela.get('tipo_monitoreo') or []) + list(ultimos)))
+            for tipo in tipos:
+                if tipo in ultimos:
+                    ref = async_db.document(
+                        f"{prefix}users/{usuario_id}/parcelas/{parcela['id']}/analisis/{ultimos[tipo]}")
+                    apuntados[ref.path] = (ref, parcela['id'], tipo)
+                else:
+                    pendientes.append((parcela['id'], tipo))
+
+        resultado: Dict[str, Dict[str, Analisis]] = {parcela['id']: {} for parcela in parcelas}
+        if apuntados:
+            async for snapshot in async_db.get_all([ref for ref, _, _ in apuntados.values()], field_paths=campos):
+                _, parcela_id, tipo = apuntados[snapshot.reference.path]
+                if snapshot.exists:
+                    resultado[parcela_id][tipo] = Analisis.from_dict(snapshot.to_dict()).proyectar(campos)
+                else:
+                    # Puntero a un analisis borrado: se busca el ultimo de ese tipo
+                    pendientes.append((parcela_id, tipo))
+
+        ultimos = await asyncio.gather(*(Analisis.get_last_analisis_by_tipo_async(usuario_id, parcela_id, tipo)
+                                         for parcela_id, tipo in pendientes))
+        for (parcela_id, tipo), analisis in zip(pendientes, ultimos):
+            if analisis:
+                resultado[parcela_id][tipo] = analisis.proyectar(campos)
+        return resultado
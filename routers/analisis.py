@@ -1,31 +1,120 @@
+import asyncio
+import json
+import logging
 import os
+from datetime import datetime
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Query, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from models import Analisis, Parcela
-from schemas import AnalisisCreate, AnalisisResponse, ImagenSatelital
-from typing import List
-from services import sentinelhub, openai
+from schemas import AnalisisCreate, AnalisisResponse, ImagenSatelital, JobResponse, TendenciaResponse
+from typing import Dict, List, Optional
+from services import sentinelhub, openai, pipeline
+from services.series import series_store
+from services.jobs import job_queue
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Comentario periodico en los streams SSE para que los proxies no corten la conexion
+SSE_PING_SECONDS = float(os.getenv('SSE_PING_SECONDS', '15'))
 
 
 @router.post("/{usuario_id}/{parcela_id}/create", response_model=AnalisisResponse, summary="Crear un nuevo analisis",
              description="Crear un nuevo analisis para una parcela especifica")
-def create_analisis(usuario_id: str, parcela_id: str, analisis: AnalisisCreate):
+async def create_analisis(usuario_id: str, parcela_id: str, analisis: AnalisisCreate):
     try:
         new_analisis = Analisis(**analisis.dict())
-        new_analisis.save(usuario_id, parcela_id)
+        await new_analisis.save_async(usuario_id, parcela_id)
         return new_analisis
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
+@router.post("/jobs/{usuario_id}/{parcela_id}/{tipo}", response_model=JobResponse,
+             status_code=status.HTTP_202_ACCEPTED, summary="Encolar la ejecucion de un analisis",
+             description="Encola el analisis para una parcela especifica y devuelve el trabajo para consultar su estado")
+def encolar_analisis(usuario_id: str, parcela_id: str, tipo: str):
+    if tipo not in sentinelhub.TIPOS_ANALISIS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Tipo de análisis no válido: {tipo}")
+    job = job_queue.enqueue(usuario_id, parcela_id, [tipo])
+    return JobResponse.from_job(job)
+
+
+@router.post("/jobs/{usuario_id}/{parcela_id}", response_model=JobResponse,
+             status_code=status.HTTP_202_ACCEPTED, summary="Encolar varios tipos de analisis",
+             description="Encola en un solo trabajo los tipos de analisis indicados (o los tipos de monitoreo de la "
+                         "parcela), que se descargan con una unica peticion a Sentinel Hub")
+def encolar_analisis_multiple(usuario_id: str, parcela_id: str, tipos: Optional[List[str]] = Query(None)):
+    try:
+        tipos = _resolver_tipos(usuario_id, parcela_id, tipos)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    job = job_queue.enqueue(usuario_id, parcela_id, tipos)
+    return JobResponse.from_job(job)
+
+
+@router.get("/jobs/{job_id}", response_model=JobResponse, summary="Obtener el estado de un trabajo",
+            description="Obtener la etapa actual y el resultado de un trabajo de analisis encolado")
+def read_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job:
+        return JobResponse.from_job(job)
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trabajo no encontrado")
+
+
+@router.get("/ultimos/{usuario_id}", response_model=Dict[str, Dict[str, AnalisisResponse]],
+            summary="Obtener el ultimo analisis de cada tipo de todas las parcelas de un usuario",
+            description="Devuelve, por parcela y por tipo de monitoreo, el ultimo analisis. Con `campos` solo se "
+                        "devuelven esos campos (ademas de id, fecha y tipo)")
+async def read_ultimos_analisis(usuario_id: str, campos: Optional[List[str]] = Query(None)):
+    try:
+        if campos:
+            invalidos = [campo for campo in campos if campo not in AnalisisResponse.model_fields]
+            if invalidos:
+                raise ValueError(f"Campos no válidos: {', '.join(invalidos)}")
+        ultimos = await Analisis.get_ultimos_async(usuario_id, campos=campos)
+        if campos:
+            return _proyeccion({parcela_id: {tipo: analisis.model_dump(exclude_unset=True)
+                                             for tipo, analisis in por_tipo.items()}
+                                for parcela_id, por_tipo in ultimos.items()})
+        return ultimos
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _proyeccion(contenido, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    # Con `campos` no se valida contra AnalisisResponse: los campos no pedidos se omiten en
+    # lugar de volver con su valor por defecto (imagenes: [], evaluacion: null)
+    return JSONResponse(jsonable_encoder(contenido), headers=headers)
+
+
+# Declarada antes de /{usuario_id}/{parcela_id}/{analisis_id}, que tambien coincide con esta ruta
+@router.get("/ejecutar_multiple/{usuario_id}/{parcela_id}", response_model=List[AnalisisResponse],
+            summary="Ejecutar varios tipos de analisis",
+            description="Ejecuta los tipos de analisis indicados (o los tipos de monitoreo de la parcela) con una "
+                        "unica descarga de imagenes y devuelve un analisis por tipo. Los tipos sin escenas nuevas "
+                        "se omiten; si ninguno tiene, devuelve los ultimos con la cabecera X-Sin-Datos-Nuevos")
+def ejecutar_analisis_multiple(usuario_id: str, parcela_id: str, response: Response,
+                               tipos: Optional[List[str]] = Query(None), forzar: bool = False):
+    try:
+        tipos = _resolver_tipos(usuario_id, parcela_id, tipos)
+        analisis_list = pipeline.ejecutar_analisis_multiple(usuario_id, parcela_id, tipos, forzar=forzar)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except pipeline.SinDatosNuevos as e:
+        return _sin_datos_nuevos(e, response)
+    return [AnalisisResponse(**analisis.to_dict()) for analisis in analisis_list]
+
+
 @router.get("/{usuario_id}/{parcela_id}/{analisis_id}", response_model=AnalisisResponse,
             summary="Obtener un analisis por ID",
             description="Obtener los detalles de un analisis especifico por su ID")
-def read_analisis(usuario_id: str, parcela_id: str, analisis_id: str):
+async def read_analisis(usuario_id: str, parcela_id: str, analisis_id: str):
     try:
-        analisis = Analisis.get_by_id(usuario_id, parcela_id, analisis_id)
+        analisis = await Analisis.get_by_id_async(usuario_id, parcela_id, analisis_id)
         if analisis:
             return analisis
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Analisis no encontrado")
@@ -35,10 +124,27 @@ def read_analisis(usuario_id: str, parcela_id: str, analisis_id: str):
 
 @router.get("/{usuario_id}/{parcela_id}/", response_model=List[AnalisisResponse],
             summary="Obtener todos los analisis de una parcela por ID",
-            description="Obtener los detalles de todos los analisis por ID de la parcela")
-def read_all_analisis(usuario_id: str, parcela_id: str):
+            description="Obtener los detalles de todos los analisis por ID de la parcela, del mas reciente al mas "
+                        "antiguo. Con `limit` se pagina: el token de la siguiente pagina llega en la cabecera "
+                        "X-Next-Page-Token. Con `campos` solo se devuelven esos campos (ademas de id, fecha y tipo)")
+async def read_all_analisis(usuario_id: str, parcela_id: str, response: Response,
+                            limit: Optional[int] = Query(None, ge=1, le=500),
+                            page_token: Optional[str] = None, tipo: Optional[str] = None,
+                            desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                            campos: Optional[List[str]] = Query(None)):
     try:
-        analisis_list = Analisis.get_all(usuario_id, parcela_id)
+        if campos:
+            invalidos = [campo for campo in campos if campo not in AnalisisResponse.model_fields]
+            if invalidos:
+                raise ValueError(f"Campos no válidos: {', '.join(invalidos)}")
+        analisis_list, next_token = await Analisis.list_async(usuario_id, parcela_id, limit=limit,
+                                                              page_token=page_token, tipo=tipo, desde=desde,
+                                                              hasta=hasta, campos=campos)
+        if next_token:
+            response.headers['X-Next-Page-Token'] = next_token
+        if analisis_list and campos:
+            return _proyeccion([analisis.model_dump(exclude_unset=True) for analisis in analisis_list],
+                               {'X-Next-Page-Token': next_token} if next_token else None)
         if analisis_list:
             return analisis_list
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Analisis no encontrados")
@@ -49,12 +155,12 @@ def read_all_analisis(usuario_id: str, parcela_id: str):
 @router.put("/{usuario_id}/{parcela_id}/{analisis_id}", response_model=AnalisisResponse,
             summary="Actualizar un analisis por ID",
             description="Actualizar los detalles de un analisis especifico por su ID")
-def update_analisis(usuario_id: str, parcela_id: str, analisis_id: str, analisis: AnalisisCreate):
+async def update_analisis(usuario_id: str, parcela_id: str, analisis_id: str, analisis: AnalisisCreate):
     try:
-        existing_analisis = Analisis.get_by_id(usuario_id, parcela_id, analisis_id)
+        existing_analisis = await Analisis.get_by_id_async(usuario_id, parcela_id, analisis_id)
         if existing_analisis:
             update_analisis = Analisis(**analisis.dict(), id=analisis_id)
-            update_analisis.save(usuario_id, parcela_id)
+            await update_analisis.save_async(usuario_id, parcela_id)
             return update_analisis
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Analisis no encontrado")
     except ValueError as e:
@@ -63,9 +169,9 @@ def update_analisis(usuario_id: str, parcela_id: str, analisis_id: str, analisis
 
 @router.delete("/{usuario_id}/{parcela_id}/{analisis_id}", summary="Eliminar un analisis por ID",
                description="Eliminar un analisis especifico por su ID")
-def delete_analisis(usuario_id: str, parcela_id: str, analisis_id: str):
+async def delete_analisis(usuario_id: str, parcela_id: str, analisis_id: str):
     try:
-        Analisis.delete(usuario_id, parcela_id, analisis_id)
+        await Analisis.delete_async(usuario_id, parcela_id, analisis_id)
         return {"message": "Analisis eliminado correctamente"}
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
@@ -74,40 +180,138 @@ def delete_analisis(usuario_id: str, parcela_id: str, analisis_id: str):
 @router.get("/last_by_tipo/{usuario_id}/{parcela_id}/{tipo}", response_model=List[AnalisisResponse],
             summary="Obtener solo el ultimo analisis de un respectivo tipo",
             description="Obtener solo el ultimo analisis de un respectivo tipo de analisis basado en la fecha de creacion")
-def get_last_analisis_by_tipo(usuario_id: str, parcela_id: str, tipo: str):
-    analisis = Analisis.get_last_analisis_by_tipo(usuario_id, parcela_id, tipo)
+async def get_last_analisis_by_tipo(usuario_id: str, parcela_id: str, tipo: str):
+    analisis = await Analisis.get_last_analisis_by_tipo_async(usuario_id, parcela_id, tipo)
     if analisis:
         return analisis
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Analisis no encontrado")
 
 
+@router.get("/tendencia/{usuario_id}/{parcela_id}/{tipo}", response_model=TendenciaResponse,
+            summary="Obtener la tendencia de los indices de una parcela",
+            description="Serie temporal de la media y los percentiles de los indices espectrales de los analisis de "
+                        "un tipo, opcionalmente entre `desde` y `hasta` y solo para los `indices` indicados")
+async def read_tendencia(usuario_id: str, parcela_id: str, tipo: str, desde: Optional[datetime] = None,
+                         hasta: Optional[datetime] = None, indices: Optional[List[str]] = Query(None)):
+    if not series_store:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Series no habilitadas")
+    if tipo not in sentinelhub.TIPOS_ANALISIS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Tipo de análisis no válido: {tipo}")
+    try:
+        parcela = await Parcela.get_by_id_async(usuario_id, parcela_id)
+    except ValueError:
+        parcela = None
+    if parcela is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Parcela no encontrada")
+    try:
+        # En memoria es inmediato; la primera consulta de una parcela puede leer el disco
+        return await run_in_threadpool(series_store.consultar, usuario_id, parcela_id, tipo, desde, hasta, indices)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
 @router.get("/ejecutar/{usuario_id}/{parcela_id}/{tipo}", response_model=AnalisisResponse,
             summary="Ejecutar un analisis",
-            description="Ejecuta el analisis para una parcela especifica y devuelve el resultado del diagnostico")
-def ejecutar_analisis(usuario_id: str, parcela_id: str, tipo: str = 'plagas'):
-    #Traer las imagenes en funcion del tipo de analisis desde sentinelHub
+            description="Ejecuta el analisis para una parcela especifica y devuelve el resultado del diagnostico. "
+                        "Si el catalogo no tiene escenas nuevas desde el ultimo analisis del tipo, devuelve ese "
+                        "analisis con la cabecera X-Sin-Datos-Nuevos (forzar=true lo ejecuta igual)")
+def ejecutar_analisis(usuario_id: str, parcela_id: str, response: Response, tipo: str = 'plagas',
+                      forzar: bool = False):
     try:
-        sentinel_hub_service = sentinelhub.SentinelHubService()
-        #obtengo datos de parcela
-        parcela = Parcela.get_by_id(usuario_id, parcela_id)
-        #busco las imagenes en funcion del tipo de analisis y la parcela, y se guardan en la ruta indicada
-        imagenes, analisis_id = sentinel_hub_service.fetch_images(parcela, tipo)
+        nuevo_analisis = pipeline.ejecutar_analisis(usuario_id, parcela_id, tipo, forzar=forzar)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except pipeline.SinDatosNuevos as e:
+        return _sin_datos_nuevos(e, response)[0]
+
+    if nuevo_analisis:
+        return AnalisisResponse(**nuevo_analisis.to_dict())
+
+@router.get("/ejecutar_stream/{usuario_id}/{parcela_id}/{tipo}",
+            summary="Ejecutar un analisis con progreso en streaming",
+            description="Igual que /ejecutar, pero responde con Server-Sent Events: `etapa` (token, fetching, "
+                        "storing con las imagenes descargadas, evaluating con el analisis guardado), `evaluacion` "
+                        "con cada fragmento del texto de OpenAI, y al final `analisis`, `sin_datos_nuevos` o `error`",
+            response_class=StreamingResponse)
+async def ejecutar_analisis_stream(usuario_id: str, parcela_id: str, tipo: str, forzar: bool = False):
+    try:
+        _resolver_tipos(usuario_id, parcela_id, [tipo])
+        if not await Parcela.get_by_id_async(usuario_id, parcela_id):
+            raise ValueError("Parcela no existe")
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
-    #Si existen las imagenes, crear el analisis y guardar en firebase
-    if imagenes:
-        nuevo_analisis = Analisis(tipo=tipo, imagenes=imagenes, id=analisis_id)
-        nuevo_analisis.save(usuario_id, parcela_id)
+    loop = asyncio.get_running_loop()
+    cola: asyncio.Queue = asyncio.Queue()
 
-        #analizar las imagenes con OpenAI
-        respuesta = openai.analyze_images(tipo, imagenes)
+    def emitir(evento: Optional[str], data=None):
+        loop.call_soon_threadsafe(cola.put_nowait, (evento, data))
+
+    def ejecutar():
+        # Corre en un hilo; si el cliente se desconecta termina igual y guarda la evaluacion
+        try:
+            # El pre-chequeo del catalogo y la descarga usan el mismo token
+            sentinelhub.token_manager.get_token()
+            emitir('etapa', {'etapa': 'token'})
+            analisis = pipeline.ejecutar_analisis(usuario_id, parcela_id, tipo,
+                                                  on_stage=lambda stage: emitir('etapa', {'etapa': stage}),
+                                                  forzar=forzar,
+                                                  on_delta=lambda texto: emitir('evaluacion', {'texto': texto}))
+            if analisis:
+                emitir('analisis', AnalisisResponse(**analisis.to_dict()).model_dump(mode='json'))
+            else:
+                emitir('error', {'detalle': 'No se obtuvieron imagenes'})
+        except pipeline.SinDatosNuevos as e:
+            emitir('sin_datos_nuevos', {
+                'detalle': str(e),
+                'analisis': [AnalisisResponse(**analisis.to_dict()).model_dump(mode='json') for analisis in e.ultimos],
+            })
+        except Exception as e:
+            logger.exception(f"Error en el analisis en streaming de {usuario_id}/{parcela_id}")
+            emitir('error', {'detalle': str(e)})
+        finally:
+            emitir(None)
+
+    async def eventos():
+        tarea = asyncio.ensure_future(run_in_threadpool(ejecutar))
+        while True:
+            try:
+                evento, data = await asyncio.wait_for(cola.get(), SSE_PING_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if evento is None:
+                break
+            yield f"event: {evento}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        await tarea
+
+    return StreamingResponse(eventos(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _sin_datos_nuevos(e: pipeline.SinDatosNuevos, response: Response) -> List[AnalisisResponse]:
+    # No se descargo nada: se devuelven los analisis vigentes marcados con la cabecera
+    if not e.ultimos:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    response.headers['X-Sin-Datos-Nuevos'] = e.fecha_adquisicion.date().isoformat() \
+        if e.fecha_adquisicion else 'true'
+    return [AnalisisResponse(**analisis.to_dict()) for analisis in e.ultimos]
+
+
+def _resolver_tipos(usuario_id: str, parcela_id: str, tipos: Optional[List[str]]) -> List[str]:
+    if not tipos:
+        parcela = Parcela.get_by_id(usuario_id, parcela_id)
+        if not parcela:
+            raise ValueError("Parcela no existe")
+        tipos = [tipo for tipo in parcela.tipo_monitoreo or [] if tipo in sentinelhub.TIPOS_ANALISIS]
+    invalidos = [tipo for tipo in tipos if tipo not in sentinelhub.TIPOS_ANALISIS]
+    if invalidos:
+        raise ValueError(f"Tipo de análisis no válido: {', '.join(invalidos)}")
+    if not tipos:
+        raise ValueError("La parcela no tiene tipos de analisis para ejecutar")
+    # Sin duplicados y en el mismo orden
+    return list(dict.fromkeys(tipos))
 
-        #si existe respuesta, actualizar el analisis
-        if respuesta:
-            nuevo_analisis.evaluacion = respuesta
-            nuevo_analisis.save(usuario_id, parcela_id)
-        return AnalisisResponse(**nuevo_analisis.to_dict())
 
 @router.get("/ejecutarplaga/{usuario_id}/{parcela_id}/", response_model=str,
                 summary="Ejecutar un analisis plaga",
@@ -5,6 +5,7 @@ from models import *
 import logging
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 @router.post("/register", response_model=UserResponse, summary="Registro de Usuario",
@@ -16,11 +17,11 @@ async def register(user: UserCreate):
     - **username**: El nombre de usuario para registro.
     - **password**: La contraseña del usuario para registro.
     """
-    existing_user = User.get_user_by_username(user.username)
+    existing_user = await User.get_user_by_username_async(user.username)
     if existing_user:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username already registered")
     new_user = User(username=user.username, password=user.password)
-    new_user.create_user()
+    await new_user.create_user_async()
     return UserResponse(username=user.username)
 
 
@@ -33,8 +34,8 @@ async def login(user: UserLogin):
     - **username**: El nombre de usuario para inicio de sesión.
     - **password**: La contraseña del usuario para inicio de sesión.
     """
-    db_user = User.get_user_by_username(user.username)
+    db_user = await User.get_user_by_username_async(user.username)
     if not db_user or db_user['password'] != user.password:
-        logging.log(logging.INFO, f"Invalid credentials for user {user.username}")
+        logger.info(f"Invalid credentials for user {user.username}")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     return UserResponse(username=user.username)
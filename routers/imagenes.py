@@ -0,0 +1,130 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import FileResponse
+
+from models import Analisis, User
+from schemas import UsoDiscoResponse
+from services import lifecycle
+from services.storage import file_sha256, get_absolute_path
+
+router = APIRouter()
+
+# Las imagenes de un analisis no cambian una vez escritas: los clientes pueden guardarlas un año
+CACHE_CONTROL = os.getenv('IMAGENES_CACHE_CONTROL', 'public, max-age=31536000, immutable')
+ETAG_CACHE_SIZE = int(os.getenv('IMAGENES_ETAG_CACHE_SIZE', '4096'))
+
+
+class ImagenResponse(FileResponse):
+    # Con servidores que soportan http.response.pathsend el archivo se envia sin copiarlo
+    # al proceso; en el resto se lee por bloques en un hilo aparte
+    chunk_size = int(os.getenv('IMAGENES_CHUNK_SIZE', str(256 * 1024)))
+
+
+class ETagCache:
+    """
+    Hash sha256 de cada archivo servido, indexado por (dispositivo, inodo, mtime, tamaño)
+    para no volver a leer el archivo completo en cada peticion. Si el archivo se reemplaza
+    cambia la clave y se recalcula.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    async def get(self, path: str, stat_result: os.stat_result) -> str:
+        key = (stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+        with self.lock:
+            etag = self.entries.get(key)
+            if etag is not None:
+                self.entries.move_to_end(key)
+                return etag
+        etag = f'"{await run_in_threadpool(file_sha256, path)}"'
+        with self.lock:
+            self.entries[key] = etag
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return etag
+
+
+etag_cache = ETagCache(ETAG_CACHE_SIZE)
+
+
+def _etag_coincide(if_none_match: str, etag: str) -> bool:
+    # Comparacion debil (RFC 9110): W/"x" coincide con "x"
+    for valor in if_none_match.split(','):
+        valor = valor.strip()
+        if valor == '*' or valor.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def _no_modificada(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    return bool(if_none_match) and _etag_coincide(if_none_match, etag)
+
+
+def _rutas_analisis(analisis: Analisis) -> set:
+    rutas = {imagen.ruta for imagen in analisis.imagenes}
+    if analisis.indices:
+        rutas.update(indice.ruta for indice in analisis.indices.values())
+    return rutas
+
+
+@router.get("/uso/{usuario_id}", response_model=UsoDiscoResponse, summary="Uso de disco de un usuario",
+            description="Espacio ocupado por las imagenes de un usuario, en total y por parcela")
+async def read_uso_disco(usuario_id: str):
+    try:
+        if await User.get_user_by_username_async(usuario_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Usuario no encontrado")
+        return await run_in_threadpool(lifecycle.uso_disco, usuario_id)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@router.api_route("/{usuario_id}/{parcela_id}/{analisis_id}/{archivo}", methods=["GET", "HEAD"],
+                  summary="Obtener una imagen de un analisis",
+                  description="Sirve una imagen (banda o indice) de un analisis del usuario, con ETag, peticiones "
+                              "condicionales, rangos de bytes y cabeceras de cache de larga duracion",
+                  response_class=ImagenResponse)
+async def read_imagen(usuario_id: str, parcela_id: str, analisis_id: str, archivo: str, request: Request):
+    if archivo.startswith('.') or '/' in archivo or '\\' in archivo:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Imagen no encontrada")
+
+    # La imagen debe pertenecer a un analisis existente de la parcela del usuario
+    analisis = await Analisis.get_by_id_async(usuario_id, parcela_id, analisis_id)
+    ruta = os.path.join(usuario_id, parcela_id, analisis_id, archivo)
+    if analisis is None or ruta not in _rutas_analisis(analisis):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Imagen no encontrada")
+
+    path = get_absolute_path(ruta)
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:
+        return await _imagen_archivada(ruta, request)
+
+    etag = await etag_cache.get(path, stat_result)
+    headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+    if _no_modificada(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # FileResponse atiende Range/If-Range (206 y 416) y HEAD con estas cabeceras
+    return ImagenResponse(path, headers=headers, stat_result=stat_result)
+
+
+async def _imagen_archivada(ruta: str, request: Request) -> Response:
+    # Analisis antiguo: la imagen (reducida) esta en el archivo zip de la parcela. Son
+    # archivos pequeños, se envian completos sin soporte de rangos
+    data = await run_in_threadpool(lifecycle.leer_archivada, ruta)
+    if data is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Imagen no encontrada")
+    etag = f'"{hashlib.sha256(data).hexdigest()}"'
+    headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+    if _no_modificada(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=data, media_type='image/png', headers=headers)
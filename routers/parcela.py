@@ -1,7 +1,7 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Response
 from models import Parcela
-from schemas import ParcelaCreate, ParcelaResponse
-from typing import List
+from schemas import ParcelaBulkItem, ParcelaCreate, ParcelaResponse
+from typing import List, Optional
 from starlette import status
 
 router = APIRouter()
@@ -9,20 +9,42 @@ router = APIRouter()
 
 @router.post("/create", response_model=ParcelaResponse, summary="Crear una nueva parcela",
              description="Crear una nueva parcela para un usuario especifico")
-def create_parcela(parcela: ParcelaCreate):
+async def create_parcela(parcela: ParcelaCreate):
     try:
         new_parcela = Parcela(**parcela.dict(), id=parcela.nombre.replace(" ", "_").lower())
-        new_parcela.save()
+        await new_parcela.save_async()
         return new_parcela
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
+@router.get("/bulk/{usuario_id}", response_model=List[ParcelaResponse], summary="Obtener varias parcelas por ID",
+            description="Obtener en una sola lectura las parcelas indicadas de un usuario; las que no existen se omiten")
+async def read_parcelas_bulk(usuario_id: str, ids: List[str] = Query(..., max_length=500)):
+    try:
+        return await Parcela.get_many_async(usuario_id, ids)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@router.post("/bulk/{usuario_id}", response_model=List[ParcelaResponse], summary="Crear o actualizar varias parcelas",
+             description="Crear o actualizar varias parcelas de un usuario con escrituras agrupadas en batches")
+async def save_parcelas_bulk(usuario_id: str, parcelas: List[ParcelaBulkItem]):
+    try:
+        nuevas = [Parcela(**parcela.dict(exclude={'id'}), usuario_id=usuario_id,
+                          id=parcela.id or parcela.nombre.replace(" ", "_").lower())
+                  for parcela in parcelas]
+        await Parcela.save_many_async(usuario_id, nuevas)
+        return nuevas
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
 @router.get("/{usuario_id}/{parcela_id}", response_model=ParcelaResponse, summary="Obtener una parcela por ID",
             description="Obtener los detalles de una parcela especifica por su ID")
-def read_parcela(usuario_id: str, parcela_id: str):
+async def read_parcela(usuario_id: str, parcela_id: str):
     try:
-        parcela = Parcela.get_by_id(usuario_id, parcela_id)
+        parcela = await Parcela.get_by_id_async(usuario_id, parcela_id)
         if parcela:
             return parcela
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Parcela no encontrada")
@@ -32,10 +54,17 @@ def read_parcela(usuario_id: str, parcela_id: str):
 
 @router.get("/{usuario_id}", response_model=List[ParcelaResponse],
             summary="Obtener todas las parcelas de un usuario por ID usuario",
-            description="Obtener los detalles de todas las parcelas por ID usuario")
-def read_all_parcelas(usuario_id: str):
+            description="Obtener los detalles de todas las parcelas por ID usuario. Con `limit` se pagina: el "
+                        "token de la siguiente pagina llega en la cabecera X-Next-Page-Token")
+async def read_all_parcelas(usuario_id: str, response: Response,
+                            limit: Optional[int] = Query(None, ge=1, le=500), page_token: Optional[str] = None):
     try:
-        parcelas = Parcela.get_all(usuario_id)
+        if limit is None:
+            parcelas = await Parcela.get_all_async(usuario_id)
+        else:
+            parcelas, next_token = await Parcela.list_async(usuario_id, limit, page_token)
+            if next_token:
+                response.headers['X-Next-Page-Token'] = next_token
         if parcelas:
             return parcelas
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Parcelas no encontradas")
@@ -45,9 +74,9 @@ def read_all_parcelas(usuario_id: str):
 
 @router.delete("/{usuario_id}/{parcela_id}", summary="Eliminar una parcela por ID",
                description="Eliminar una parcela especifica por su ID")
-def delete_parcela(usuario_id: str, parcela_id: str):
+async def delete_parcela(usuario_id: str, parcela_id: str):
     try:
-        Parcela.delete(usuario_id, parcela_id)
+        await Parcela.delete_async(usuario_id, parcela_id)
         return {"message": "Parcela eliminada correctamente"}
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
@@ -55,12 +84,12 @@ def delete_parcela(usuario_id: str, parcela_id: str):
 
 @router.put("/{usuario_id}/{parcela_id}", response_model=ParcelaResponse, summary="Actualizar una parcela por ID",
             description="Actualizar los detalles de una parcela especifica por su ID")
-def update_parcela(usuario_id: str, parcela_id: str, parcela: ParcelaCreate):
+async def update_parcela(usuario_id: str, parcela_id: str, parcela: ParcelaCreate):
     try:
-        existing_parcela = Parcela.get_by_id(usuario_id, parcela_id)
+        existing_parcela = await Parcela.get_by_id_async(usuario_id, parcela_id)
         if existing_parcela:
             updated_parcela = Parcela(**parcela.dict(), id=parcela_id)
-            updated_parcela.save()
+            await updated_parcela.save_async()
             return updated_parcela
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Parcela no encontrada")
     except ValueError as e:
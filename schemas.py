@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 
 
@@ -29,6 +29,21 @@ class ImagenSatelital(BaseModel):
                       description="Ruta de la imagen satelital en el servidor de contenido estatico")
 
 
+class IndiceEspectral(BaseModel):
+    ruta: str = Field(..., example="devuser/mi_parcela/20240621120000_maleza/indice_ndvi.png",
+                      description="Ruta del raster del indice en el servidor de contenido estatico")
+    media: float = Field(..., example=0.62, description="Valor medio del indice sobre los pixeles validos")
+    desviacion: float = Field(..., example=0.08, description="Desviacion estandar del indice")
+    minimo: float = Field(..., example=0.12, description="Valor minimo del indice")
+    maximo: float = Field(..., example=0.91, description="Valor maximo del indice")
+    percentiles: Dict[str, float] = Field(..., example={"p10": 0.51, "p50": 0.63, "p90": 0.72},
+                                          description="Percentiles del indice")
+    histograma: List[int] = Field(..., description="Cantidad de pixeles en cada intervalo del histograma")
+    rango_histograma: List[float] = Field(..., example=[-1.0, 1.0], description="Limites del histograma")
+    fraccion_enmascarada: float = Field(..., example=0.18,
+                                        description="Fraccion de pixeles sin datos (fuera de la parcela o nubes)")
+
+
 class ParcelaBase(BaseModel):
     nombre: str = Field(..., example="Mi Parcela", description="El nombre referencial de la parcela")
     ubicacion: List[Punto] = Field(...,
@@ -44,6 +59,11 @@ class ParcelaCreate(ParcelaBase):
     usuario_id: str = Field(..., example="devuser", description="El username del usuario propietario de la parcela")
 
 
+class ParcelaBulkItem(ParcelaBase):
+    id: Optional[str] = Field(None, example="parcela_id_123",
+                              description="ID de la parcela a actualizar; si se omite se crea a partir del nombre")
+
+
 class ParcelaResponse(ParcelaBase):
     id: Optional[str] = Field(None, example="parcela_id_123",
                               description="El ID de la parcela, es unico y no admite espacios")
@@ -64,6 +84,10 @@ class AnalisisBase(AnalisisCreate):
     fecha: datetime = Field(..., example="2024-06-21T00:00:00", description="Fecha y hora del analisis")
     evaluacion: Optional[str] = Field(None, example="Healthy",
                             description="Resultado de la evaluacion del diagnostico hecho por la IA")
+    indices: Optional[Dict[str, IndiceEspectral]] = Field(None,
+                                                          description="Indices espectrales calculados localmente")
+    fecha_adquisicion: Optional[datetime] = Field(None, example="2024-06-18T00:00:00",
+                                                  description="Dia de la escena de Sentinel-2 mas reciente usada")
 
 
 class AnalisisResponse(AnalisisBase):
@@ -71,3 +95,63 @@ class AnalisisResponse(AnalisisBase):
 
     class Config:
         from_attributes = True
+
+
+class JobResponse(BaseModel):
+    id: str = Field(..., example="3f2b9c0e8d1a4b6f9e7c5a3d1b0f2e4c", description="Identificador del trabajo")
+    usuario_id: str = Field(..., example="devuser", description="El username del usuario propietario de la parcela")
+    parcela_id: str = Field(..., example="mi_parcela", description="El ID de la parcela analizada")
+    tipos: List[str] = Field(..., example=["plagas"], description="Tipos de analisis a ejecutar")
+    etapa: str = Field(..., example="fetching",
+                       description="Etapa actual: pending, fetching, storing, evaluating, done o failed")
+    intentos: int = Field(..., example=1, description="Cantidad de veces que se intento ejecutar el trabajo")
+    error: Optional[str] = Field(None, description="Detalle del error si el trabajo fallo")
+    resultado: Optional[dict] = Field(None, example={"analisis_ids": ["20240621120000_plagas"]},
+                                      description="Resultado del trabajo una vez terminado")
+    grupo: Optional[List[Dict[str, str]]] = Field(
+        None, example=[{"usuario_id": "devuser", "parcela_id": "mi_parcela"}],
+        description="Parcelas vecinas del mismo usuario analizadas con una sola descarga de imagenes")
+    creado: datetime = Field(..., example="2024-06-21T00:00:00", description="Fecha y hora de creacion del trabajo")
+    actualizado: datetime = Field(..., example="2024-06-21T00:01:00",
+                                  description="Fecha y hora de la ultima actualizacion del trabajo")
+
+    @staticmethod
+    def from_job(job: dict):
+        return JobResponse(
+            id=job['id'],
+            usuario_id=job['usuario_id'],
+            parcela_id=job['parcela_id'],
+            tipos=job['tipos'],
+            etapa=job['stage'],
+            intentos=job['attempts'],
+            error=job['error'],
+            resultado=job['resultado'],
+            grupo=job.get('grupo'),
+            creado=datetime.fromisoformat(job['created_at']),
+            actualizado=datetime.fromisoformat(job['updated_at'])
+        )
+
+
+class UsoParcela(BaseModel):
+    bytes: int = Field(..., example=5242880, description="Bytes ocupados por las imagenes de la parcela")
+    archivos: int = Field(..., example=42, description="Cantidad de archivos en disco")
+    analisis: int = Field(..., example=8, description="Analisis con carpeta de imagenes (no archivados)")
+    archivado_bytes: int = Field(..., example=1048576, description="Tamaño del archivo con los analisis antiguos")
+
+
+class UsoDiscoResponse(BaseModel):
+    usuario_id: str = Field(..., example="devuser", description="El username del usuario")
+    bytes: int = Field(..., example=5242880, description="Bytes ocupados por todas las imagenes del usuario")
+    archivos: int = Field(..., example=42, description="Cantidad de archivos en disco")
+    parcelas: Dict[str, UsoParcela] = Field(..., description="Uso de disco por parcela")
+
+
+class TendenciaResponse(BaseModel):
+    tipo: str = Field(..., example="maleza", description="Tipo de analisis de la serie")
+    fechas: List[datetime] = Field(..., example=["2024-06-21T12:00:00"], description="Fecha de cada analisis")
+    analisis_ids: List[str] = Field(..., example=["20240621120000_maleza"], description="ID de cada analisis")
+    fraccion_enmascarada: List[Optional[float]] = Field(..., example=[0.35],
+                                                        description="Fraccion de pixeles sin datos de cada analisis")
+    indices: Dict[str, Dict[str, List[Optional[float]]]] = Field(
+        ..., example={"ndvi": {"media": [0.61], "p10": [0.42], "p50": [0.63], "p90": [0.78]}},
+        description="Por indice, la serie de cada estadistico (media y percentiles)")
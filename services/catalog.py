@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Iterable, List, Optional
+
+from dotenv import load_dotenv
+
+from services import http_client, metrics
+from services.imagery_cache import normalize_polygon
+from services.ratelimit import sentinelhub_limiter
+# Misma ventana y filtro de nubosidad que las peticiones de procesamiento
+from services.sentinelhub import MAX_NUBOSIDAD, VENTANA_DIAS, token_manager
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class Catalog:
+    """
+    Fechas de adquisicion de Sentinel-2 disponibles para un poligono, para saber antes
+    de descargar si hay imagenes nuevas. Las respuestas se guardan `ttl` segundos.
+
+    Las subclases implementan `_buscar`.
+    """
+
+    def __init__(self, ttl: float = 900.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _buscar(self, polygon_coords, desde: datetime, hasta: datetime, max_nubosidad: int) -> List[date]:
+        raise NotImplementedError
+
+    def fechas_adquisicion(self, polygon_coords, desde: Optional[datetime] = None,
+                           hasta: Optional[datetime] = None) -> List[date]:
+        hasta = hasta or datetime.now()
+        desde = desde or hasta - timedelta(days=VENTANA_DIAS)
+        # Dentro del mismo dia se considera la misma consulta, igual que en la cache de imagenes
+        key = json.dumps([normalize_polygon(polygon_coords), desde.date().isoformat(), hasta.date().isoformat(),
+                          MAX_NUBOSIDAD])
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.misses += 1
+        fechas = sorted(set(self._buscar(polygon_coords, desde, hasta, MAX_NUBOSIDAD)))
+        with self.lock:
+            self.entries[key] = (now + self.ttl, fechas)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return fechas
+
+    def ultima_adquisicion(self, polygon_coords) -> Optional[datetime]:
+        # Adquisicion mas reciente de la ventana: la que usa el mosaico (mostRecent)
+        fechas = self.fechas_adquisicion(polygon_coords)
+        return datetime.combine(fechas[-1], datetime.min.time()) if fechas else None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class SentinelCatalog(Catalog):
+    """
+    Catalog API (STAC) de Sentinel Hub: fechas distintas de las escenas de
+    sentinel-2-l2a que intersectan el poligono con nubosidad menor al limite.
+    """
+
+    def __init__(self, url: str, ttl: float = 900.0, max_entries: int = 10000):
+        super().__init__(ttl, max_entries)
+        self.url = url
+
+    def _buscar(self, polygon_coords, desde: datetime, hasta: datetime, max_nubosidad: int) -> List[date]:
+        payload = {
+            'collections': ['sentinel-2-l2a'],
+            'datetime': f"{desde.strftime('%Y-%m-%dT%H:%M:%SZ')}/{hasta.strftime('%Y-%m-%dT%H:%M:%SZ')}",
+            'intersects': {'type': 'Polygon', 'coordinates': polygon_coords},
+            'filter': f'eo:cloud_cover < {max_nubosidad}',
+            'filter-lang': 'cql2-text',
+            'distinct': 'date',
+            'limit': 100,
+        }
+        fechas = []
+        while True:
+            response = self._post(payload)
+            if response.status_code != 200:
+                raise Exception(f"Error consultando el catalogo: {response.status_code} - {response.text}")
+            data = response.json()
+            fechas.extend(date.fromisoformat(fecha[:10]) for fecha in data.get('features', []))
+            siguiente = data.get('context', {}).get('next')
+            if siguiente is None:
+                return fechas
+            payload['next'] = siguiente
+
+    def _post(self, payload):
+        token = token_manager.get_token()
+        sentinelhub_limiter.acquire()
+        with metrics.stage('sentinel_catalog'):
+            response = http_client.post(self.url, json=payload, headers={'Authorization': f'Bearer {token}'})
+            if response.status_code == 401:
+                # Token expirado o revocado, obtener uno nuevo y reintentar
+                token_manager.invalidate(token)
+                token = token_manager.get_token()
+                response = http_client.post(self.url, json=payload, headers={'Authorization': f'Bearer {token}'})
+        return response
+
+
+class LocalCatalog(Catalog):
+    """
+    Catalogo en memoria con fechas fijas, para pruebas y ejecuciones sin Sentinel Hub.
+    """
+
+    def __init__(self, fechas: Iterable[date] = (), ttl: float = 0.0):
+        super().__init__(ttl)
+        self.fechas = list(fechas)
+
+    def _buscar(self, polygon_coords, desde: datetime, hasta: datetime, max_nubosidad: int) -> List[date]:
+        return [fecha for fecha in self.fechas if desde.date() <= fecha <= hasta.date()]
+
+
+catalog: Optional[Catalog] = None
+if os.getenv('CATALOG_ENABLED', 'true').lower() == 'true':
+    catalog = SentinelCatalog(
+        os.getenv('SENTINEL_CATALOG_URL', 'https://services.sentinel-hub.com/api/v1/catalog/1.0.0/search'),
+        ttl=float(os.getenv('CATALOG_CACHE_TTL_SECONDS', '900'))
+    )
+
+
+def set_catalog(nuevo: Optional[Catalog]):
+    # Reemplaza el catalogo (p. ej. por un LocalCatalog); None desactiva el pre-chequeo
+    global catalog
+    catalog = nuevo
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class EvaluationCache:
+    """
+    Cache de las evaluaciones devueltas por OpenAI, guardada en SQLite.
+
+    La clave combina el modelo, el prompt y el hash del contenido de cada imagen (o, en
+    las imagenes remotas, su URL y la version que informa el CDN), asi que repetir o
+    actualizar un analisis con las mismas imagenes reutiliza la respuesta.
+    Las llamadas concurrentes con la misma clave esperan a la primera en lugar de
+    repetir la consulta.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS evaluaciones ('
+            'key TEXT PRIMARY KEY, evaluacion TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS evaluaciones_last_access ON evaluaciones (last_access)')
+
+    @staticmethod
+    def build_key(model: str, prompt: str, image_hashes: List[str], **params) -> str:
+        key_source = {
+            'model': model,
+            'prompt': hashlib.sha256(prompt.encode('utf-8')).hexdigest(),
+            'images': image_hashes,
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(key_source, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT evaluacion, created_at FROM evaluaciones WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                self._conn.execute('DELETE FROM evaluaciones WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE evaluaciones SET last_access = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def put(self, key: str, evaluacion: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO evaluaciones (key, evaluacion, created_at, last_access) VALUES (?, ?, ?, ?)',
+                (key, evaluacion, now, now)
+            )
+            self._evict(now)
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        while True:
+            evaluacion = self.get(key)
+            if evaluacion is not None:
+                with self._lock:
+                    self.hits += 1
+                return evaluacion
+            with self._lock:
+                event = self._in_flight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._in_flight[key] = event
+                    self.misses += 1
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                # Otra peticion ya esta consultando lo mismo: esperar su resultado
+                event.wait()
+                continue
+            try:
+                evaluacion = compute()
+                if evaluacion:
+                    self.put(key, evaluacion)
+                return evaluacion
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                event.set()
+
+    def _evict(self, now: float):
+        self._conn.execute('DELETE FROM evaluaciones WHERE created_at < ?', (now - self.ttl_seconds,))
+        count = self._conn.execute('SELECT COUNT(*) FROM evaluaciones').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM evaluaciones WHERE key IN '
+                '(SELECT key FROM evaluaciones ORDER BY last_access LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM evaluaciones').fetchone()[0]
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'max_entries': self.max_entries,
+        }
+
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+evaluation_cache: Optional[EvaluationCache] = None
+if os.getenv('EVAL_CACHE_ENABLED', 'true').lower() == 'true':
+    evaluation_cache = EvaluationCache(
+        os.path.join(project_root, os.getenv('EVAL_CACHE_PATH', 'data/evaluation_cache.db')),
+        ttl_seconds=float(os.getenv('EVAL_CACHE_TTL_SECONDS', str(30 * 24 * 3600))),
+        max_entries=int(os.getenv('EVAL_CACHE_MAX_ENTRIES', '10000'))
+    )
@@ -2,15 +2,32 @@ import os
 
 import firebase_admin
 from dotenv import load_dotenv
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
+from google.auth.credentials import AnonymousCredentials
 
 load_dotenv()
 
-parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-firebase_keyfile = os.path.join(parent_dir, os.getenv("FIREBASE_KEYFILE"))
 
-cred = credentials.Certificate(firebase_keyfile)
-firebase_admin.initialize_app(cred)
+class EmulatorCredential(credentials.Base):
+    # El emulador de Firestore no valida credenciales
+    def get_credential(self):
+        return AnonymousCredentials()
+
+
+if os.getenv('FIRESTORE_EMULATOR_HOST'):
+    # Emulador local (benchmarks y desarrollo): el cliente de Firestore se conecta a
+    # FIRESTORE_EMULATOR_HOST sin cuenta de servicio
+    firebase_admin.initialize_app(EmulatorCredential(),
+                                  {'projectId': os.getenv('FIREBASE_PROJECT_ID', 'farmai-local')})
+else:
+    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    firebase_keyfile = os.path.join(parent_dir, os.getenv("FIREBASE_KEYFILE"))
+
+    cred = credentials.Certificate(firebase_keyfile)
+    firebase_admin.initialize_app(cred)
+
 db = firestore.client()
+# Cliente asincrono para las rutas del API (no bloquea el event loop)
+async_db = firestore_async.client()
 
 prefix = os.getenv('FIREBASE_COLLECTION_PREFIX', '')
\ No newline at end of file
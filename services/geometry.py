@@ -0,0 +1,49 @@
+import math
+from typing import Tuple
+
+# Radio medio de la Tierra en metros
+EARTH_RADIUS_M = 6371008.8
+
+# Resolucion nativa (m) de cada banda de Sentinel-2 usada por los analisis
+BANDA_RESOLUCION_M = {
+    'B02': 10, 'B03': 10, 'B04': 10, 'B08': 10,
+    'B05': 20, 'B06': 20, 'B07': 20, 'B8A': 20, 'B11': 20, 'B12': 20,
+    'B01': 60, 'B09': 60,
+}
+
+
+def bbox(polygon_coords) -> Tuple[float, float, float, float]:
+    # (min_lon, min_lat, max_lon, max_lat) del anillo exterior
+    ring = polygon_coords[0]
+    lons = [point[0] for point in ring]
+    lats = [point[1] for point in ring]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def _metros_por_grado(lat: float) -> Tuple[float, float]:
+    por_grado = math.pi * EARTH_RADIUS_M / 180
+    return por_grado * math.cos(math.radians(lat)), por_grado
+
+
+def bbox_size_m(box) -> Tuple[float, float]:
+    # Ancho y alto aproximados en metros (proyeccion equirectangular a la latitud media)
+    min_lon, min_lat, max_lon, max_lat = box
+    m_lon, m_lat = _metros_por_grado((min_lat + max_lat) / 2)
+    return (max_lon - min_lon) * m_lon, (max_lat - min_lat) * m_lat
+
+
+def output_size(box, resolution_m: float, min_px: int, max_px: int) -> Tuple[int, int]:
+    """
+    Tamaño en pixeles que corresponde al bbox a la resolucion indicada, limitado a
+    [min_px, max_px] por lado y conservando la proporcion.
+    """
+    width_m, height_m = bbox_size_m(box)
+    width = max(1.0, width_m / resolution_m)
+    height = max(1.0, height_m / resolution_m)
+    scale = 1.0
+    if max(width, height) > max_px:
+        scale = max_px / max(width, height)
+    elif max(width, height) < min_px:
+        scale = min_px / max(width, height)
+    return (max(1, min(max_px, math.ceil(width * scale))),
+            max(1, min(max_px, math.ceil(height * scale))))
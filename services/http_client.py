@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Respuestas que se consideran transitorias y se reintentan
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '120'))
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '20'))
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))
+BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '30'))
+
+
+def _retry_after(headers) -> Optional[float]:
+    # Retry-After puede venir en segundos o como fecha HTTP
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        fecha = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return max(0.0, (fecha - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, headers=None) -> float:
+    retry_after = _retry_after(headers)
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX)
+    # Backoff exponencial con jitter completo
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+
+def request(method: str, url: str, max_retries: int = MAX_RETRIES, **kwargs) -> requests.Response:
+    """
+    Peticion sincrona sobre la sesion compartida (conexiones keep-alive reutilizadas),
+    reintentando errores de conexion y respuestas 429/5xx.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    attempt = 0
+    while True:
+        try:
+            response = _session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{method} {url} fallo ({e}), reintento {attempt + 1} en {delay:.2f}s")
+        else:
+            if response.status_code not in RETRY_STATUS or attempt >= max_retries:
+                return response
+            delay = backoff_delay(attempt, response.headers)
+            logger.warning(f"{method} {url} respondio {response.status_code}, reintento {attempt + 1} en {delay:.2f}s")
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE),
+        )
+    return _async_client
+
+
+async def async_request(method: str, url: str, max_retries: int = MAX_RETRIES, **kwargs) -> httpx.Response:
+    """
+    Variante asincrona de `request` con la misma politica de reintentos.
+    """
+    client = get_async_client()
+    attempt = 0
+    while True:
+        try:
+            response = await client.request(method, url, **kwargs)
+        except (httpx.ConnectError, httpx.TimeoutException) as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{method} {url} fallo ({e}), reintento {attempt + 1} en {delay:.2f}s")
+        else:
+            if response.status_code not in RETRY_STATUS or attempt >= max_retries:
+                return response
+            delay = backoff_delay(attempt, response.headers)
+            logger.warning(f"{method} {url} respondio {response.status_code}, reintento {attempt + 1} en {delay:.2f}s")
+            await response.aclose()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def async_get(url: str, **kwargs) -> httpx.Response:
+    return await async_request('GET', url, **kwargs)
+
+
+async def async_post(url: str, **kwargs) -> httpx.Response:
+    return await async_request('POST', url, **kwargs)
+
+
+async def aclose():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
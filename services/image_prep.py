@@ -0,0 +1,93 @@
+import base64
+import io
+import math
+import os
+from typing import List
+
+from dotenv import load_dotenv
+from PIL import Image, ImageDraw
+
+from models import ImagenSatelital
+from services.storage import get_absolute_path
+
+load_dotenv()
+
+# 'mosaic': un solo mosaico con todas las bandas, 'bands': cada banda reducida por separado,
+# 'url': las URLs del CDN a resolucion completa (comportamiento anterior)
+MODE = os.getenv('OPENAI_IMAGE_MODE', 'mosaic').lower()
+MAX_SIZE = int(os.getenv('OPENAI_IMAGE_MAX_SIZE', '512'))
+FORMAT = os.getenv('OPENAI_IMAGE_FORMAT', 'JPEG').upper()
+QUALITY = int(os.getenv('OPENAI_IMAGE_QUALITY', '85'))
+
+# Nivel de detalle que pide cada tipo de analisis; 'low' se factura como una sola tesela
+DETAIL_POR_TIPO = {
+    'maleza': os.getenv('OPENAI_IMAGE_DETAIL_MALEZA', 'high'),
+    'nutricion': os.getenv('OPENAI_IMAGE_DETAIL_NUTRICION', 'low'),
+    'plagas': os.getenv('OPENAI_IMAGE_DETAIL_PLAGAS', 'high'),
+}
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+
+
+def inline_enabled() -> bool:
+    return MODE in ('mosaic', 'bands')
+
+
+def firma(diagnosis_type: str) -> dict:
+    # Parametros que cambian lo que ve el modelo; forman parte de la clave de la cache
+    return {'mode': MODE, 'max_size': MAX_SIZE, 'format': FORMAT, 'quality': QUALITY,
+            'detail': DETAIL_POR_TIPO.get(diagnosis_type, 'auto')}
+
+
+def _cargar_reducida(imagen: ImagenSatelital, size: int) -> Image.Image:
+    with Image.open(get_absolute_path(imagen.ruta)) as image:
+        # draft() deja que el decodificador reduzca antes de cargar (util en JPEG)
+        image.draft('RGB', (size, size))
+        reducida = image.convert('RGB')
+    reducida.thumbnail((size, size), Image.LANCZOS)
+    return reducida
+
+
+def _mosaico(imagenes: List[ImagenSatelital]) -> Image.Image:
+    columnas = math.ceil(math.sqrt(len(imagenes)))
+    filas = math.ceil(len(imagenes) / columnas)
+    tesela = max(64, MAX_SIZE // columnas)
+    mosaico = Image.new('RGB', (columnas * tesela, filas * tesela))
+    draw = ImageDraw.Draw(mosaico)
+    for i, imagen in enumerate(imagenes):
+        x, y = (i % columnas) * tesela, (i // columnas) * tesela
+        mosaico.paste(_cargar_reducida(imagen, tesela), (x, y))
+        # Etiqueta con el nombre de la banda para que el modelo identifique cada tesela
+        draw.rectangle((x, y, x + 8 * len(imagen.tipo) + 6, y + 14), fill=(0, 0, 0))
+        draw.text((x + 3, y + 2), imagen.tipo, fill=(255, 255, 255))
+    return mosaico
+
+
+def _data_url(image: Image.Image) -> str:
+    buffer = io.BytesIO()
+    options = {} if FORMAT == 'PNG' else {'quality': QUALITY}
+    image.save(buffer, format=FORMAT, **options)
+    encoded = base64.b64encode(buffer.getvalue()).decode('ascii')
+    return f"data:{MIME_TYPES.get(FORMAT, 'image/jpeg')};base64,{encoded}"
+
+
+def preparar_imagenes(diagnosis_type: str, imagenes: List[ImagenSatelital]) -> List[dict]:
+    """
+    Construye, a partir de las bandas guardadas localmente, las imagenes reducidas que
+    se envian inline (base64) a OpenAI.
+    """
+    detail = DETAIL_POR_TIPO.get(diagnosis_type, 'auto')
+    if MODE == 'mosaic':
+        reducidas = [_mosaico(imagenes)]
+    else:
+        reducidas = [_cargar_reducida(imagen, MAX_SIZE) for imagen in imagenes]
+    return [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": _data_url(reducida),
+                "detail": detail,
+            },
+        }
+        for reducida in reducidas
+    ]
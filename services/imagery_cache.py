@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from models import Parcela, ImagenSatelital
+from services.storage import StorageService, link_or_copy
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_polygon(polygon_coords, decimals: int = 6):
+    """
+    Forma canonica del anillo devuelto por `convert_points_to_coordinates`: coordenadas
+    redondeadas, sentido antihorario y empezando por el vertice menor, de modo que el
+    mismo poligono dibujado desde otro punto o en otro sentido produzca la misma clave.
+    """
+    ring = [(round(lon, decimals), round(lat, decimals)) for lon, lat in polygon_coords[0]]
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring = ring[:-1]
+    # Area con signo (formula del shoelace): negativa si el anillo esta en sentido horario
+    area = sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]))
+    if area < 0:
+        ring.reverse()
+    start = ring.index(min(ring))
+    ring = ring[start:] + ring[:start]
+    return [list(point) for point in ring]
+
+
+class ImageryCache:
+    """
+    Cache en disco de las imagenes devueltas por Sentinel Hub.
+
+    Cada entrada corresponde a una peticion (poligono, tipo, evalscript y ventana de
+    fechas) y apunta a blobs guardados por hash de contenido, asi que una misma banda
+    solo ocupa disco una vez. Se desalojan las entradas menos usadas cuando los blobs
+    superan `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.blobs_path = os.path.join(path, 'blobs')
+        os.makedirs(self.blobs_path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, files TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)'
+        )
+
+    @staticmethod
+    def build_key(tipo: str, polygon_coords, payload: dict) -> str:
+        data_filter = payload['input']['data'][0]['dataFilter']
+        # La ventana se cuantiza al dia: dentro del mismo dia se considera la misma peticion
+        time_range = {limit: value[:10] for limit, value in data_filter['timeRange'].items()}
+        key_source = {
+            'polygon': normalize_polygon(polygon_coords),
+            'tipo': tipo,
+            'evalscript': hashlib.sha256(payload['evalscript'].encode('utf-8')).hexdigest(),
+            'output': payload['output'],
+            'filter': {**data_filter, 'timeRange': time_range},
+        }
+        return hashlib.sha256(json.dumps(key_source, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _blob_path(self, sha: str) -> str:
+        return os.path.join(self.blobs_path, sha[:2], sha)
+
+    def get(self, key: str, parcela: Parcela, analisis_id: str) -> Optional[List[ImagenSatelital]]:
+        with self._lock:
+            row = self._conn.execute('SELECT files FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            files = json.loads(row[0])
+            if not all(os.path.exists(self._blob_path(sha)) for _, sha in files):
+                # Blob borrado por fuera de la cache: descartar la entrada
+                self._remove_entry(key, files)
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+            storage_service = StorageService(parcela, analisis_id)
+            imagenes = [storage_service.link_image(self._blob_path(sha), filename) for filename, sha in files]
+        logger.info(f"Imagenes servidas desde cache para {analisis_id}")
+        return imagenes
+
+    def put(self, key: str, storage_service: StorageService):
+        files = list(storage_service.content_hashes.items())
+        if not files:
+            return
+        with self._lock:
+            existing = self._conn.execute('SELECT files FROM entries WHERE key = ?', (key,)).fetchone()
+            if existing is not None:
+                self._remove_entry(key, json.loads(existing[0]))
+            for filename, sha in files:
+                blob_path = self._blob_path(sha)
+                if self._conn.execute('SELECT 1 FROM blobs WHERE sha = ?', (sha,)).fetchone():
+                    self._conn.execute('UPDATE blobs SET refs = refs + 1 WHERE sha = ?', (sha,))
+                    continue
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                link_or_copy(os.path.join(storage_service.folder_path, filename), blob_path)
+                self._conn.execute('INSERT INTO blobs (sha, size, refs) VALUES (?, ?, 1)',
+                                   (sha, os.path.getsize(blob_path)))
+            now = time.time()
+            self._conn.execute('INSERT INTO entries (key, files, created_at, last_access) VALUES (?, ?, ?, ?)',
+                               (key, json.dumps(files), now, now))
+            self._evict()
+
+    def _remove_entry(self, key: str, files):
+        self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        for _, sha in files:
+            self._conn.execute('UPDATE blobs SET refs = refs - 1 WHERE sha = ?', (sha,))
+        for (sha,) in self._conn.execute('SELECT sha FROM blobs WHERE refs <= 0').fetchall():
+            self._conn.execute('DELETE FROM blobs WHERE sha = ?', (sha,))
+            if os.path.exists(self._blob_path(sha)):
+                os.remove(self._blob_path(sha))
+
+    def _evict(self):
+        # Desalojar las entradas menos usadas recientemente hasta volver bajo el limite
+        while self._total_bytes() > self.max_bytes:
+            row = self._conn.execute('SELECT key, files FROM entries ORDER BY last_access LIMIT 1').fetchone()
+            if row is None:
+                break
+            logger.info(f"Desalojando entrada de cache {row[0]}")
+            self._remove_entry(row[0], json.loads(row[1]))
+
+    def _total_bytes(self) -> int:
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            total_bytes = self._total_bytes()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+imagery_cache: Optional[ImageryCache] = None
+if os.getenv('IMAGERY_CACHE_ENABLED', 'true').lower() == 'true':
+    imagery_cache = ImageryCache(
+        os.path.join(project_root, os.getenv('IMAGERY_CACHE_PATH', 'data/imagery_cache')),
+        max_bytes=int(os.getenv('IMAGERY_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+    )
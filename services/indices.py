@@ -0,0 +1,115 @@
+import logging
+import os
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+from models import ImagenSatelital, IndiceEspectral
+from services.sentinelhub import BANDAS_POR_TIPO
+from services.storage import get_absolute_path
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (10, 25, 50, 75, 90)
+HISTOGRAMA_BINS = int(os.getenv('INDICES_HISTOGRAMA_BINS', '20'))
+HISTOGRAMA_RANGO = (-1.0, 1.0)
+
+
+def _diferencia_normalizada(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (a - b) / (a + b)
+
+
+def _evi(bandas: Dict[str, np.ndarray]) -> np.ndarray:
+    nir, red, blue = bandas['B08'], bandas['B04'], bandas['B02']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 2.5 * (nir - red) / (nir + 6.0 * red - 7.5 * blue + 1.0)
+
+
+# Indice -> (bandas necesarias, calculo sobre los arrays completos)
+INDICES = {
+    'ndvi': (('B08', 'B04'), lambda b: _diferencia_normalizada(b['B08'], b['B04'])),
+    'evi': (('B08', 'B04', 'B02'), _evi),
+    'ndwi': (('B03', 'B08'), lambda b: _diferencia_normalizada(b['B03'], b['B08'])),
+    # Estres hidrico (NDMI)
+    'ndmi': (('B08', 'B11'), lambda b: _diferencia_normalizada(b['B08'], b['B11'])),
+    'nbr': (('B08', 'B12'), lambda b: _diferencia_normalizada(b['B08'], b['B12'])),
+}
+
+
+def _cargar_banda(ruta: str) -> np.ndarray:
+    # Las PNG de Sentinel Hub vienen en 8 bits (reflectancia 0-1 escalada a 0-255) o en 16 bits
+    with Image.open(get_absolute_path(ruta)) as image:
+        array = np.asarray(image)
+    escala = 65535.0 if array.dtype == np.uint16 else 255.0
+    return array.astype(np.float32) / escala
+
+
+def _cargar_bandas(tipo: str, imagenes: List[ImagenSatelital]) -> Dict[str, np.ndarray]:
+    nombres = BANDAS_POR_TIPO.get(tipo, {})
+    bandas = {}
+    for imagen in imagenes:
+        banda = nombres.get(imagen.tipo)
+        if banda:
+            bandas[banda] = _cargar_banda(imagen.ruta)
+    return bandas
+
+
+def _guardar_raster(valores: np.ndarray, valido: np.ndarray, ruta: str):
+    # Escala [-1, 1] a [1, 255]; 0 queda reservado para los pixeles sin datos
+    escalado = np.clip((valores + 1.0) * 127.0 + 1.0, 1, 255)
+    raster = np.where(valido, escalado, 0).astype(np.uint8)
+    filepath = get_absolute_path(ruta)
+    tmp_path = f"{filepath}.tmp"
+    Image.fromarray(raster).save(tmp_path, format='PNG')
+    os.replace(tmp_path, filepath)
+
+
+def _estadisticas(valores: np.ndarray, valido: np.ndarray, ruta: str) -> IndiceEspectral:
+    muestra = valores[valido]
+    fraccion_enmascarada = 1.0 - muestra.size / valores.size if valores.size else 1.0
+    if muestra.size == 0:
+        return IndiceEspectral(ruta=ruta, media=0.0, desviacion=0.0, minimo=0.0, maximo=0.0,
+                               percentiles={f"p{p}": 0.0 for p in PERCENTILES},
+                               histograma=[0] * HISTOGRAMA_BINS, rango_histograma=list(HISTOGRAMA_RANGO),
+                               fraccion_enmascarada=fraccion_enmascarada)
+    percentiles = np.percentile(muestra, PERCENTILES)
+    histograma, _ = np.histogram(np.clip(muestra, *HISTOGRAMA_RANGO), bins=HISTOGRAMA_BINS, range=HISTOGRAMA_RANGO)
+    return IndiceEspectral(
+        ruta=ruta,
+        media=float(muestra.mean()),
+        desviacion=float(muestra.std()),
+        minimo=float(muestra.min()),
+        maximo=float(muestra.max()),
+        percentiles={f"p{p}": float(v) for p, v in zip(PERCENTILES, percentiles)},
+        histograma=histograma.tolist(),
+        rango_histograma=list(HISTOGRAMA_RANGO),
+        fraccion_enmascarada=float(fraccion_enmascarada),
+    )
+
+
+def calcular_indices(tipo: str, imagenes: List[ImagenSatelital]) -> Dict[str, IndiceEspectral]:
+    """
+    Calcula los indices espectrales que permiten las bandas descargadas para el tipo
+    de analisis, guarda un raster PNG de cada uno junto a las imagenes y devuelve
+    sus estadisticas.
+    """
+    bandas = _cargar_bandas(tipo, imagenes)
+    if not bandas:
+        return {}
+    # Fuera del poligono (o sin adquisicion valida) todas las bandas valen 0
+    sin_datos = np.logical_and.reduce([banda == 0 for banda in bandas.values()])
+    carpeta = os.path.dirname(imagenes[0].ruta)
+
+    resultados = {}
+    for nombre, (requeridas, calculo) in INDICES.items():
+        if not all(banda in bandas for banda in requeridas):
+            continue
+        valores = calculo(bandas)
+        valido = ~sin_datos & np.isfinite(valores)
+        ruta = os.path.join(carpeta, f"indice_{nombre}.png")
+        _guardar_raster(valores, valido, ruta)
+        resultados[nombre] = _estadisticas(valores, valido, ruta)
+    logger.info(f"Indices calculados para {carpeta}: {', '.join(resultados)}")
+    return resultados
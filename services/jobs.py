@@ -0,0 +1,252 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from dotenv import load_dotenv
+
+from services import log_config, metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Etapas por las que pasa un trabajo de analisis
+STAGE_PENDING = 'pending'
+STAGE_FETCHING = 'fetching'
+STAGE_STORING = 'storing'
+STAGE_EVALUATING = 'evaluating'
+STAGE_DONE = 'done'
+STAGE_FAILED = 'failed'
+
+STAGES_EN_CURSO = (STAGE_FETCHING, STAGE_STORING, STAGE_EVALUATING)
+
+
+class JobQueue:
+    """
+    Cola de trabajos persistente respaldada por SQLite.
+
+    Los trabajos sobreviven a reinicios del proceso: al arrancar, los que quedaron
+    a medias se devuelven a la cola (o se marcan fallidos si agotaron sus intentos).
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._nuevo_trabajo = threading.Condition()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                usuario_id TEXT NOT NULL,
+                parcela_id TEXT NOT NULL,
+                tipos TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                error TEXT,
+                resultado TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                grupo TEXT
+            )
+            """
+        )
+        # Bases creadas antes de los trabajos agrupados
+        columnas = {row['name'] for row in self._conn.execute('PRAGMA table_info(jobs)')}
+        if 'grupo' not in columnas:
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN grupo TEXT')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_stage_run_at ON jobs (stage, run_at)')
+
+    def enqueue(self, usuario_id: str, parcela_id: str, tipos: List[str], run_at: Optional[datetime] = None,
+                grupo: Optional[List[dict]] = None) -> dict:
+        # grupo: parcelas vecinas ({usuario_id, parcela_id}) que se analizan con una sola
+        # descarga; usuario_id/parcela_id son los de la primera
+        now = datetime.now().isoformat()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO jobs (id, usuario_id, parcela_id, tipos, stage, attempts, run_at, created_at, updated_at, '
+                'grupo) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?)',
+                (job_id, usuario_id, parcela_id, json.dumps(tipos), STAGE_PENDING,
+                 (run_at.isoformat() if run_at else now), now, now, json.dumps(grupo) if grupo else None)
+            )
+        with self._nuevo_trabajo:
+            self._nuevo_trabajo.notify()
+        # Deja asociado el id de la peticion (o del scheduler) con el del trabajo
+        destino = f"{len(grupo)} parcelas desde {usuario_id}/{parcela_id}" if grupo else f"{usuario_id}/{parcela_id}"
+        logger.info(f"Trabajo {job_id} encolado para {destino}: {', '.join(tipos)}")
+        return self.get(job_id)
+
+    def claim(self) -> Optional[dict]:
+        # Toma el siguiente trabajo pendiente de forma atomica
+        now = datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT id FROM jobs WHERE stage = ? AND run_at <= ? ORDER BY run_at LIMIT 1',
+                    (STAGE_PENDING, now)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute('COMMIT')
+                    return None
+                self._conn.execute(
+                    'UPDATE jobs SET stage = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                    (STAGE_FETCHING, now, row['id'])
+                )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return self.get(row['id'])
+
+    def wait_for_job(self, timeout: float):
+        with self._nuevo_trabajo:
+            self._nuevo_trabajo.wait(timeout)
+
+    def wake_all(self):
+        with self._nuevo_trabajo:
+            self._nuevo_trabajo.notify_all()
+
+    def update_stage(self, job_id: str, stage: str):
+        self._update(job_id, stage=stage)
+
+    def complete(self, job_id: str, resultado: Optional[dict] = None):
+        self._update(job_id, stage=STAGE_DONE, resultado=json.dumps(resultado) if resultado is not None else None)
+
+    def fail(self, job_id: str, error: str):
+        self._update(job_id, stage=STAGE_FAILED, error=error)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return self._row_to_dict(row)
+
+    def recover(self) -> int:
+        # Devuelve a la cola los trabajos interrumpidos por un reinicio
+        now = datetime.now().isoformat()
+        placeholders = ', '.join('?' for _ in STAGES_EN_CURSO)
+        with self._lock:
+            self._conn.execute(
+                f'UPDATE jobs SET stage = ?, error = ?, updated_at = ? '
+                f'WHERE stage IN ({placeholders}) AND attempts >= ?',
+                (STAGE_FAILED, 'Se agotaron los intentos', now, *STAGES_EN_CURSO, self.max_attempts)
+            )
+            cursor = self._conn.execute(
+                f'UPDATE jobs SET stage = ?, updated_at = ? WHERE stage IN ({placeholders})',
+                (STAGE_PENDING, now, *STAGES_EN_CURSO)
+            )
+        return cursor.rowcount
+
+    def _update(self, job_id: str, **fields):
+        fields['updated_at'] = datetime.now().isoformat()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._lock:
+            self._conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    @staticmethod
+    def _row_to_dict(row) -> dict:
+        job = dict(row)
+        job['tipos'] = json.loads(job['tipos'])
+        job['resultado'] = json.loads(job['resultado']) if job['resultado'] else None
+        job['grupo'] = json.loads(job['grupo']) if job.get('grupo') else None
+        return job
+
+
+class JobWorkerPool:
+    """
+    Conjunto acotado de hilos que consumen la cola y ejecutan cada trabajo.
+
+    El handler recibe el trabajo y una funcion para reportar la etapa actual, y
+    devuelve el resultado que se guarda al terminar.
+    """
+
+    def __init__(self, queue: JobQueue, handler: Callable[[dict, Callable[[str], None]], Optional[dict]],
+                 workers: int = 2, poll_interval: float = 5.0):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recovered = self.queue.recover()
+        if recovered:
+            logger.info(f"Trabajos recuperados tras reinicio: {recovered}")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        self.queue.wake_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self.queue.wait_for_job(self.poll_interval)
+                continue
+            self._process(job)
+
+    def _process(self, job: dict):
+        job_id = job['id']
+
+        def on_stage(stage: str):
+            self.queue.update_stage(job_id, stage)
+
+        # Los logs emitidos mientras corre el trabajo llevan su id
+        token = log_config.job_id_var.set(job_id)
+        metrics.JOBS_IN_FLIGHT.inc()
+        try:
+            with metrics.stage('job'):
+                resultado = self.handler(job, on_stage)
+            self.queue.complete(job_id, resultado)
+        except Exception as e:
+            logger.exception(f"Error ejecutando el trabajo {job_id}")
+            self.queue.fail(job_id, str(e))
+        finally:
+            metrics.JOBS_IN_FLIGHT.dec()
+            log_config.job_id_var.reset(token)
+
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+job_queue = JobQueue(
+    os.path.join(project_root, os.getenv('JOBS_DB_PATH', 'data/jobs.db')),
+    max_attempts=int(os.getenv('JOBS_MAX_ATTEMPTS', '3'))
+)
+_pool: Optional[JobWorkerPool] = None
+
+
+def start_workers(handler: Callable[[dict, Callable[[str], None]], Optional[dict]]):
+    global _pool
+    if _pool is None:
+        _pool = JobWorkerPool(job_queue, handler, workers=int(os.getenv('JOBS_WORKERS', '2')))
+        _pool.start()
+
+
+def stop_workers():
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
@@ -0,0 +1,307 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from PIL import Image
+
+from models import Analisis, Parcela
+from services.storage import get_absolute_path, get_storage_path
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Analisis mas recientes por parcela y tipo que conservan las imagenes a resolucion completa
+FULL_KEEP = int(os.getenv('LIFECYCLE_FULL_KEEP', '3'))
+# Los siguientes se reducen; los mas antiguos se empaquetan en el archivo de la parcela
+REDUCED_KEEP = int(os.getenv('LIFECYCLE_REDUCED_KEEP', '10'))
+REDUCED_MAX_SIZE = int(os.getenv('LIFECYCLE_REDUCED_MAX_SIZE', '256'))
+# Carpetas sin analisis mas recientes que esto pueden ser de un analisis en curso
+ORPHAN_GRACE_SECONDS = int(os.getenv('LIFECYCLE_ORPHAN_GRACE_SECONDS', str(24 * 3600)))
+
+# Archivo zip por parcela con las imagenes (reducidas) de los analisis antiguos
+ARCHIVO = 'archivo.zip'
+# Las imagenes reducidas se guardan con otro nombre: las URLs de las imagenes se sirven
+# como inmutables, asi que el contenido de una ruta nunca cambia
+SUFIJO_REDUCIDA = '.min.png'
+
+
+def ruta_reducida(ruta: str) -> str:
+    if ruta.endswith(SUFIJO_REDUCIDA):
+        return ruta
+    return f"{os.path.splitext(ruta)[0]}{SUFIJO_REDUCIDA}"
+
+
+def _rutas(analisis: Analisis) -> List[str]:
+    rutas = [imagen.ruta for imagen in analisis.imagenes]
+    if analisis.indices:
+        rutas.extend(indice.ruta for indice in analisis.indices.values())
+    return rutas
+
+
+def _reducir_imagen(src: str, dst: str):
+    # Se escribe un archivo nuevo: la original puede ser un hard link a la cache de imagenes
+    tmp_path = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.tmp")
+    with Image.open(src) as image:
+        image.thumbnail((REDUCED_MAX_SIZE, REDUCED_MAX_SIZE), Image.LANCZOS)
+        image.save(tmp_path, format='PNG', optimize=True)
+    os.replace(tmp_path, dst)
+
+
+def reducir_analisis(usuario_id: str, parcela_id: str, analisis: Analisis) -> bool:
+    """
+    Reemplaza las imagenes del analisis por versiones reducidas y actualiza sus rutas.
+    Devuelve True si hubo cambios.
+    """
+    reemplazos = {}
+    for ruta in _rutas(analisis):
+        nueva = ruta_reducida(ruta)
+        if nueva == ruta:
+            continue
+        if os.path.exists(get_absolute_path(ruta)):
+            _reducir_imagen(get_absolute_path(ruta), get_absolute_path(nueva))
+        elif not os.path.exists(get_absolute_path(nueva)):
+            continue
+        reemplazos[ruta] = nueva
+    if not reemplazos:
+        return False
+
+    for imagen in analisis.imagenes:
+        imagen.ruta = reemplazos.get(imagen.ruta, imagen.ruta)
+    for indice in (analisis.indices or {}).values():
+        indice.ruta = reemplazos.get(indice.ruta, indice.ruta)
+    campos = {'imagenes': [imagen.dict() for imagen in analisis.imagenes]}
+    if analisis.indices:
+        campos['indices'] = {nombre: indice.dict() for nombre, indice in analisis.indices.items()}
+    Analisis.update_fields(usuario_id, parcela_id, analisis.id, campos)
+
+    # Las originales se borran solo cuando el analisis ya apunta a las reducidas
+    for ruta in reemplazos:
+        if os.path.exists(get_absolute_path(ruta)):
+            os.remove(get_absolute_path(ruta))
+    return True
+
+
+def _archivar(usuario_id: str, parcela_id: str, archivar: List[Analisis], vigentes: set) -> int:
+    # Reescribe el zip de la parcela con las entradas de los analisis que siguen existiendo
+    # mas las carpetas nuevas a archivar; se reemplaza de forma atomica para no cortar lecturas
+    zip_path = get_absolute_path(os.path.join(usuario_id, parcela_id, ARCHIVO))
+    carpetas = [analisis for analisis in archivar
+                if os.path.isdir(get_absolute_path(os.path.join(usuario_id, parcela_id, analisis.id)))]
+    existentes = []
+    if os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path) as archivo:
+            existentes = archivo.namelist()
+    descartadas = [nombre for nombre in existentes if nombre.split('/', 1)[0] not in vigentes]
+    if not carpetas and not descartadas:
+        return 0
+
+    tmp_path = f"{zip_path}.tmp"
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as destino:
+        if existentes:
+            with zipfile.ZipFile(zip_path) as origen:
+                for nombre in existentes:
+                    if nombre not in descartadas:
+                        destino.writestr(origen.getinfo(nombre), origen.read(nombre))
+        for analisis in carpetas:
+            for ruta in _rutas(analisis):
+                filepath = get_absolute_path(ruta)
+                if os.path.exists(filepath):
+                    destino.write(filepath, f"{analisis.id}/{os.path.basename(ruta)}")
+    os.replace(tmp_path, zip_path)
+
+    for analisis in carpetas:
+        shutil.rmtree(get_absolute_path(os.path.join(usuario_id, parcela_id, analisis.id)), ignore_errors=True)
+    return len(carpetas)
+
+
+def leer_archivada(ruta: str) -> Optional[bytes]:
+    # Contenido de una imagen que ya se movio al archivo de su parcela
+    partes = ruta.replace(os.sep, '/').split('/')
+    if len(partes) != 4:
+        return None
+    usuario_id, parcela_id, analisis_id, archivo = partes
+    zip_path = get_absolute_path(os.path.join(usuario_id, parcela_id, ARCHIVO))
+    try:
+        with zipfile.ZipFile(zip_path) as zip_file:
+            return zip_file.read(f"{analisis_id}/{archivo}")
+    except (FileNotFoundError, KeyError):
+        return None
+
+
+def borrar_imagenes(usuario_id: str, parcela_id: str, analisis_id: Optional[str] = None):
+    """
+    Borra la carpeta de imagenes de un analisis o de una parcela completa (con su archivo).
+    Las entradas de un analisis ya archivado se descartan en la siguiente pasada.
+    """
+    partes = [usuario_id, parcela_id] + ([analisis_id] if analisis_id else [])
+    path = get_absolute_path(os.path.join(*partes))
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"Imagenes borradas: {os.path.join(*partes)}")
+
+
+def _antigua(path: str, ahora: float) -> bool:
+    return ahora - os.stat(path).st_mtime > ORPHAN_GRACE_SECONDS
+
+
+def aplicar_politica(usuario_id: str, parcela_id: str) -> Dict[str, int]:
+    """
+    Aplica la politica de retencion a una parcela: resolucion completa para los FULL_KEEP
+    analisis mas recientes de cada tipo, imagenes reducidas para los REDUCED_KEEP
+    siguientes y el resto al archivo de la parcela. Borra las carpetas huerfanas.
+    """
+    resultado = {'reducidos': 0, 'archivados': 0, 'huerfanos': 0}
+    parcela_path = get_absolute_path(os.path.join(usuario_id, parcela_id))
+    ahora = time.time()
+    try:
+        parcela = Parcela.get_by_id(usuario_id, parcela_id)
+    except ValueError:
+        parcela = None
+    if parcela is None:
+        if _antigua(parcela_path, ahora):
+            shutil.rmtree(parcela_path, ignore_errors=True)
+            resultado['huerfanos'] += 1
+        return resultado
+
+    analisis = Analisis.get_all(usuario_id, parcela_id)
+    por_tipo = defaultdict(list)
+    for item in analisis:
+        por_tipo[item.tipo].append(item)
+
+    archivar = []
+    for items in por_tipo.values():
+        items.sort(key=lambda item: item.fecha or datetime.min, reverse=True)
+        for posicion, item in enumerate(items):
+            if posicion < FULL_KEEP:
+                continue
+            if reducir_analisis(usuario_id, parcela_id, item):
+                resultado['reducidos'] += 1
+            if posicion >= FULL_KEEP + REDUCED_KEEP:
+                archivar.append(item)
+
+    vigentes = {item.id for item in analisis}
+    resultado['archivados'] = _archivar(usuario_id, parcela_id, archivar, vigentes)
+
+    for entry in os.scandir(parcela_path):
+        if entry.is_dir() and entry.name not in vigentes and _antigua(entry.path, ahora):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            resultado['huerfanos'] += 1
+    return resultado
+
+
+def ejecutar() -> Dict[str, int]:
+    # Una pasada sobre todas las parcelas con imagenes en disco
+    totales = defaultdict(int)
+    storage_path = get_storage_path()
+    if not os.path.isdir(storage_path):
+        return dict(totales)
+    for usuario in os.scandir(storage_path):
+        if not usuario.is_dir():
+            continue
+        for parcela in os.scandir(usuario.path):
+            if not parcela.is_dir():
+                continue
+            try:
+                for clave, valor in aplicar_politica(usuario.name, parcela.name).items():
+                    totales[clave] += valor
+            except Exception:
+                logger.exception(f"Error aplicando la politica de retencion a {usuario.name}/{parcela.name}")
+    logger.info(f"Retencion de imagenes: {dict(totales)}")
+    return dict(totales)
+
+
+def _uso_carpeta(path: str) -> Dict[str, int]:
+    uso = {'bytes': 0, 'archivos': 0}
+    for raiz, _, archivos in os.walk(path):
+        for archivo in archivos:
+            uso['bytes'] += os.lstat(os.path.join(raiz, archivo)).st_size
+            uso['archivos'] += 1
+    return uso
+
+
+def _carpeta_usuario(usuario_id: str) -> str:
+    # El id llega desde la URL: no puede salir de la carpeta de almacenamiento
+    if not usuario_id or usuario_id in ('.', '..') or '/' in usuario_id or os.sep in usuario_id:
+        raise ValueError("Usuario no válido")
+    raiz = os.path.realpath(get_storage_path())
+    user_path = os.path.realpath(get_absolute_path(usuario_id))
+    if os.path.dirname(user_path) != raiz:
+        raise ValueError("Usuario no válido")
+    return user_path
+
+
+def uso_disco(usuario_id: str) -> dict:
+    """
+    Espacio ocupado por las imagenes de un usuario, en total y por parcela. Los hard links
+    compartidos con la cache de imagenes se cuentan en cada analisis que los usa.
+    """
+    user_path = _carpeta_usuario(usuario_id)
+    parcelas = {}
+    if os.path.isdir(user_path):
+        for parcela in os.scandir(user_path):
+            if not parcela.is_dir(follow_symlinks=False):
+                continue
+            uso = _uso_carpeta(parcela.path)
+            zip_path = os.path.join(parcela.path, ARCHIVO)
+            uso['analisis'] = sum(1 for entry in os.scandir(parcela.path) if entry.is_dir())
+            uso['archivado_bytes'] = os.path.getsize(zip_path) if os.path.exists(zip_path) else 0
+            parcelas[parcela.name] = uso
+    return {
+        'usuario_id': usuario_id,
+        'bytes': sum(uso['bytes'] for uso in parcelas.values()),
+        'archivos': sum(uso['archivos'] for uso in parcelas.values()),
+        'parcelas': parcelas,
+    }
+
+
+class LifecycleManager:
+    """
+    Aplica periodicamente la politica de retencion de imagenes en un hilo aparte.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='lifecycle-imagenes', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                ejecutar()
+            except Exception:
+                logger.exception("Error aplicando la politica de retencion de imagenes")
+
+
+_manager: Optional[LifecycleManager] = None
+
+
+def start_lifecycle():
+    global _manager
+    if _manager is None and os.getenv('LIFECYCLE_ENABLED', 'false').lower() == 'true':
+        _manager = LifecycleManager(interval=float(os.getenv('LIFECYCLE_INTERVAL_SECONDS', str(6 * 3600))))
+        _manager.start()
+
+
+def stop_lifecycle():
+    global _manager
+    if _manager is not None:
+        _manager.stop()
+        _manager = None
@@ -0,0 +1,109 @@
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Intervalos pensados para etapas que van de milisegundos (escrituras) a minutos (Sentinel/OpenAI)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    'farmai_stage_seconds', 'Duracion de cada etapa de la ejecucion de un analisis', ['stage'], buckets=BUCKETS
+)
+FIRESTORE_SECONDS = Histogram(
+    'farmai_firestore_seconds', 'Duracion de cada operacion de los modelos contra Firestore', ['operation'],
+    buckets=BUCKETS
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'farmai_http_request_seconds',
+    'Duracion de las peticiones al API por ruta; en las respuestas streaming (SSE) solo hasta '
+    'enviar los encabezados, no el cuerpo', ['method', 'route', 'status'],
+    buckets=BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge('farmai_http_requests_in_flight', 'Peticiones al API en curso')
+JOBS_IN_FLIGHT = Gauge('farmai_jobs_in_flight', 'Trabajos de analisis en ejecucion en los workers')
+BYTES_DOWNLOADED = Counter('farmai_bytes_downloaded_total', 'Bytes descargados de servicios externos', ['source'])
+BYTES_STORED = Counter('farmai_bytes_stored_total', 'Bytes de imagenes escritos en disco')
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def firestore_timed(operation: str):
+    # Decorador para los metodos de los modelos, sincronos o async
+    histogram = FIRESTORE_SECONDS.labels(operation)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class CacheCollector:
+    """
+    Expone los contadores de las caches (imagenes, evaluaciones, espejo de Firestore, series
+    y catalogo)
+    leyendo sus `stats()` en cada scrape.
+    """
+
+    def describe(self):
+        # Sin describe() el registro llamaria a collect() al importar este modulo
+        return [
+            CounterMetricFamily('farmai_cache_hits', 'Consultas resueltas por la cache', labels=['cache']),
+            CounterMetricFamily('farmai_cache_misses', 'Consultas no resueltas por la cache', labels=['cache']),
+            GaugeMetricFamily('farmai_cache_hit_rate', 'Proporcion de aciertos de la cache', labels=['cache']),
+        ]
+
+    def collect(self):
+        # Importes diferidos: las caches importan modulos que a su vez usan este
+        from services import catalog
+        from services.evaluation_cache import evaluation_cache
+        from services.imagery_cache import imagery_cache
+        from services.mirror import mirror
+        from services.series import series_store
+
+        hits = CounterMetricFamily('farmai_cache_hits', 'Consultas resueltas por la cache', labels=['cache'])
+        misses = CounterMetricFamily('farmai_cache_misses', 'Consultas no resueltas por la cache', labels=['cache'])
+        hit_rate = GaugeMetricFamily('farmai_cache_hit_rate', 'Proporcion de aciertos de la cache', labels=['cache'])
+        for name, cache in (('imagery', imagery_cache), ('evaluation', evaluation_cache), ('mirror', mirror),
+                            ('series', series_store), ('catalog', catalog.catalog)):
+            if cache is None:
+                continue
+            stats = cache.stats()
+            hits.add_metric([name], stats['hits'])
+            misses.add_metric([name], stats['misses'])
+            hit_rate.add_metric([name], stats['hit_rate'])
+        yield hits
+        yield misses
+        yield hit_rate
+
+
+REGISTRY.register(CacheCollector())
+
+
+def render():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
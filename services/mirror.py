@@ -0,0 +1,235 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from services.firebase import db, prefix
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    """
+    Copia en memoria de un documento y/o una coleccion, mantenida por listeners
+    `on_snapshot`. Queda lista cuando todos sus listeners entregaron la primera foto.
+    """
+
+    def __init__(self, listeners: int):
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.watches = []
+        self.doc: Optional[dict] = None
+        self.docs: Dict[str, dict] = {}
+        self._pending = listeners
+        self._closed = False
+
+    def watch(self, watch):
+        # Los listeners se crean fuera del lock global: si la entrada ya se desalojo
+        # mientras tanto, el listener se cierra en el acto
+        with self.lock:
+            if not self._closed:
+                self.watches.append(watch)
+                return
+        watch.unsubscribe()
+
+    def _mark_loaded(self):
+        with self.lock:
+            self._pending -= 1
+            if self._pending <= 0:
+                self.ready.set()
+
+    def on_document(self, snapshots, changes, read_time):
+        snapshot = snapshots[0] if snapshots else None
+        with self.lock:
+            self.doc = snapshot.to_dict() if snapshot is not None and snapshot.exists else None
+        if not self.ready.is_set():
+            self._mark_loaded()
+
+    def on_collection(self, snapshots, changes, read_time):
+        docs = {snapshot.id: snapshot.to_dict() for snapshot in snapshots}
+        with self.lock:
+            self.docs = docs
+        if not self.ready.is_set():
+            self._mark_loaded()
+
+    def close(self):
+        with self.lock:
+            self._closed = True
+            watches, self.watches = self.watches, []
+        for watch in watches:
+            try:
+                watch.unsubscribe()
+            except Exception:
+                logger.exception("Error cerrando listener de Firestore")
+
+
+class FirestoreMirror:
+    """
+    Cache de lectura de usuarios, parcelas y analisis de los usuarios activos.
+
+    Por cada usuario se escucha su documento y su subcoleccion de parcelas, y por cada
+    parcela consultada su subcoleccion de analisis. Las escrituras locales se aplican
+    en el acto y los listeners traen los cambios hechos desde otras instancias. Los
+    usuarios y parcelas menos usados se desalojan (y dejan de escucharse) al superar
+    los limites.
+    """
+
+    def __init__(self, max_users: int, max_parcelas: int, timeout: float, cooldown: float = 300.0):
+        self.max_users = max_users
+        self.max_parcelas = max_parcelas
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._users: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._analisis: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        # Hasta este instante (monotonic) no se crean listeners nuevos: se lee directo de Firestore
+        self._pausa_hasta = 0.0
+
+    def _fallo(self, motivo: str):
+        # Si los listeners no responden, no volver a suscribir (y esperar) en cada lectura
+        with self._lock:
+            self._pausa_hasta = time.monotonic() + self.cooldown
+        logger.warning(f"{motivo}: espejo de Firestore en pausa por {self.cooldown:.0f} s")
+
+    def _get(self, entries: OrderedDict, key, limit: int, subscribe, listeners: int,
+             wait: bool) -> Optional[_Entry]:
+        evicted = []
+        with self._lock:
+            entry = entries.get(key)
+            nuevo = entry is None
+            if not nuevo:
+                entries.move_to_end(key)
+            elif time.monotonic() < self._pausa_hasta:
+                self.misses += 1
+                return None
+            else:
+                entry = _Entry(listeners)
+                entries[key] = entry
+                while len(entries) > limit:
+                    evicted.append(entries.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        if nuevo:
+            try:
+                subscribe(entry)
+            except Exception:
+                logger.exception("Error creando listeners de Firestore")
+                self._descartar(entries, key, entry)
+                self._fallo("No se pudieron crear los listeners")
+                self.misses += 1
+                return None
+
+        if not wait:
+            # Desde el event loop no se bloquea: si aun no llego la primera foto se lee
+            # de Firestore y el listener queda suscrito para las siguientes consultas
+            if entry.ready.is_set() and not nuevo:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+        if not entry.ready.wait(self.timeout):
+            # El listener no respondio a tiempo: descartarlo y leer directo de Firestore
+            if self._descartar(entries, key, entry):
+                self._fallo("Listener de Firestore sin respuesta")
+            self.misses += 1
+            return None
+        if nuevo:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _descartar(self, entries: OrderedDict, key, entry: _Entry) -> bool:
+        with self._lock:
+            propia = entries.get(key) is entry
+            if propia:
+                del entries[key]
+        entry.close()
+        return propia
+
+    def user(self, usuario_id: str, wait: bool = True) -> Optional[_Entry]:
+        def subscribe(entry: _Entry):
+            user_ref = db.document(f'{prefix}users/{usuario_id}')
+            entry.watch(user_ref.on_snapshot(entry.on_document))
+            entry.watch(user_ref.collection('parcelas').on_snapshot(entry.on_collection))
+        return self._get(self._users, usuario_id, self.max_users, subscribe, 2, wait)
+
+    def analisis(self, usuario_id: str, parcela_id: str, wait: bool = True) -> Optional[_Entry]:
+        def subscribe(entry: _Entry):
+            analisis_ref = db.collection(f'{prefix}users/{usuario_id}/parcelas/{parcela_id}/analisis')
+            entry.watch(analisis_ref.on_snapshot(entry.on_collection))
+        return self._get(self._analisis, (usuario_id, parcela_id), self.max_parcelas, subscribe, 1, wait)
+
+    # Escrituras locales: se aplican solo si el usuario/parcela ya esta en memoria
+
+    def _cached(self, entries: OrderedDict, key) -> Optional[_Entry]:
+        with self._lock:
+            entry = entries.get(key)
+        return entry if entry is not None and entry.ready.is_set() else None
+
+    def user_saved(self, usuario_id: str, data: Optional[dict]):
+        entry = self._cached(self._users, usuario_id)
+        if entry:
+            with entry.lock:
+                entry.doc = data
+                if data is None:
+                    entry.docs = {}
+
+    @staticmethod
+    def _apply(entry: _Entry, doc_id: str, data: Optional[dict], merge: bool):
+        with entry.lock:
+            if data is None:
+                entry.docs.pop(doc_id, None)
+            elif merge:
+                # Igual que set(merge=True)/update(): conservar los campos no escritos
+                entry.docs[doc_id] = {**entry.docs.get(doc_id, {}), **data}
+            else:
+                entry.docs[doc_id] = data
+
+    def parcela_saved(self, usuario_id: str, parcela_id: str, data: Optional[dict], merge: bool = False):
+        entry = self._cached(self._users, usuario_id)
+        if entry:
+            self._apply(entry, parcela_id, data, merge)
+
+    def analisis_saved(self, usuario_id: str, parcela_id: str, analisis_id: str, data: Optional[dict],
+                       merge: bool = False):
+        entry = self._cached(self._analisis, (usuario_id, parcela_id))
+        if entry:
+            self._apply(entry, analisis_id, data, merge)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._users.values()) + list(self._analisis.values())
+            self._users.clear()
+            self._analisis.clear()
+        for entry in entries:
+            entry.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'users': len(self._users),
+            'parcelas': len(self._analisis),
+        }
+
+
+mirror: Optional[FirestoreMirror] = None
+# Opcional: mantiene listeners abiertos contra Firestore por cada usuario y parcela activos
+if os.getenv('MIRROR_ENABLED', 'false').lower() == 'true':
+    mirror = FirestoreMirror(
+        max_users=int(os.getenv('MIRROR_MAX_USERS', '500')),
+        max_parcelas=int(os.getenv('MIRROR_MAX_PARCELAS', '1000')),
+        timeout=float(os.getenv('MIRROR_TIMEOUT_SECONDS', '5')),
+        cooldown=float(os.getenv('MIRROR_COOLDOWN_SECONDS', '300'))
+    )
@@ -1,20 +1,28 @@
 import os
-from typing import List
+import time
+from typing import Callable, List, Optional
 from dotenv import load_dotenv
 from openai import OpenAI
 from models import ImagenSatelital
+import requests
+from services import http_client, image_prep, metrics
+from services.evaluation_cache import evaluation_cache
+from services.ratelimit import openai_limiter
+from services.storage import file_sha256, get_absolute_path
 
 load_dotenv()
 client = OpenAI(
     api_key=os.getenv('OPENAI_API_KEY'),
     organization=os.getenv('OPENAI_ORG_ID'),
     project=os.getenv('OPENAI_PROJECT_ID'),
+    # Misma politica de tiempos y reintentos que el resto de llamadas salientes
+    timeout=http_client.READ_TIMEOUT,
+    max_retries=http_client.MAX_RETRIES,
 )
 
-def analyze_images(diagnosis_type: str, images: List[ImagenSatelital]) -> str:
-    url = os.getenv('CDN_URL' or 'http://cdn.vakajose.live')
-    image_paths = [f"{url}/{img.ruta}" for img in images]
-
+def analyze_images(diagnosis_type: str, images: List[ImagenSatelital],
+                   on_delta: Optional[Callable[[str], None]] = None) -> str:
+    # Con on_delta la respuesta se pide en streaming y cada fragmento se entrega al llegar
     msgInstructions = _get_instructions(diagnosis_type)
     messages = [
     {
@@ -25,22 +33,28 @@ def analyze_images(diagnosis_type: str, images: List[ImagenSatelital]) -> str:
     }
   ]
 
-    # Adding each image URL to the messages list
-    for path in image_paths:
-        messages[0]["content"].append({
-          "type": "image_url",
-          "image_url": {
-            "url": path,
-          },
-        })
+    params = {"max_tokens": 2000}
+    if image_prep.inline_enabled():
+        # Bandas reducidas desde el almacenamiento local, enviadas inline en base64
+        messages[0]["content"].extend(image_prep.preparar_imagenes(diagnosis_type, images))
+        params["imagenes"] = image_prep.firma(diagnosis_type)
+    else:
+        url = os.getenv('CDN_URL' or 'http://cdn.vakajose.live')
+        image_paths = [f"{url}/{img.ruta}" for img in images]
 
-    response = client.chat.completions.create(
-        model=os.getenv('OPENAI_MODEL') or 'gpt-4o-mini',
-        messages=messages,
-        max_tokens=2000,
-    )
+        # Adding each image URL to the messages list
+        for path in image_paths:
+            messages[0]["content"].append({
+              "type": "image_url",
+              "image_url": {
+                "url": path,
+              },
+            })
 
-    return response.choices[0].message.content.strip()
+    model = os.getenv('OPENAI_MODEL') or 'gpt-4o-mini'
+    # Las imagenes estan en el almacenamiento local: se identifican por el hash de su contenido
+    image_hashes = [file_sha256(get_absolute_path(img.ruta)) for img in images]
+    return _cached_completion(model, msgInstructions, image_hashes, messages, on_delta=on_delta, **params)
 
 
 def _get_instructions(diagnosis_type):
@@ -73,11 +87,72 @@ def analyze_images_b(image_paths: List[str]) -> str:
           },
         })
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        max_tokens=1000,
-    )
-    
-    #return response.choices[0].message['content'].strip()
-    return response.choices[0].message.content.strip()
\ No newline at end of file
+    # Imagenes remotas: la clave usa la URL y la version que informa el CDN (sin descargar
+    # las imagenes); si alguna no tiene version no se usa la cache
+    versiones = [_url_version(path) for path in image_paths]
+    image_hashes = versiones if all(versiones) else None
+    return _cached_completion("gpt-4o", msgInstructions, image_hashes, messages, max_tokens=1000)
+
+
+def _url_version(url: str) -> Optional[str]:
+    # URL mas ETag o Last-Modified segun un HEAD; None si el CDN falla o no informa ninguno
+    try:
+        response = http_client.request('HEAD', url, max_retries=0, allow_redirects=True)
+    except requests.RequestException:
+        return None
+    with response:
+        version = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if response.status_code != 200 or not version:
+            return None
+    return f"{url}#{version}"
+
+
+def _cached_completion(model: str, prompt: str, image_hashes: Optional[List[str]], messages, max_tokens: int,
+                       on_delta: Optional[Callable[[str], None]] = None, **key_params) -> str:
+    streamed = False
+
+    def completion():
+        nonlocal streamed
+        openai_limiter.acquire()
+        if on_delta:
+            streamed = True
+            return _streamed_completion(model, messages, max_tokens, on_delta)
+        with metrics.stage('openai'):
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+            )
+        #return response.choices[0].message['content'].strip()
+        return response.choices[0].message.content.strip()
+
+    # Sin hashes de las imagenes no hay clave confiable: se consulta sin cache
+    if not evaluation_cache or image_hashes is None:
+        return completion()
+    key = evaluation_cache.build_key(model, prompt, image_hashes, max_tokens=max_tokens, **key_params)
+    evaluacion = evaluation_cache.get_or_compute(key, completion)
+    if on_delta and not streamed and evaluacion:
+        # Acierto de cache (o de otra peticion en curso): el texto completo en un solo fragmento
+        on_delta(evaluacion)
+    return evaluacion
+
+
+def _streamed_completion(model: str, messages, max_tokens: int, on_delta: Callable[[str], None]) -> str:
+    partes = []
+    start = time.perf_counter()
+    with metrics.stage('openai'):
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        with stream:
+            for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if not partes:
+                    metrics.STAGE_SECONDS.labels('openai_first_token').observe(time.perf_counter() - start)
+                partes.append(chunk.choices[0].delta.content)
+                on_delta(chunk.choices[0].delta.content)
+    return ''.join(partes).strip()
@@ -0,0 +1,227 @@
+import logging
+from datetime import datetime
+from functools import reduce
+from typing import Callable, List, Optional, Tuple
+
+from models import Analisis, Parcela, ImagenSatelital
+from services import sentinelhub, openai, indices, metrics, catalog, geometry, spatial
+from services.series import series_store
+from services.jobs import STAGE_FETCHING, STAGE_STORING, STAGE_EVALUATING
+
+logger = logging.getLogger(__name__)
+
+
+def _obtener_parcela(usuario_id: str, parcela_id: str) -> Parcela:
+    parcela = Parcela.get_by_id(usuario_id, parcela_id)
+    if not parcela:
+        raise ValueError("Parcela no existe")
+    return parcela
+
+
+class SinDatosNuevos(Exception):
+    """
+    No hay escenas nuevas en el catalogo desde el ultimo analisis de los tipos pedidos, asi
+    que no se descargan imagenes ni se consulta a OpenAI. `ultimos` son los analisis vigentes.
+    """
+
+    def __init__(self, tipos: List[str], fecha_adquisicion: Optional[datetime], ultimos: List[Analisis]):
+        desde = f" desde la escena del {fecha_adquisicion.date().isoformat()}" if fecha_adquisicion else ""
+        super().__init__(f"Sin datos nuevos para {', '.join(tipos)}{desde}")
+        self.tipos = tipos
+        self.fecha_adquisicion = fecha_adquisicion
+        self.ultimos = ultimos
+
+
+def _ultima_adquisicion(polygon_coords) -> Tuple[bool, Optional[datetime]]:
+    # Pre-chequeo contra el catalogo (con cache). Si no hay catalogo o falla, se descarga
+    # igual que antes y el analisis queda sin fecha de adquisicion
+    if catalog.catalog is None:
+        return False, None
+    try:
+        return True, catalog.catalog.ultima_adquisicion(polygon_coords)
+    except Exception:
+        logger.exception("Error consultando el catalogo de Sentinel Hub, se descarga sin pre-chequeo")
+        return False, None
+
+
+def _tipos_con_datos(usuario_id: str, parcela_id: str, tipos: List[str],
+                     adquisicion: Optional[datetime]) -> Tuple[List[str], List[Analisis]]:
+    # Tipos cuyo ultimo analisis es anterior a la escena mas reciente, y los ultimos
+    # analisis de los que no tienen novedades
+    con_datos = []
+    ultimos = []
+    for tipo in tipos:
+        ultimo = Analisis.get_last_analisis_by_tipo(usuario_id, parcela_id, tipo)
+        if adquisicion is None or (ultimo and ultimo.fecha_adquisicion and ultimo.fecha_adquisicion >= adquisicion):
+            if ultimo:
+                ultimos.append(ultimo)
+        else:
+            con_datos.append(tipo)
+    return con_datos, ultimos
+
+
+def _preflight(usuario_id: str, parcela: Parcela, tipos: List[str],
+               forzar: bool) -> Tuple[List[str], Optional[datetime]]:
+    consultado, adquisicion = _ultima_adquisicion(sentinelhub.convert_points_to_coordinates(parcela.ubicacion))
+    if not consultado or forzar:
+        return tipos, adquisicion
+    con_datos, ultimos = _tipos_con_datos(usuario_id, parcela.id, tipos, adquisicion)
+    if not con_datos:
+        raise SinDatosNuevos(tipos, adquisicion, ultimos)
+    if len(con_datos) < len(tipos):
+        logger.info(f"Sin datos nuevos para {usuario_id}/{parcela.id}: "
+                    f"{', '.join(tipo for tipo in tipos if tipo not in con_datos)}")
+    return con_datos, adquisicion
+
+
+def ejecutar_analisis(usuario_id: str, parcela_id: str, tipo: str,
+                      on_stage: Optional[Callable[[str], None]] = None, forzar: bool = False,
+                      on_delta: Optional[Callable[[str], None]] = None) -> Optional[Analisis]:
+    #obtengo datos de parcela
+    parcela = _obtener_parcela(usuario_id, parcela_id)
+    #si no hay escenas nuevas desde el ultimo analisis se corta aca (SinDatosNuevos)
+    _, adquisicion = _preflight(usuario_id, parcela, [tipo], forzar)
+
+    #busco las imagenes en funcion del tipo de analisis y la parcela, y se guardan en la ruta indicada
+    if on_stage:
+        on_stage(STAGE_FETCHING)
+    sentinel_hub_service = sentinelhub.SentinelHubService()
+    imagenes, analisis_id = sentinel_hub_service.fetch_images(parcela, tipo)
+    if not imagenes:
+        return None
+    return _completar_analisis(usuario_id, parcela_id, tipo, imagenes, analisis_id, on_stage, adquisicion,
+                               on_delta)
+
+
+def ejecutar_analisis_multiple(usuario_id: str, parcela_id: str, tipos: List[str],
+                               on_stage: Optional[Callable[[str], None]] = None,
+                               forzar: bool = False) -> List[Analisis]:
+    parcela = _obtener_parcela(usuario_id, parcela_id)
+    tipos, adquisicion = _preflight(usuario_id, parcela, tipos, forzar)
+
+    #una sola descarga para todos los tipos, repartida luego en un analisis por tipo
+    if on_stage:
+        on_stage(STAGE_FETCHING)
+    sentinel_hub_service = sentinelhub.SentinelHubService()
+    resultados = sentinel_hub_service.fetch_images_multiple(parcela, tipos)
+
+    analisis_list = []
+    for tipo, (imagenes, analisis_id) in resultados.items():
+        analisis = _completar_analisis(usuario_id, parcela_id, tipo, imagenes, analisis_id, on_stage, adquisicion)
+        if analisis:
+            analisis_list.append(analisis)
+    return analisis_list
+
+
+def ejecutar_analisis_grupo(grupo: List[dict], tipos: List[str],
+                            on_stage: Optional[Callable[[str], None]] = None) -> dict:
+    # Parcelas vecinas: una descarga por el bbox comun y un analisis por parcela y tipo.
+    # Las parcelas borradas desde que se encolo el trabajo se omiten
+    parcelas = []
+    for miembro in grupo:
+        try:
+            parcela = Parcela.get_by_id(miembro['usuario_id'], miembro['parcela_id'])
+        except ValueError:
+            parcela = None
+        if parcela:
+            parcelas.append(parcela)
+    if not parcelas:
+        return {"analisis_ids": []}
+
+    # Pre-chequeo con una sola consulta al catalogo por el bbox del cluster
+    box = reduce(spatial.union, (geometry.bbox(sentinelhub.convert_points_to_coordinates(parcela.ubicacion))
+                                 for parcela in parcelas))
+    consultado, adquisicion = _ultima_adquisicion(spatial.poligono_bbox(box))
+    pendientes = {(parcela.usuario_id, parcela.id): tipos for parcela in parcelas}
+    sin_datos = []
+    if consultado:
+        for parcela in parcelas:
+            con_datos, _ = _tipos_con_datos(parcela.usuario_id, parcela.id, tipos, adquisicion)
+            pendientes[(parcela.usuario_id, parcela.id)] = con_datos
+            sin_datos.extend(f"{parcela.usuario_id}/{parcela.id}/{tipo}" for tipo in tipos if tipo not in con_datos)
+        parcelas = [parcela for parcela in parcelas if pendientes[(parcela.usuario_id, parcela.id)]]
+    if not parcelas:
+        return {"analisis_ids": [], "sin_datos_nuevos": sin_datos}
+
+    if on_stage:
+        on_stage(STAGE_FETCHING)
+    sentinel_hub_service = sentinelhub.SentinelHubService()
+    # Se descargan los tipos pendientes en alguna parcela y se guardan solo los de cada una
+    tipos = [tipo for tipo in tipos if any(tipo in pendientes[(parcela.usuario_id, parcela.id)]
+                                           for parcela in parcelas)]
+    resultados = sentinel_hub_service.fetch_images_cluster(parcelas, tipos, pendientes)
+
+    # Un error en una parcela (p. ej. OpenAI) no descarta los analisis de las demas
+    analisis_ids = []
+    errores = {}
+    for (usuario_id, parcela_id), por_tipo in resultados.items():
+        for tipo, (imagenes, analisis_id) in por_tipo.items():
+            try:
+                analisis = _completar_analisis(usuario_id, parcela_id, tipo, imagenes, analisis_id, on_stage,
+                                               adquisicion)
+            except Exception as e:
+                logger.exception(f"Error completando el analisis {analisis_id} de {usuario_id}/{parcela_id}")
+                errores[f"{usuario_id}/{parcela_id}/{tipo}"] = str(e)
+                continue
+            if analisis:
+                analisis_ids.append(f"{usuario_id}/{parcela_id}/{analisis.id}")
+    resultado = {"analisis_ids": analisis_ids}
+    if sin_datos:
+        resultado["sin_datos_nuevos"] = sin_datos
+    if errores:
+        resultado["errores"] = errores
+    return resultado
+
+
+def _completar_analisis(usuario_id: str, parcela_id: str, tipo: str, imagenes: List[ImagenSatelital],
+                        analisis_id: str, on_stage: Optional[Callable[[str], None]] = None,
+                        fecha_adquisicion: Optional[datetime] = None,
+                        on_delta: Optional[Callable[[str], None]] = None) -> Optional[Analisis]:
+    def etapa(stage: str):
+        if on_stage:
+            on_stage(stage)
+
+    #calcular los indices espectrales localmente, crear el analisis y guardar en firebase
+    etapa(STAGE_STORING)
+    with metrics.stage('indices'):
+        indices_espectrales = indices.calcular_indices(tipo, imagenes)
+    nuevo_analisis = Analisis(tipo=tipo, imagenes=imagenes, id=analisis_id, indices=indices_espectrales or None,
+                              fecha_adquisicion=fecha_adquisicion)
+    nuevo_analisis.save(usuario_id, parcela_id)
+    _agregar_a_serie(usuario_id, parcela_id, nuevo_analisis)
+
+    #analizar las imagenes con OpenAI (en streaming si hay on_delta)
+    etapa(STAGE_EVALUATING)
+    respuesta = openai.analyze_images(tipo, imagenes, on_delta)
+
+    #si existe respuesta, actualizar el analisis una sola vez con el texto completo
+    if respuesta:
+        nuevo_analisis.evaluacion = respuesta
+        Analisis.update_fields(usuario_id, parcela_id, nuevo_analisis.id, {'evaluacion': respuesta})
+    return nuevo_analisis
+
+
+def _agregar_a_serie(usuario_id: str, parcela_id: str, analisis: Analisis):
+    # La serie es un dato derivado: si falla no se pierde el analisis ya guardado
+    if not series_store:
+        return
+    try:
+        series_store.agregar(usuario_id, parcela_id, analisis)
+    except Exception:
+        logger.exception(f"Error agregando el analisis {analisis.id} a la serie de {usuario_id}/{parcela_id}")
+
+
+def ejecutar_job(job: dict, on_stage: Callable[[str], None]) -> dict:
+    tipos = job['tipos']
+    if job.get('grupo'):
+        return ejecutar_analisis_grupo(job['grupo'], tipos, on_stage)
+    try:
+        if len(tipos) > 1:
+            analisis_list = ejecutar_analisis_multiple(job['usuario_id'], job['parcela_id'], tipos, on_stage)
+        else:
+            analisis = ejecutar_analisis(job['usuario_id'], job['parcela_id'], tipos[0], on_stage)
+            analisis_list = [analisis] if analisis else []
+    except SinDatosNuevos as e:
+        logger.info(str(e))
+        return {"analisis_ids": [], "sin_datos_nuevos": e.tipos}
+    return {"analisis_ids": [analisis.id for analisis in analisis_list]}
@@ -0,0 +1,42 @@
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class TokenBucket:
+    """
+    Limitador de tasa compartido entre hilos: permite `rate` llamadas por segundo
+    con rafagas de hasta `burst`. Con rate <= 0 no limita.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Un limitador por servicio externo, configurable en llamadas por minuto
+sentinelhub_limiter = TokenBucket(float(os.getenv('SENTINEL_RATE_LIMIT_PER_MINUTE', '0')) / 60,
+                                  burst=int(os.getenv('SENTINEL_RATE_LIMIT_BURST', '1')))
+openai_limiter = TokenBucket(float(os.getenv('OPENAI_RATE_LIMIT_PER_MINUTE', '0')) / 60,
+                             burst=int(os.getenv('OPENAI_RATE_LIMIT_BURST', '1')))
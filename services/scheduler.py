@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from models import Parcela
+from services import geometry, spatial
+from services.jobs import job_queue
+from services.sentinelhub import TIPOS_ANALISIS, convert_points_to_coordinates
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Cada cuantos dias se repite el monitoreo de cada tipo de analisis
+FRECUENCIA_DIAS = {
+    'maleza': 7,
+    'plagas': 7,
+    'nutricion': 30,
+}
+
+
+def proximo_monitoreo(actual: datetime, tipos: List[str], ahora: datetime) -> datetime:
+    # Avanza en pasos de la frecuencia mas corta de los tipos, hasta quedar en el futuro
+    dias = min((FRECUENCIA_DIAS.get(tipo, 7) for tipo in tipos), default=7)
+    # Las fechas se comparan como hora local sin zona, igual que se guardan
+    siguiente = actual.replace(tzinfo=None)
+    while siguiente <= ahora:
+        siguiente += timedelta(days=dias)
+    return siguiente
+
+
+def desfase(usuario_id: str, parcela_id: str, ventana: int) -> timedelta:
+    # Desfase estable por parcela dentro de la ventana, para que las parcelas que vencen a
+    # la misma hora no lleguen juntas a Sentinel Hub y OpenAI
+    if ventana <= 0:
+        return timedelta()
+    digest = hashlib.sha256(f"{usuario_id}/{parcela_id}".encode('utf-8')).digest()
+    return timedelta(seconds=int.from_bytes(digest[:8], 'big') % ventana)
+
+
+class MonitoreoScheduler:
+    """
+    Busca periodicamente las parcelas con el monitoreo vencido y encola su analisis.
+
+    La concurrencia la limita el pool de workers de la cola de trabajos, y el ritmo de
+    llamadas a cada servicio externo los limitadores de `services.ratelimit`. Las parcelas
+    vecinas que vencen en el mismo lote se encolan como un solo trabajo agrupado.
+    """
+
+    def __init__(self, interval: float, batch_size: int, spread_seconds: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.spread_seconds = spread_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='monitoreo-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("Error buscando parcelas con monitoreo vencido")
+            self._stop.wait(self.interval)
+
+    def tick(self, ahora: Optional[datetime] = None) -> int:
+        ahora = ahora or datetime.now()
+        encolados = 0
+        while True:
+            vencidas = Parcela.get_due(ahora, self.batch_size)
+            avanzadas, encolados_lote = self._encolar(vencidas, ahora)
+            encolados += encolados_lote
+            # Si el lote vino completo puede haber mas parcelas vencidas
+            if len(vencidas) < self.batch_size or not avanzadas:
+                break
+        if encolados:
+            logger.info(f"Monitoreos encolados: {encolados}")
+        return encolados
+
+    def _encolar(self, vencidas, ahora: datetime):
+        avanzadas = 0
+        pendientes = []
+        for parcela, update_time in vencidas:
+            tipos = [tipo for tipo in parcela.tipo_monitoreo or [] if tipo in TIPOS_ANALISIS]
+            siguiente = proximo_monitoreo(parcela.proximo_monitoreo, tipos, ahora)
+            # Avanzar la fecha antes de encolar: si otra instancia ya tomo la parcela, la
+            # escritura condicional falla y no se duplica el analisis
+            if not Parcela.update_proximo_monitoreo(parcela.usuario_id, parcela.id, siguiente, update_time):
+                continue
+            avanzadas += 1
+            if not tipos:
+                continue
+            pendientes.append((parcela, tipos))
+
+        encolados = 0
+        for miembros, tipos in self._agrupar(pendientes):
+            lider = miembros[0]
+            run_at = ahora + desfase(lider.usuario_id, lider.id, self.spread_seconds)
+            grupo = None
+            if len(miembros) > 1:
+                grupo = [{'usuario_id': parcela.usuario_id, 'parcela_id': parcela.id} for parcela in miembros]
+            job_queue.enqueue(lider.usuario_id, lider.id, tipos, run_at=run_at, grupo=grupo)
+            encolados += 1
+        return avanzadas, encolados
+
+    @staticmethod
+    def _agrupar(pendientes) -> List[Tuple[List[Parcela], List[str]]]:
+        # Las parcelas vecinas del mismo usuario con los mismos tipos se descargan juntas
+        # (services.spatial); el trabajo queda a nombre del usuario y su grupo no expone
+        # parcelas de otros
+        if not spatial.AGRUPAR_ENABLED:
+            return [([parcela], tipos) for parcela, tipos in pendientes]
+        grupos = []
+        por_usuario_tipos = defaultdict(dict)
+        for parcela, tipos in pendientes:
+            if len(parcela.ubicacion) < 3:
+                grupos.append(([parcela], tipos))
+                continue
+            box = geometry.bbox(convert_points_to_coordinates(parcela.ubicacion))
+            clave = (parcela.usuario_id, tuple(sorted(tipos)))
+            por_usuario_tipos[clave][(parcela.usuario_id, parcela.id)] = (parcela, box)
+        for (_, tipos), parcelas in por_usuario_tipos.items():
+            boxes = {key: box for key, (_, box) in parcelas.items()}
+            for cluster in spatial.agrupar(boxes, spatial.MAX_LADO_M, spatial.MIN_OCUPACION, spatial.MAX_PARCELAS):
+                grupos.append(([parcelas[key][0] for key in cluster], list(tipos)))
+        return grupos
+
+
+_scheduler: Optional[MonitoreoScheduler] = None
+
+
+def start_scheduler():
+    global _scheduler
+    if _scheduler is None and os.getenv('SCHEDULER_ENABLED', 'false').lower() == 'true':
+        _scheduler = MonitoreoScheduler(
+            interval=float(os.getenv('SCHEDULER_INTERVAL_SECONDS', '60')),
+            batch_size=int(os.getenv('SCHEDULER_BATCH_SIZE', '200')),
+            spread_seconds=int(os.getenv('SCHEDULER_SPREAD_SECONDS', '3600'))
+        )
+        _scheduler.start()
+
+
+def stop_scheduler():
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler.stop()
+        _scheduler = None
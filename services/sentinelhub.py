@@ -1,13 +1,56 @@
-from typing import List
-import requests
-from models import Parcela, Analisis, Punto
-from services.storage import StorageService
+from functools import reduce
+from typing import Dict, List, Optional, Tuple
+import io
+import logging
+import shutil
+import tarfile
+import threading
+import time
+import numpy as np
+from PIL import Image
+from models import Parcela, Analisis, Punto, ImagenSatelital
+from services.storage import StorageService, get_absolute_path
+from services import http_client, geometry, metrics, spatial
+from services.ratelimit import sentinelhub_limiter
+from services.imagery_cache import imagery_cache
 from dotenv import load_dotenv
 import os
 from datetime import datetime, timedelta
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+TIPOS_ANALISIS = ('maleza', 'nutricion', 'plagas')
+
+# Ventana de busqueda de imagenes y nubosidad maxima de las escenas (tambien en el catalogo)
+VENTANA_DIAS = int(os.getenv('SENTINEL_VENTANA_DIAS', '30'))
+MAX_NUBOSIDAD = int(os.getenv('SENTINEL_MAX_NUBOSIDAD', '20'))
+
+# Limites del tamaño de salida en pixeles por lado (la API de procesamiento admite hasta 2500)
+OUTPUT_MIN_PX = int(os.getenv('SENTINEL_OUTPUT_MIN_PX', '32'))
+OUTPUT_MAX_PX = int(os.getenv('SENTINEL_OUTPUT_MAX_PX', '2048'))
+
+# Banda de Sentinel-2 que contiene cada imagen devuelta, por tipo de analisis
+BANDAS_POR_TIPO = {
+    'maleza': {'blue': 'B02', 'green': 'B03', 'red': 'B04', 'nir': 'B08'},
+    'nutricion': {'red': 'B04', 'nir': 'B08', 'swir': 'B11'},
+    'plagas': {'nir': 'B08', 'swir1': 'B11', 'swir2': 'B12'},
+}
+
+# Imagenes que forman la imagen combinada (RGB) de cada tipo de analisis
+COMBINADA_POR_TIPO = {
+    'maleza': ('nir', 'red', 'green'),
+    'nutricion': ('nir', 'red', 'swir'),
+    'plagas': ('swir2', 'swir1', 'nir'),
+}
+
+EVALSCRIPTS = {
+    'maleza': "//VERSION=3\n\nfunction setup() {\n  return {\n    input: [\"B02\", \"B03\", \"B04\", \"B08\"],\n    output: [\n      { id: \"blue\", bands: 1 },\n      { id: \"green\", bands: 1 },\n      { id: \"red\", bands: 1 },\n      { id: \"nir\", bands: 1 },\n      { id: \"combined\", bands: 3 }\n    ]\n  }\n}\n\nfunction evaluatePixel(sample) {\n  let blue = sample.B02;\n  let green = sample.B03;\n  let red = sample.B04;\n  let nir = sample.B08;\n\n  return {\n    blue: [blue],\n    green: [green],\n    red: [red],\n    nir: [nir],\n    combined: [nir, red, green]\n  }\n}",
+    'nutricion': "//VERSION=3\nfunction setup() { return { input: ['B04', 'B08', 'B11'], output: [ { id: 'red', bands: 1 }, { id: 'nir', bands: 1 }, { id: 'swir', bands: 1 }, { id: 'combined', bands: 3 } ] }; }\nfunction evaluatePixel(sample) { let red = sample.B04; let nir = sample.B08; let swir = sample.B11; return { red: [red], nir: [nir], swir: [swir], combined: [nir, red, swir] }; }",
+    'plagas': "//VERSION=3\nfunction setup() { return { input: ['B08', 'B11', 'B12'], output: [ { id: 'nir', bands: 1 }, { id: 'swir1', bands: 1 }, { id: 'swir2', bands: 1 }, { id: 'combined', bands: 3 } ] }; }\nfunction evaluatePixel(sample) { let nir = sample.B08; let swir1 = sample.B11; let swir2 = sample.B12; return { nir: [nir], swir1: [swir1], swir2: [swir2], combined: [swir2, swir1, nir] }; }",
+}
+
 
 def convert_points_to_coordinates(points: List[Punto]):
     coordinates = []
@@ -18,22 +61,52 @@ def convert_points_to_coordinates(points: List[Punto]):
     return [coordinates]
 
 
+def _png(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
 def fetch_images_analisis(parcela: Parcela, tipo_analisis: str) -> Analisis:
     return Analisis()
 
 
-class SentinelHubService:
-    def __init__(self):
-        self.instance_id = os.getenv('SENTINEL_INSTANCE_ID')
-        self.client_id = os.getenv('SENTINEL_CLIENT_ID')
-        self.client_secret = os.getenv('SENTINEL_CLIENT_SECRET')
-        self.oauth_url = os.getenv('SENTINEL_OAUTH_URL')
-        self.process_url = os.getenv('SENTINEL_PROCESS_URL')
-        self.access_token = self.get_access_token()
+class TokenManager:
+    """
+    Token OAuth de Sentinel Hub compartido por todo el proceso.
 
-    def get_access_token(self):
-        print('Getting access token')
-        url = self.oauth_url
+    Se renueva antes de que expire segun el `expires_in` devuelto por el servidor,
+    y si varias peticiones lo necesitan a la vez solo una hace la renovacion.
+    """
+
+    def __init__(self, oauth_url: str, client_id: str, client_secret: str, refresh_margin: float = 60.0):
+        self.oauth_url = oauth_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._access_token: Optional[str] = None
+        self._refresh_at = 0.0
+
+    def get_token(self) -> str:
+        token = self._access_token
+        if token and time.monotonic() < self._refresh_at:
+            return token
+        with self._lock:
+            # Otro hilo pudo haber renovado el token mientras esperabamos el lock
+            if self._access_token and time.monotonic() < self._refresh_at:
+                return self._access_token
+            return self._refresh()
+
+    def invalidate(self, token: str):
+        # Descarta el token solo si nadie lo renovo ya, para no repetir la renovacion
+        with self._lock:
+            if self._access_token == token:
+                self._access_token = None
+                self._refresh_at = 0.0
+
+    def _refresh(self) -> str:
+        logger.info('Obteniendo token de acceso de Sentinel Hub')
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded'
         }
@@ -42,38 +115,186 @@ class SentinelHubService:
             'client_id': self.client_id,
             'client_secret': self.client_secret
         }
-        response = requests.post(url, data=payload, headers=headers)
+        with metrics.stage('sentinel_oauth'):
+            response = http_client.post(self.oauth_url, data=payload, headers=headers)
         response.raise_for_status()
-        return response.json()['access_token']
+        data = response.json()
+        expires_in = float(data.get('expires_in', 3600))
+        # Renovar con margen, sin que el margen se coma todo el tiempo de vida de tokens cortos
+        margin = min(self.refresh_margin, expires_in / 2)
+        self._access_token = data['access_token']
+        self._refresh_at = time.monotonic() + expires_in - margin
+        return self._access_token
+
+
+token_manager = TokenManager(
+    os.getenv('SENTINEL_OAUTH_URL'),
+    os.getenv('SENTINEL_CLIENT_ID'),
+    os.getenv('SENTINEL_CLIENT_SECRET'),
+    refresh_margin=float(os.getenv('SENTINEL_TOKEN_REFRESH_MARGIN', '60'))
+)
+
+
+class SentinelHubService:
+    def __init__(self):
+        self.instance_id = os.getenv('SENTINEL_INSTANCE_ID')
+        self.client_id = os.getenv('SENTINEL_CLIENT_ID')
+        self.client_secret = os.getenv('SENTINEL_CLIENT_SECRET')
+        self.oauth_url = os.getenv('SENTINEL_OAUTH_URL')
+        self.process_url = os.getenv('SENTINEL_PROCESS_URL')
+        # El token se pide recien cuando hace falta, asi un acierto de cache no toca la red
+        self.access_token = None
+
+    def get_access_token(self):
+        return token_manager.get_token()
 
     def fetch_images(self, parcela: Parcela, tipo_analisis: str):
 
         polygon_coords = convert_points_to_coordinates(parcela.ubicacion)
-        print('PolygonCords: ', polygon_coords)
+        logger.debug(f"Coordenadas del poligono: {polygon_coords}")
         analisis_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{tipo_analisis}"
 
         images = self._fetch_images_from_sentinel(polygon_coords, analisis_id, parcela, tipo_analisis)
         return images, analisis_id
 
-    def _fetch_images_from_sentinel(self, polygon_coords, analisis_id, parcela, tipo_analisis):
-        url = self.process_url
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.access_token}',
-            "Accept": "application/tar"
-        }
+    def fetch_images_multiple(self, parcela: Parcela, tipos: List[str]):
+        # Una sola peticion para todos los tipos: cada banda compartida se descarga una vez
+        for tipo in tipos:
+            if tipo not in TIPOS_ANALISIS:
+                raise Exception(f"Tipo de análisis no válido: {tipo}")
+        polygon_coords = convert_points_to_coordinates(parcela.ubicacion)
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+
+        payload = self._get_data_multiple(tipos, polygon_coords)
+        staging_id = f".{timestamp}_multi"
+        staging_images = self._fetch_payload(payload, '+'.join(tipos), polygon_coords, parcela, staging_id)
+        if not staging_images:
+            return {}
+        staging_path = get_absolute_path(os.path.dirname(staging_images[0].ruta))
+
+        # Repartir las bandas en la carpeta de cada analisis con los nombres de siempre
+        resultados = {}
+        try:
+            for tipo in tipos:
+                analisis_id = f"{timestamp}_{tipo}"
+                storage_service = StorageService(parcela, analisis_id)
+                imagenes = [
+                    storage_service.link_image(os.path.join(staging_path, f"{banda}.png"), f"{nombre}.png")
+                    for nombre, banda in BANDAS_POR_TIPO[tipo].items()
+                ]
+                imagenes.append(storage_service.link_image(os.path.join(staging_path, f"combined_{tipo}.png"),
+                                                           "combined.png"))
+                resultados[tipo] = (imagenes, analisis_id)
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+        return resultados
 
+    def fetch_images_cluster(self, parcelas: List[Parcela], tipos: List[str],
+                             pendientes: Optional[Dict[Tuple[str, str], List[str]]] = None):
+        """
+        Una sola peticion por el bbox comun de un cluster de parcelas vecinas; las bandas
+        de cada parcela se recortan localmente con su poligono. Con `pendientes` solo se
+        guardan los tipos indicados para cada (usuario_id, parcela_id). Cada recorte pasa
+        por la cache de imagenes, con la peticion del cluster en la clave: si todos estan
+        en cache no se descarga nada. Devuelve, por (usuario_id, parcela_id), lo mismo que
+        `fetch_images_multiple`.
+        """
+        for tipo in tipos:
+            if tipo not in TIPOS_ANALISIS:
+                raise Exception(f"Tipo de análisis no válido: {tipo}")
+        poligonos = {(parcela.usuario_id, parcela.id): convert_points_to_coordinates(parcela.ubicacion)
+                     for parcela in parcelas}
+        box = reduce(spatial.union, (geometry.bbox(coords) for coords in poligonos.values()))
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        payload = self._get_data_multiple(tipos, None, box=box)
+        width, height = payload['output']['width'], payload['output']['height']
+
+        resultados = {clave: {} for clave in poligonos}
+        faltan = {}
+        for parcela in parcelas:
+            clave = (parcela.usuario_id, parcela.id)
+            for tipo in (pendientes[clave] if pendientes is not None else tipos):
+                analisis_id = f"{timestamp}_{tipo}"
+                cache_key = imagery_cache.build_key(tipo, poligonos[clave], payload) if imagery_cache else None
+                imagenes = imagery_cache.get(cache_key, parcela, analisis_id) if cache_key else None
+                if imagenes is not None:
+                    resultados[clave][tipo] = (imagenes, analisis_id)
+                else:
+                    faltan.setdefault(clave, []).append((tipo, cache_key))
+        if not faltan:
+            return resultados
+
+        bandas = self._descargar_bandas(payload)
+        if not bandas:
+            return resultados
+        for parcela in parcelas:
+            clave = (parcela.usuario_id, parcela.id)
+            if clave not in faltan:
+                continue
+            coords = poligonos[clave]
+            ventana_px = spatial.ventana(box, geometry.bbox(coords), width, height)
+            mascara = spatial.mascara_poligono(coords[0], box, width, height, ventana_px)
+            # Cada banda se guarda una vez por parcela y se enlaza en los demas analisis
+            guardadas = {}
+            for tipo, cache_key in faltan[clave]:
+                analisis_id = f"{timestamp}_{tipo}"
+                storage_service = StorageService(parcela, analisis_id)
+                imagenes = []
+                for nombre, banda in BANDAS_POR_TIPO[tipo].items():
+                    filename = f"{nombre}.png"
+                    if banda in guardadas:
+                        ruta_guardada, sha = guardadas[banda]
+                        imagenes.append(storage_service.link_image(ruta_guardada, filename, sha))
+                        continue
+                    ruta = storage_service.save_image(_png(spatial.recortar(bandas[banda], ventana_px, mascara)),
+                                                      filename)
+                    guardadas[banda] = (get_absolute_path(ruta), storage_service.content_hashes[filename])
+                    imagenes.append(ImagenSatelital(ruta=ruta, tipo=nombre))
+                combinada = spatial.recortar(bandas[f"combined_{tipo}"], ventana_px, mascara)
+                imagenes.append(ImagenSatelital(ruta=storage_service.save_image(_png(combinada), "combined.png"),
+                                                tipo="combined"))
+                if cache_key:
+                    imagery_cache.put(cache_key, storage_service)
+                resultados[clave][tipo] = (imagenes, analisis_id)
+        logger.info(f"Descarga compartida de {width}x{height} px para {len(faltan)} parcelas")
+        return resultados
+
+    def _descargar_bandas(self, payload):
+        # Bandas de la respuesta decodificadas en memoria, por identifier
+        with self._request(payload) as response:
+            if response.status_code != 200:
+                raise Exception(f"Error fetching images: {response.status_code} - {response.text}")
+            if 'application/x-tar' not in response.headers.get('Content-Type', ''):
+                raise Exception("Unexpected response format")
+            bandas = {}
+            response.raw.decode_content = True
+            with metrics.stage('tar_extract'), tarfile.open(fileobj=response.raw, mode='r|*') as tar_file:
+                for member in tar_file:
+                    file = tar_file.extractfile(member)
+                    if file:
+                        with Image.open(io.BytesIO(file.read())) as image:
+                            bandas[os.path.basename(member.name).split('.')[0]] = np.array(image)
+            metrics.BYTES_DOWNLOADED.labels('sentinelhub').inc(response.raw.tell())
+        return bandas
+
+    def _fetch_images_from_sentinel(self, polygon_coords, analisis_id, parcela, tipo_analisis):
         payload = self._get_data_by_tipo(tipo_analisis, polygon_coords)
         if payload:
-            response = requests.post(url, headers=headers, json=payload)
-            if response.status_code == 401:
-                # Token expirado, obtener uno nuevo y reintentar
-                self.access_token = self.get_access_token()
-                headers['Authorization'] = f'Bearer {self.access_token}'
-                response = requests.post(url, headers=headers, json=payload)
+            return self._fetch_payload(payload, tipo_analisis, polygon_coords, parcela, analisis_id)
+        else:
+            raise Exception(f"Tipo de análisis no válido: {tipo_analisis}")
+
+    def _fetch_payload(self, payload, cache_tipo, polygon_coords, parcela, analisis_id):
+        cache_key = None
+        if imagery_cache:
+            cache_key = imagery_cache.build_key(cache_tipo, polygon_coords, payload)
+            cached_images = imagery_cache.get(cache_key, parcela, analisis_id)
+            if cached_images is not None:
+                return cached_images
 
-            print(f"Response Status Code: {response.status_code}")
-            print(f"Response Headers: {response.headers}")
+        with self._request(payload) as response:
+            logger.debug(f"Respuesta de Sentinel Hub: {response.status_code}",
+                         extra={'headers': dict(response.headers)})
 
             if response.status_code == 200:
                 try:
@@ -81,6 +302,9 @@ class SentinelHubService:
                     if 'application/x-tar' in response.headers.get('Content-Type', ''):
                         storage_service = StorageService(parcela, analisis_id)
                         saved_images = storage_service.save_image_from_tar(response)
+                        metrics.BYTES_DOWNLOADED.labels('sentinelhub').inc(response.raw.tell())
+                        if imagery_cache:
+                            imagery_cache.put(cache_key, storage_service)
                         return saved_images
                     else:
                         raise Exception("Unexpected response format")
@@ -88,205 +312,114 @@ class SentinelHubService:
                     raise Exception(f"Error parsing JSON response: {e}")
             else:
                 raise Exception(f"Error fetching images: {response.status_code} - {response.text}")
-        else:
-            raise Exception(f"Tipo de análisis no válido: {tipo_analisis}")
+
+    def _request(self, payload):
+        url = self.process_url
+        self.access_token = self.get_access_token()
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.access_token}',
+            "Accept": "application/tar"
+        }
+
+        # stream=True: el tar se procesa a medida que llega en lugar de bufferearlo
+        sentinelhub_limiter.acquire()
+        # Hasta recibir las cabeceras: el tiempo de procesamiento en Sentinel Hub
+        with metrics.stage('sentinel_process'):
+            response = http_client.post(url, headers=headers, json=payload, stream=True)
+            if response.status_code == 401:
+                # Token expirado o revocado, obtener uno nuevo y reintentar
+                response.close()
+                token_manager.invalidate(self.access_token)
+                self.access_token = self.get_access_token()
+                headers['Authorization'] = f'Bearer {self.access_token}'
+                response = http_client.post(url, headers=headers, json=payload, stream=True)
+
+        return response
 
     def _get_data_by_tipo(self, tipo: str, polygon_coords):
-        # Obtener la fecha actual y la fecha de hace un mes
+        if tipo not in EVALSCRIPTS:
+            return None
+        identifiers = list(BANDAS_POR_TIPO[tipo]) + ['combined']
+        bandas = BANDAS_POR_TIPO[tipo].values()
+        return self._build_payload(polygon_coords, EVALSCRIPTS[tipo], identifiers, bandas)
+
+    def _get_data_multiple(self, tipos: List[str], polygon_coords, box=None):
+        # Evalscript combinado: la union de las bandas de todos los tipos, cada una como
+        # salida propia, mas la imagen combinada de cada tipo
+        bandas = sorted({banda for tipo in tipos for banda in BANDAS_POR_TIPO[tipo].values()})
+        outputs = [f"{{ id: '{banda}', bands: 1 }}" for banda in bandas]
+        outputs += [f"{{ id: 'combined_{tipo}', bands: 3 }}" for tipo in tipos]
+        values = [f"{banda}: [sample.{banda}]" for banda in bandas]
+        for tipo in tipos:
+            combinada = ', '.join(f"sample.{BANDAS_POR_TIPO[tipo][nombre]}" for nombre in COMBINADA_POR_TIPO[tipo])
+            values.append(f"combined_{tipo}: [{combinada}]")
+        inputs = ', '.join(f"'{banda}'" for banda in bandas)
+        evalscript = (
+            "//VERSION=3\n"
+            f"function setup() {{ return {{ input: [{inputs}], output: [ {', '.join(outputs)} ] }}; }}\n"
+            f"function evaluatePixel(sample) {{ return {{ {', '.join(values)} }}; }}"
+        )
+        identifiers = bandas + [f"combined_{tipo}" for tipo in tipos]
+        return self._build_payload(polygon_coords, evalscript, identifiers, bandas, box=box)
+
+    def _output_size(self, box, bandas):
+        # Tamaño que corresponde a la resolucion nativa de la banda mas fina pedida, en lugar
+        # de un 2048x2048 fijo que sobremuestrea las parcelas chicas
+        resolution_m = min(geometry.BANDA_RESOLUCION_M.get(banda, 10) for banda in bandas)
+        width, height = geometry.output_size(box, resolution_m, OUTPUT_MIN_PX, OUTPUT_MAX_PX)
+        logger.debug(f"Bbox {box}, salida {width}x{height} a {resolution_m} m")
+        return width, height
+
+    def _build_payload(self, polygon_coords, evalscript: str, identifiers: List[str], bandas, box=None):
+        # Con box se pide el rectangulo completo (descarga compartida por un cluster de
+        # parcelas); si no, solo el poligono de la parcela
+        if box is None:
+            bounds = {"geometry": {"type": "Polygon", "coordinates": polygon_coords}}
+            width, height = self._output_size(geometry.bbox(polygon_coords), bandas)
+        else:
+            bounds = {"bbox": list(box), "properties": {"crs": "http://www.opengis.net/def/crs/OGC/1.3/CRS84"}}
+            width, height = self._output_size(box, bandas)
+
+        # Obtener la fecha actual y el inicio de la ventana (un mes por defecto)
         to_date = datetime.now()
-        from_date = to_date - timedelta(days=30)
+        from_date = to_date - timedelta(days=VENTANA_DIAS)
 
         # Formatear las fechas
         to_date_str = to_date.strftime('%Y-%m-%dT%H:%M:%SZ')
         from_date_str = from_date.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-        if tipo == 'maleza':
-
-            payload = {
-                "input": {
-                    "bounds": {
-                        "geometry": {
-                            "type": "Polygon",
-                            "coordinates": polygon_coords
-                        }
-                    },
-                    "data": [
-                        {
-                            "dataFilter": {
-                                "timeRange": {
-                                    "from": from_date_str,
-                                    "to": to_date_str
-                                },
-                                "maxCloudCoverage": 20
-                            },
-                            "processing": {
-                                "harmonizeValues": True
+        return {
+            "input": {
+                "bounds": bounds,
+                "data": [
+                    {
+                        "type": "sentinel-2-l2a",
+                        "dataFilter": {
+                            "timeRange": {
+                                "from": from_date_str,
+                                "to": to_date_str
                             },
-                            "type": "sentinel-2-l2a"
-                        }
-                    ]
-                },
-                "output": {
-                    "width": 2048,
-                    "height": 2048,
-                    "responses": [
-                        {
-                            "identifier": "blue",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "green",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "red",
-                            "format": {
-                                "type": "image/png"
-                            }
+                            "maxCloudCoverage": MAX_NUBOSIDAD
                         },
-                        {
-                            "identifier": "nir",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "combined",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        }
-                    ]
-                },
-                "evalscript": "//VERSION=3\n\nfunction setup() {\n  return {\n    input: [\"B02\", \"B03\", \"B04\", \"B08\"],\n    output: [\n      { id: \"blue\", bands: 1 },\n      { id: \"green\", bands: 1 },\n      { id: \"red\", bands: 1 },\n      { id: \"nir\", bands: 1 },\n      { id: \"combined\", bands: 3 }\n    ]\n  }\n}\n\nfunction evaluatePixel(sample) {\n  let blue = sample.B02;\n  let green = sample.B03;\n  let red = sample.B04;\n  let nir = sample.B08;\n\n  return {\n    blue: [blue],\n    green: [green],\n    red: [red],\n    nir: [nir],\n    combined: [nir, red, green]\n  }\n}"
-            }
-
-            return payload
-        elif tipo == 'nutricion':
-            evalscript = "//VERSION=3\nfunction setup() { return { input: ['B04', 'B08', 'B11'], output: [ { id: 'red', bands: 1 }, { id: 'nir', bands: 1 }, { id: 'swir', bands: 1 }, { id: 'combined', bands: 3 } ] }; }\nfunction evaluatePixel(sample) { let red = sample.B04; let nir = sample.B08; let swir = sample.B11; return { red: [red], nir: [nir], swir: [swir], combined: [nir, red, swir] }; }"
-
-            payload = {
-                "input": {
-                    "bounds": {
-                        "geometry": {
-                            "type": "Polygon",
-                            "coordinates": polygon_coords
+                        "processing": {
+                            "harmonizeValues": True
                         }
-                    },
-                    "data": [
-                        {
-                            "type": "sentinel-2-l2a",
-                            "dataFilter": {
-                                "timeRange": {
-                                    "from": from_date_str,
-                                    "to": to_date_str
-                                },
-                                "maxCloudCoverage": 20
-                            },
-                            "processing": {
-                                "harmonizeValues": True
-                            }
+                    }
+                ]
+            },
+            "output": {
+                "width": width,
+                "height": height,
+                "responses": [
+                    {
+                        "identifier": identifier,
+                        "format": {
+                            "type": "image/png"
                         }
-                    ]
-                },
-                "output": {
-                    "width": 2048,
-                    "height": 2048,
-                    "responses": [
-                        {
-                            "identifier": "red",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "nir",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "swir",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "combined",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        }
-                    ]
-                },
-                "evalscript": evalscript
-            }
-
-            return payload
-        elif tipo == 'plagas':
-            evalscript = "//VERSION=3\nfunction setup() { return { input: ['B08', 'B11', 'B12'], output: [ { id: 'nir', bands: 1 }, { id: 'swir1', bands: 1 }, { id: 'swir2', bands: 1 }, { id: 'combined', bands: 3 } ] }; }\nfunction evaluatePixel(sample) { let nir = sample.B08; let swir1 = sample.B11; let swir2 = sample.B12; return { nir: [nir], swir1: [swir1], swir2: [swir2], combined: [swir2, swir1, nir] }; }"
-
-            payload = {
-                "input": {
-                    "bounds": {
-                        "geometry": {
-                            "type": "Polygon",
-                            "coordinates": polygon_coords
-                        }
-                    },
-                    "data": [
-                        {
-                            "type": "sentinel-2-l2a",
-                            "dataFilter": {
-                                "timeRange": {
-                                    "from": from_date_str,
-                                    "to": to_date_str
-                                },
-                                "maxCloudCoverage": 20
-                            },
-                            "processing": {
-                                "harmonizeValues": True
-                            }
-                        }
-                    ]
-                },
-                "output": {
-                    "width": 2048,
-                    "height": 2048,
-                    "responses": [
-                        {
-                            "identifier": "nir",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "swir1",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "swir2",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        },
-                        {
-                            "identifier": "combined",
-                            "format": {
-                                "type": "image/png"
-                            }
-                        }
-                    ]
-                },
-                "evalscript": evalscript
-            }
-
-            return payload
-        else:
-            return None
+                    }
+                    for identifier in identifiers
+                ]
+            },
+            "evalscript": evalscript
+        }
@@ -0,0 +1,234 @@
+import io
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from models import Analisis
+from services.indices import PERCENTILES
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Estadisticos de cada indice que se guardan en la serie
+ESTADISTICOS = ('media',) + tuple(f"p{p}" for p in PERCENTILES)
+
+
+def _columna(indice: str, estadistico: str) -> str:
+    return f"{indice}.{estadistico}"
+
+
+class SeriesStore:
+    """
+    Series temporales de las estadisticas de los analisis, una por parcela y tipo, como
+    columnas numpy guardadas en un .npz. Cada consulta lee arrays en memoria, sin tocar
+    Firestore ni las imagenes. Solo las altas escriben: la primera de cada parcela y tipo
+    arma la serie con los analisis ya guardados.
+
+    Columnas: fecha (datetime64[s]), analisis_id, fraccion_enmascarada y un
+    '<indice>.<estadistico>' por cada estadistico de cada indice (NaN si falta).
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = os.path.realpath(path)
+        self.max_entries = max_entries
+        # Protege solo el LRU y los contadores; las lecturas de disco y Firestore van fuera
+        self.lock = threading.Lock()
+        # Serializan las altas y bajas de una misma serie (repartidas en franjas por clave)
+        self._locks = [threading.Lock() for _ in range(64)]
+        self.series: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file_path(self, usuario_id: str, parcela_id: str, tipo: str) -> str:
+        # Los ids llegan desde la URL: la ruta no puede salir de la carpeta de series
+        file_path = os.path.realpath(os.path.join(self.path, usuario_id, parcela_id, f"{tipo}.npz"))
+        if os.path.commonpath([self.path, file_path]) != self.path:
+            raise ValueError("Serie no válida")
+        return file_path
+
+    def _lock_serie(self, key: tuple) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    @staticmethod
+    def _vacia() -> Dict[str, np.ndarray]:
+        return {
+            'fecha': np.array([], dtype='datetime64[s]'),
+            'analisis_id': np.array([], dtype=str),
+            'fraccion_enmascarada': np.array([], dtype=np.float64),
+        }
+
+    @staticmethod
+    def _fila(analisis: Analisis) -> Dict[str, object]:
+        fraccion = [indice.fraccion_enmascarada for indice in (analisis.indices or {}).values()
+                    if indice.fraccion_enmascarada is not None]
+        fila = {
+            'fecha': np.datetime64(analisis.fecha.replace(microsecond=0, tzinfo=None), 's'),
+            'analisis_id': analisis.id,
+            'fraccion_enmascarada': min(fraccion) if fraccion else np.nan,
+        }
+        for nombre, indice in (analisis.indices or {}).items():
+            fila[_columna(nombre, 'media')] = indice.media
+            for estadistico in ESTADISTICOS[1:]:
+                fila[_columna(nombre, estadistico)] = (indice.percentiles or {}).get(estadistico, np.nan)
+        return fila
+
+    def _leer(self, key: tuple) -> Optional[Dict[str, np.ndarray]]:
+        # Serie en memoria o en disco; None si todavia no se guardo ninguna
+        with self.lock:
+            serie = self.series.get(key)
+            if serie is not None:
+                self.hits += 1
+                self.series.move_to_end(key)
+                return serie
+            self.misses += 1
+        file_path = self._file_path(*key)
+        if not os.path.exists(file_path):
+            return None
+        with np.load(file_path) as data:
+            serie = {nombre: data[nombre] for nombre in data.files}
+        # Una alta concurrente pudo dejar ya una version mas nueva: no pisarla
+        return self._recordar(key, serie, reemplazar=False)
+
+    def _recordar(self, key: tuple, serie: Dict[str, np.ndarray], reemplazar: bool = True) -> Dict[str, np.ndarray]:
+        with self.lock:
+            if not reemplazar and key in self.series:
+                return self.series[key]
+            self.series[key] = serie
+            self.series.move_to_end(key)
+            while len(self.series) > self.max_entries:
+                self.series.popitem(last=False)
+        return serie
+
+    def _construir(self, usuario_id: str, parcela_id: str, tipo: str) -> Dict[str, np.ndarray]:
+        # Primera alta de la parcela y tipo (p. ej. analisis anteriores a la serie): se arma
+        # una vez desde Firestore y desde ahi se mantiene incrementalmente
+        serie = self._vacia()
+        analisis_list = [analisis for analisis in Analisis.get_all(usuario_id, parcela_id)
+                         if analisis.tipo == tipo and analisis.fecha and analisis.indices]
+        for analisis in analisis_list:
+            serie = self._agregar_fila(serie, self._fila(analisis))
+        return serie
+
+    def _guardar(self, key: tuple, serie: Dict[str, np.ndarray]):
+        file_path = self._file_path(*key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, **serie)
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(buffer.getvalue())
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def _agregar_fila(serie: Dict[str, np.ndarray], fila: Dict[str, object]) -> Dict[str, np.ndarray]:
+        # Reemplaza la fila del mismo analisis si ya estaba, y mantiene el orden por fecha
+        conservar = serie['analisis_id'] != fila['analisis_id']
+        filas = int(conservar.sum())
+        posicion = int(np.searchsorted(serie['fecha'][conservar], fila['fecha'], side='right'))
+        nueva = {}
+        for nombre in set(serie) | set(fila):
+            columna = serie[nombre][conservar] if nombre in serie else np.full(filas, np.nan)
+            valor = fila.get(nombre, np.nan)
+            if nombre == 'analisis_id':
+                # np.insert truncaria el id al ancho del dtype unicode actual
+                ids = columna.tolist()
+                nueva[nombre] = np.array(ids[:posicion] + [valor] + ids[posicion:], dtype=str)
+            else:
+                nueva[nombre] = np.insert(columna, posicion, valor)
+        return nueva
+
+    def agregar(self, usuario_id: str, parcela_id: str, analisis: Analisis):
+        # Unico punto que escribe series en disco
+        if not analisis.fecha or not analisis.indices:
+            return
+        key = (usuario_id, parcela_id, analisis.tipo)
+        with self._lock_serie(key):
+            serie = self._leer(key)
+            if serie is None:
+                serie = self._construir(*key)
+            serie = self._agregar_fila(serie, self._fila(analisis))
+            self._guardar(key, serie)
+            self._recordar(key, serie)
+
+    def quitar(self, usuario_id: str, parcela_id: str, analisis_id: Optional[str] = None):
+        # Sin analisis_id se descartan todas las series de la parcela
+        carpeta = os.path.dirname(self._file_path(usuario_id, parcela_id, 'serie'))
+        if analisis_id is None:
+            with self.lock:
+                for key in [key for key in self.series if key[:2] == (usuario_id, parcela_id)]:
+                    del self.series[key]
+            shutil.rmtree(carpeta, ignore_errors=True)
+            return
+        tipos = [nombre[:-4] for nombre in os.listdir(carpeta) if nombre.endswith('.npz')] \
+            if os.path.isdir(carpeta) else []
+        for tipo in tipos:
+            key = (usuario_id, parcela_id, tipo)
+            with self._lock_serie(key):
+                serie = self._leer(key)
+                if serie is None or (serie['analisis_id'] != analisis_id).all():
+                    continue
+                conservar = serie['analisis_id'] != analisis_id
+                serie = {nombre: columna[conservar] for nombre, columna in serie.items()}
+                self._guardar(key, serie)
+                self._recordar(key, serie)
+
+    def consultar(self, usuario_id: str, parcela_id: str, tipo: str, desde: Optional[datetime] = None,
+                  hasta: Optional[datetime] = None, indices: Optional[List[str]] = None) -> dict:
+        """
+        Serie de la parcela y tipo entre `desde` y `hasta` (inclusive), con los indices
+        indicados o todos. Los valores faltantes se devuelven como None.
+        """
+        # Solo lectura: una parcela sin serie guardada devuelve una serie vacia
+        serie = self._leer((usuario_id, parcela_id, tipo)) or self._vacia()
+        fechas = serie['fecha']
+        inicio = int(np.searchsorted(fechas, np.datetime64(desde.replace(tzinfo=None), 's'), side='left')) \
+            if desde else 0
+        fin = int(np.searchsorted(fechas, np.datetime64(hasta.replace(tzinfo=None), 's'), side='right')) \
+            if hasta else len(fechas)
+
+        def valores(columna: np.ndarray) -> List[Optional[float]]:
+            tramo = columna[inicio:fin]
+            return [None if np.isnan(valor) else float(valor) for valor in tramo]
+
+        resultado_indices = {}
+        for nombre in sorted(serie):
+            if '.' not in nombre:
+                continue
+            indice, estadistico = nombre.split('.', 1)
+            if indices and indice not in indices:
+                continue
+            resultado_indices.setdefault(indice, {})[estadistico] = valores(serie[nombre])
+        return {
+            'tipo': tipo,
+            'fechas': fechas[inicio:fin].astype(datetime).tolist(),
+            'analisis_ids': serie['analisis_id'][inicio:fin].tolist(),
+            'fraccion_enmascarada': valores(serie['fraccion_enmascarada']),
+            'indices': resultado_indices,
+        }
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.series),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+series_store: Optional[SeriesStore] = None
+if os.getenv('SERIES_ENABLED', 'true').lower() == 'true':
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    series_store = SeriesStore(
+        os.path.join(project_root, os.getenv('SERIES_PATH', 'data/series')),
+        max_entries=int(os.getenv('SERIES_MAX_ENTRIES', '10000'))
+    )
@@ -0,0 +1,161 @@
+import math
+import os
+from collections import defaultdict
+from typing import Dict, Hashable, List, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from services import geometry
+
+load_dotenv()
+
+# Agrupar las parcelas vecinas que vencen juntas en una sola descarga de Sentinel Hub
+AGRUPAR_ENABLED = os.getenv('SPATIAL_CLUSTERING_ENABLED', 'true').lower() == 'true'
+# Lado maximo del bbox de un cluster: a 10 m por pixel entra en la salida maxima de la API
+MAX_LADO_M = float(os.getenv('SPATIAL_MAX_LADO_M', '10000'))
+MIN_OCUPACION = float(os.getenv('SPATIAL_MIN_OCUPACION', '0.25'))
+MAX_PARCELAS = int(os.getenv('SPATIAL_MAX_PARCELAS', '20'))
+
+# Metros por grado de latitud; las celdas del indice son cuadradas en grados
+METROS_POR_GRADO = math.pi * geometry.EARTH_RADIUS_M / 180
+
+Box = Tuple[float, float, float, float]
+
+
+def union(a: Box, b: Box) -> Box:
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def poligono_bbox(box: Box):
+    # Anillo cerrado del rectangulo, con la forma de `convert_points_to_coordinates`
+    min_lon, min_lat, max_lon, max_lat = box
+    return [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]]
+
+
+def _area(box: Box) -> float:
+    ancho, alto = geometry.bbox_size_m(box)
+    return ancho * alto
+
+
+class GridIndex:
+    """
+    Indice espacial de grilla regular sobre los bbox de las parcelas: cada parcela se
+    registra en las celdas que toca y la busqueda devuelve las que comparten celda con
+    el bbox consultado.
+    """
+
+    def __init__(self, celda_m: float):
+        self.celda = celda_m / METROS_POR_GRADO
+        self.celdas: Dict[Tuple[int, int], List[Hashable]] = defaultdict(list)
+        self.boxes: Dict[Hashable, Box] = {}
+
+    def _rango(self, box: Box):
+        min_lon, min_lat, max_lon, max_lat = box
+        for i in range(math.floor(min_lon / self.celda), math.floor(max_lon / self.celda) + 1):
+            for j in range(math.floor(min_lat / self.celda), math.floor(max_lat / self.celda) + 1):
+                yield i, j
+
+    def insertar(self, key: Hashable, box: Box):
+        self.boxes[key] = box
+        for celda in self._rango(box):
+            self.celdas[celda].append(key)
+
+    def buscar(self, box: Box, margen_m: float = 0.0) -> List[Hashable]:
+        margen = margen_m / METROS_POR_GRADO
+        ampliado = (box[0] - margen, box[1] - margen, box[2] + margen, box[3] + margen)
+        encontrados = {}
+        for celda in self._rango(ampliado):
+            for key in self.celdas.get(celda, ()):
+                encontrados[key] = None
+        return list(encontrados)
+
+
+def agrupar(boxes: Dict[Hashable, Box], max_lado_m: float, min_ocupacion: float,
+            max_parcelas: int) -> List[List[Hashable]]:
+    """
+    Agrupa parcelas cercanas en clusters cuyo bbox comun mide a lo sumo `max_lado_m` por
+    lado y en el que los bbox de las parcelas cubren al menos `min_ocupacion` del area,
+    para que la descarga compartida no pague por mucho terreno vacio.
+
+    Greedy: cada parcela sin asignar inicia un cluster y suma a sus vecinas por distancia.
+    """
+    index = GridIndex(max_lado_m)
+    for key, box in boxes.items():
+        index.insertar(key, box)
+
+    def centro(box: Box):
+        return (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+
+    asignadas = set()
+    clusters = []
+    for semilla in sorted(boxes, key=lambda key: (boxes[key][0], boxes[key][1])):
+        if semilla in asignadas:
+            continue
+        asignadas.add(semilla)
+        cluster = [semilla]
+        caja = boxes[semilla]
+        area_parcelas = _area(caja)
+        cx, cy = centro(caja)
+        vecinas = [key for key in index.buscar(caja, max_lado_m) if key not in asignadas]
+        vecinas.sort(key=lambda key: (centro(boxes[key])[0] - cx) ** 2 + (centro(boxes[key])[1] - cy) ** 2)
+        for vecina in vecinas:
+            if len(cluster) >= max_parcelas:
+                break
+            nueva = union(caja, boxes[vecina])
+            ancho, alto = geometry.bbox_size_m(nueva)
+            if ancho > max_lado_m or alto > max_lado_m:
+                continue
+            area = _area(nueva)
+            if area > 0 and (area_parcelas + _area(boxes[vecina])) / area < min_ocupacion:
+                continue
+            cluster.append(vecina)
+            asignadas.add(vecina)
+            caja = nueva
+            area_parcelas += _area(boxes[vecina])
+        clusters.append(cluster)
+    return clusters
+
+
+def ventana(box: Box, parcela_box: Box, width: int, height: int) -> Tuple[int, int, int, int]:
+    # (col0, fila0, col1, fila1) de la imagen del cluster que cubren el bbox de la parcela
+    min_lon, min_lat, max_lon, max_lat = box
+    dx = (max_lon - min_lon) / width
+    dy = (max_lat - min_lat) / height
+    col0 = max(0, math.floor((parcela_box[0] - min_lon) / dx))
+    col1 = min(width, math.ceil((parcela_box[2] - min_lon) / dx))
+    fila0 = max(0, math.floor((max_lat - parcela_box[3]) / dy))
+    fila1 = min(height, math.ceil((max_lat - parcela_box[1]) / dy))
+    return col0, fila0, max(col1, col0 + 1), max(fila1, fila0 + 1)
+
+
+def mascara_poligono(ring: Sequence[Sequence[float]], box: Box, width: int, height: int,
+                     ventana_px: Tuple[int, int, int, int]) -> np.ndarray:
+    """
+    Rasteriza el anillo sobre los centros de los pixeles de la ventana (regla par-impar).
+    Itera sobre las aristas y opera sobre todas las filas y columnas a la vez.
+    """
+    min_lon, min_lat, max_lon, max_lat = box
+    col0, fila0, col1, fila1 = ventana_px
+    x = min_lon + (np.arange(col0, col1) + 0.5) * (max_lon - min_lon) / width
+    y = max_lat - (np.arange(fila0, fila1) + 0.5) * (max_lat - min_lat) / height
+    x = x[np.newaxis, :]
+    y = y[:, np.newaxis]
+    dentro = np.zeros((fila1 - fila0, col1 - col0), dtype=bool)
+    puntos = list(ring)
+    for (x1, y1), (x2, y2) in zip(puntos, puntos[1:] + puntos[:1]):
+        if y1 == y2:
+            continue
+        cruza = (y1 > y) != (y2 > y)
+        x_corte = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        dentro ^= cruza & (x < x_corte)
+    return dentro
+
+
+def recortar(banda: np.ndarray, ventana_px: Tuple[int, int, int, int], mascara: np.ndarray) -> np.ndarray:
+    # Recorte de la ventana con los pixeles fuera del poligono en 0, como los devuelve
+    # Sentinel Hub cuando la peticion se hace con la geometria de la parcela
+    col0, fila0, col1, fila1 = ventana_px
+    recorte = banda[fila0:fila1, col0:col1].copy()
+    recorte[~mascara] = 0
+    return recorte
@@ -1,20 +1,59 @@
+import logging
 import os
 from dotenv import load_dotenv
 import tarfile
-import io
+import hashlib
+import shutil
+from typing import Optional
 
 from models import Parcela, ImagenSatelital
+from services import metrics
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Tamaño del buffer usado para copiar cada imagen del tar al disco
+CHUNK_SIZE = int(os.getenv('STORAGE_CHUNK_SIZE', str(64 * 1024)))
+
+
+def get_storage_path() -> str:
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return f"{project_root}{os.getenv('STORAGE_CONTAINER_PATH', 'img')}"
+
+
+def get_absolute_path(ruta: str) -> str:
+    # Ruta en disco de una imagen a partir de la ruta relativa guardada en el analisis
+    return os.path.join(get_storage_path(), ruta)
+
+
+def file_sha256(filepath: str) -> str:
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_or_copy(src: str, dst: str):
+    # Hard link cuando se puede (mismo volumen), copia en caso contrario
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
 
 class StorageService:
     def __init__(self, parcela: Parcela, analisis_id: str):
         # Obtener la ruta raiz del proyecto
         self.folder_path = None
         self.relative_path = None
+        # Hash sha256 del contenido de cada imagen guardada, por nombre de archivo
+        self.content_hashes = {}
         self.project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        self.storage_path = f"{self.project_root}{os.getenv('STORAGE_CONTAINER_PATH', 'img')}"
+        self.storage_path = get_storage_path()
         # Crear directorio si no existe
         os.makedirs(self.storage_path, exist_ok=True)
         self.create_folder_structure(parcela, analisis_id)
@@ -24,27 +63,63 @@ class StorageService:
         self.relative_path = os.path.join(parcela.usuario_id, parcela.id, analisis_id)
         self.folder_path = os.path.join(self.storage_path,self.relative_path)
         os.makedirs(self.folder_path, exist_ok=True)
-        print(f"Ruta de almacenamiento de imagenes: {self.folder_path}")
+        logger.debug(f"Ruta de almacenamiento de imagenes: {self.folder_path}")
 
     def save_image_from_tar(self, response):
+        # Leer el tar directamente del stream de la respuesta, sin cargarlo completo en memoria
         saved_images = []
-        tar_content = io.BytesIO(response.content)
-        with tarfile.open(fileobj=tar_content) as tar_file:
-            for member in tar_file.getmembers():
+        response.raw.decode_content = True
+        with metrics.stage('tar_extract'), tarfile.open(fileobj=response.raw, mode='r|*') as tar_file:
+            for member in tar_file:
                 file = tar_file.extractfile(member)
                 if file:
-                    content = file.read()
-                    filename = member.name
-                    relativepath = self.save_image(content, filename)
+                    filename = os.path.basename(member.name)
+                    relativepath = self.save_stream(file, filename)
                     image_type = filename.split('.')[0]
                     saved_images.append(ImagenSatelital(ruta=relativepath, tipo=image_type))
         return saved_images
 
+    def save_stream(self, fileobj, filename: str) -> str:
+        # Copiar por bloques a un archivo temporal y renombrarlo al terminar, para que
+        # nunca quede visible una imagen a medio escribir
+        filepath = os.path.join(self.folder_path, filename)
+        tmp_path = os.path.join(self.folder_path, f".{filename}.tmp")
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            with metrics.stage('file_write'):
+                with open(tmp_path, 'wb') as file:
+                    while True:
+                        chunk = fileobj.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sha.update(chunk)
+                        file.write(chunk)
+                        size += len(chunk)
+                os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        metrics.BYTES_STORED.inc(size)
+        self.content_hashes[filename] = sha.hexdigest()
+        logger.debug(f"Imagen guardada: {filepath} ({size} bytes)")
+        return os.path.join(self.relative_path, filename)
+
+    def link_image(self, src_path: str, filename: str, sha: Optional[str] = None) -> ImagenSatelital:
+        # Reutilizar una imagen ya guardada en disco sin duplicar su contenido
+        link_or_copy(src_path, os.path.join(self.folder_path, filename))
+        if sha:
+            self.content_hashes[filename] = sha
+        return ImagenSatelital(ruta=os.path.join(self.relative_path, filename), tipo=filename.split('.')[0])
+
     def save_image(self, image_data: bytes, filename: str) -> str:
         # Definir la ruta completa del archivo
         filepath = os.path.join(self.folder_path, filename)
-        print(f"Imagen guardada: {filepath}")
+        logger.debug(f"Imagen guardada: {filepath}")
         # Escribir los datos de la imagen en el archivo
         with open(filepath, 'wb') as file:
             file.write(image_data)
+        metrics.BYTES_STORED.inc(len(image_data))
+        self.content_hashes[filename] = hashlib.sha256(image_data).hexdigest()
         return os.path.join(self.relative_path, filename)